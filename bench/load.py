@@ -0,0 +1,329 @@
+"""
+MCP server 壓測：啟動本機 stub 後端與 server.py（streamable-http），
+以多個租戶 token 依權重混合呼叫 tool，輸出各 tool 的 p50/p95/p99、throughput 以及 server 的 RSS / FD 數
+全程在本機執行，不需要網路
+
+    uv run python bench/load.py --tenants 50 --concurrency 32 --duration 30 --latency-ms 20
+    uv run python bench/load.py --server-url http://127.0.0.1:8080/mcp --tokens-file tokens.json  # 壓測已在執行的 server
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from typing import Optional
+
+import aiohttp
+from fastmcp import Client
+from fastmcp.client.transports import StreamableHttpTransport
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stub_backend import StubConfig, start_stub_backend  # noqa: E402
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server.py')
+
+DEFAULT_MIX = {
+    'my_application_get_brief_webpage_structure': 25,
+    'my_application_get_element_component_source': 15,
+    'my_application_list_all_webpages': 10,
+    'my_application_get_detail_element_structure': 10,
+    'my_application_list_my_media_assets': 10,
+    'my_application_retrieve_product': 10,
+    'my_application_update_element': 10,
+    'my_application_create_element': 5,
+    'my_application_update_product': 5,
+}
+
+COMPONENTS = ['ck_editor', 'custom_slider', 'product_detail', 'cart_button', 'shop', 'blog_grid', 'checkout_form']
+
+
+def _tool_args(tool: str, rng: random.Random, webpage_count: int) -> dict:
+    some_uuid = str(uuid.UUID(int=rng.getrandbits(128)))
+    return {
+        'my_application_get_brief_webpage_structure': lambda: {'webpage_name': f"page-{rng.randrange(webpage_count)}"},
+        'my_application_get_element_component_source': lambda: {'component': rng.choice(COMPONENTS)},
+        'my_application_list_all_webpages': lambda: {},
+        'my_application_get_detail_element_structure': lambda: {'element_uuid': some_uuid},
+        'my_application_list_my_media_assets': lambda: {'media_type': 'image'},
+        'my_application_retrieve_product': lambda: {'product_uuid': some_uuid},
+        'my_application_update_element': lambda: {'element_uuid': some_uuid, 'element_name': 'bench'},
+        'my_application_create_element': lambda: {
+            'element_name': 'bench',
+            'element_tag_name': 'div',
+            'element_inner_html': '<p>bench</p>',
+            'element_props': {},
+            'target_webpage_uuid': some_uuid,
+            'target_webpage_position': 'body',
+        },
+        'my_application_update_product': lambda: {'product_uuid': some_uuid, 'price': round(rng.uniform(1, 1000), 2)},
+    }[tool]()
+
+
+def _parse_mix(text: Optional[str]) -> dict:
+    if not text:
+        return DEFAULT_MIX
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return float('nan')
+    index = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class ProcessSampler:
+    """定期讀 /proc 取得 server 的 RSS 與 FD 數（僅 Linux）"""
+
+    def __init__(self, pid: Optional[int], interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.samples: list[tuple[float, int]] = []
+
+    def cpu_seconds(self) -> Optional[float]:
+        """server 累計的 user + system CPU 秒數"""
+        if self.pid is None:
+            return None
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            return None
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def sample(self) -> Optional[tuple[float, int]]:
+        if self.pid is None:
+            return None
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                rss_kb = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+            fds = len(os.listdir(f"/proc/{self.pid}/fd"))
+        except (OSError, StopIteration):
+            return None
+        return rss_kb / 1024, fds
+
+    async def run(self) -> None:
+        while True:
+            sample = self.sample()
+            if sample is not None:
+                self.samples.append(sample)
+            await asyncio.sleep(self.interval)
+
+    def summary(self) -> dict:
+        if not self.samples:
+            return {}
+        return {
+            'rss_mb_start': round(self.samples[0][0], 1),
+            'rss_mb_max': round(max(s[0] for s in self.samples), 1),
+            'rss_mb_end': round(self.samples[-1][0], 1),
+            'fds_max': max(s[1] for s in self.samples),
+            'fds_end': self.samples[-1][1],
+        }
+
+
+async def _wait_for_server(url: str, process: Optional[subprocess.Popen], timeout: float = 30) -> None:
+    base = url.rsplit('/mcp', 1)[0]
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process is not None and process.poll() is not None:
+                raise RuntimeError(f"server.py 已結束，exit code {process.returncode}")
+            try:
+                async with session.get(f"{base}/healthz/live") as resp:
+                    if resp.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"等待 {url} 啟動逾時")
+
+
+async def run_load(args: argparse.Namespace) -> dict:
+    mix = _parse_mix(args.mix)
+    tools, weights = list(mix), list(mix.values())
+    stubs = []
+    server = None
+    tmpdir = tempfile.TemporaryDirectory(prefix='tnt-mcp-bench-')
+
+    try:
+        if args.tokens_file:
+            with open(args.tokens_file) as f:
+                keys = list(json.load(f))
+        else:
+            stub_config = StubConfig.from_args(args)
+            for index in range(args.stub_instances):
+                config = copy.copy(stub_config)
+                if index < args.slow_instances:
+                    config.latency_ms += args.slow_latency_ms
+                stubs.append(await start_stub_backend(config))
+            stub_port = stubs[0][2]
+            tokens = {
+                f"bench-key-{i}": {
+                    'client_id': f"bench-{i}",
+                    'scopes': ['website:write', 'content:write'],
+                    'user_access_token': f"bench-backend-token-{i}",
+                    'domain': f"127.0.0.1:{stub_port}",
+                    'protocol': 'http',
+                    'store_uuid': str(uuid.UUID(int=i)),
+                }
+                for i in range(args.tenants)
+            }
+            tokens_file = os.path.join(tmpdir.name, 'tokens.json')
+            with open(tokens_file, 'w') as f:
+                json.dump(tokens, f)
+            keys = list(tokens)
+
+        if args.server_url:
+            url = args.server_url
+        else:
+            url = 'http://127.0.0.1:8080/mcp'
+            env = {k: v for k, v in os.environ.items() if k != 'DEV'}
+            env['TOKENS_FILE'] = tokens_file
+            if len(stubs) > 1:
+                # 多個 stub 模擬同一個 service 背後的多個 pod，交給 server 的用戶端負載平衡
+                env['UPSTREAM_ENDPOINTS'] = json.dumps({f"127.0.0.1:{stub_port}": [f"127.0.0.1:{port}" for _, _, port in stubs]})
+            server = subprocess.Popen(
+                [sys.executable, SERVER_PATH],
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=open(os.path.join(tmpdir.name, 'server.log'), 'w'),
+            )
+        await _wait_for_server(url, server)
+
+        sampler = ProcessSampler(server.pid if server else args.server_pid)
+        sampler_task = asyncio.create_task(sampler.run())
+        latencies: dict[str, list[float]] = defaultdict(list)
+        errors: dict[str, int] = defaultdict(int)
+        measuring = False
+        stop_at = time.monotonic() + args.warmup + args.duration
+
+        async def worker(index: int) -> None:
+            rng = random.Random(args.seed * 1000 + index)
+            my_keys = keys[index::args.concurrency] or [keys[index % len(keys)]]
+            clients = {}
+            try:
+                for key in my_keys:
+                    client = Client(StreamableHttpTransport(url, auth=key), timeout=args.timeout)
+                    await client.__aenter__()
+                    clients[key] = client
+                while time.monotonic() < stop_at:
+                    client = clients[rng.choice(my_keys)]
+                    tool = rng.choices(tools, weights)[0]
+                    started = time.perf_counter()
+                    try:
+                        result = await client.call_tool(tool, _tool_args(tool, rng, args.webpage_count), raise_on_error=False)
+                        failed = result.is_error
+                    except Exception:
+                        failed = True
+                    elapsed = time.perf_counter() - started
+                    if measuring:
+                        latencies[tool].append(elapsed)
+                        if failed:
+                            errors[tool] += 1
+            finally:
+                for client in clients.values():
+                    await client.__aexit__(None, None, None)
+
+        workers = [asyncio.create_task(worker(i)) for i in range(args.concurrency)]
+        await asyncio.sleep(args.warmup)
+        measuring = True
+        measure_started = time.monotonic()
+        cpu_started = sampler.cpu_seconds()
+        await asyncio.gather(*workers)
+        measured = time.monotonic() - measure_started
+        cpu_used = sampler.cpu_seconds() - cpu_started if cpu_started is not None else None
+        sampler_task.cancel()
+
+        report = {'duration_s': round(measured, 2), 'concurrency': args.concurrency, 'tenants': len(keys), 'tools': {}}
+        total = 0
+        all_latencies = []
+        for tool in tools:
+            values = sorted(latencies.get(tool, []))
+            total += len(values)
+            all_latencies += values
+            report['tools'][tool] = {
+                'calls': len(values),
+                'errors': errors.get(tool, 0),
+                'p50_ms': round(_percentile(values, 0.50) * 1000, 2),
+                'p95_ms': round(_percentile(values, 0.95) * 1000, 2),
+                'p99_ms': round(_percentile(values, 0.99) * 1000, 2),
+            }
+        all_latencies.sort()
+        report['total'] = {
+            'calls': total,
+            'errors': sum(errors.values()),
+            'throughput_per_s': round(total / measured, 1) if measured else 0,
+            'p50_ms': round(_percentile(all_latencies, 0.50) * 1000, 2),
+            'p95_ms': round(_percentile(all_latencies, 0.95) * 1000, 2),
+            'p99_ms': round(_percentile(all_latencies, 0.99) * 1000, 2),
+        }
+        report['process'] = sampler.summary()
+        if cpu_used is not None and total:
+            report['process']['cpu_s'] = round(cpu_used, 2)
+            report['process']['cpu_ms_per_call'] = round(cpu_used * 1000 / total, 3)
+        if stubs:
+            report['stub_backend_requests'] = [backend.requests for backend, _, _ in stubs]
+        return report
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        for _, runner, _ in stubs:
+            await runner.cleanup()
+        tmpdir.cleanup()
+
+
+def print_report(report: dict) -> None:
+    print(f"{'tool':<48}{'calls':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for tool, stats in report['tools'].items():
+        print(f"{tool:<48}{stats['calls']:>8}{stats['errors']:>8}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+    total = report['total']
+    print(f"{'TOTAL':<48}{total['calls']:>8}{total['errors']:>8}{total['p50_ms']:>10}{total['p95_ms']:>10}{total['p99_ms']:>10}")
+    print(f"throughput: {total['throughput_per_s']} calls/s over {report['duration_s']}s, "
+          f"concurrency {report['concurrency']}, tenants {report['tenants']}")
+    if report.get('process'):
+        print('server process: ' + ', '.join(f"{k}={v}" for k, v in report['process'].items()))
+    if 'stub_backend_requests' in report:
+        print(f"stub backend requests: {report['stub_backend_requests']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tenants', type=int, default=20, help='產生的租戶 token 數')
+    parser.add_argument('--concurrency', type=int, default=16, help='同時呼叫的 client 數')
+    parser.add_argument('--duration', type=float, default=20, help='量測秒數')
+    parser.add_argument('--warmup', type=float, default=3, help='暖機秒數（不列入結果）')
+    parser.add_argument('--timeout', type=float, default=60, help='單次 tool 呼叫逾時秒數')
+    parser.add_argument('--mix', help='tool 權重，例如 "my_application_list_all_webpages=3,my_application_retrieve_product=1"')
+    parser.add_argument('--server-url', help='壓測已在執行的 server，不自動啟動 server.py')
+    parser.add_argument('--server-pid', type=int, help='搭配 --server-url，用來取樣 RSS / FD')
+    parser.add_argument('--tokens-file', help='搭配 --server-url，使用既有的 tokens.json（不啟動 stub）')
+    parser.add_argument('--stub-instances', type=int, default=1, help='stub 後端數量；大於 1 時透過 UPSTREAM_ENDPOINTS 讓 server 做用戶端負載平衡')
+    parser.add_argument('--slow-instances', type=int, default=0, help='其中幾個 stub 額外變慢')
+    parser.add_argument('--slow-latency-ms', type=float, default=200, help='慢 stub 額外增加的延遲')
+    parser.add_argument('--json', help='另外把結果寫成 JSON 檔，方便比對回歸')
+    StubConfig.add_arguments(parser)
+    args = parser.parse_args()
+    if args.tokens_file and not args.server_url:
+        parser.error('--tokens-file 需搭配 --server-url')
+
+    report = asyncio.run(run_load(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
@@ -0,0 +1,220 @@
+"""
+模擬 Django 後端與 source-viewer 的本機 stand-in，給壓測 / benchmark 使用，不需要網路
+
+單獨啟動：
+    uv run python bench/stub_backend.py --port 18080 --latency-ms 20 --error-rate 0.01
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import uuid
+
+from aiohttp import web
+
+
+class StubConfig:
+    def __init__(
+        self,
+        latency_ms: float = 0,
+        jitter_ms: float = 0,
+        error_rate: float = 0,
+        structure_nodes: int = 200,
+        structure_depth: int = 5,
+        media_count: int = 200,
+        source_kb: int = 8,
+        webpage_count: int = 20,
+        compress: bool = False,
+        seed: int = 0,
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.structure_nodes = structure_nodes
+        self.structure_depth = structure_depth
+        self.media_count = media_count
+        self.source_kb = source_kb
+        self.webpage_count = webpage_count
+        self.compress = compress
+        self.seed = seed
+
+    @classmethod
+    def add_arguments(cls, parser: argparse.ArgumentParser) -> None:
+        parser.add_argument('--latency-ms', type=float, default=0, help='每個請求的基本延遲')
+        parser.add_argument('--jitter-ms', type=float, default=0, help='延遲的隨機浮動範圍')
+        parser.add_argument('--error-rate', type=float, default=0, help='回 503 的機率')
+        parser.add_argument('--structure-nodes', type=int, default=200, help='網頁 / 元素結構的節點數')
+        parser.add_argument('--structure-depth', type=int, default=5, help='結構樹的最大深度')
+        parser.add_argument('--media-count', type=int, default=200, help='素材列表的筆數')
+        parser.add_argument('--source-kb', type=int, default=8, help='組件原始碼大小（KB）')
+        parser.add_argument('--webpage-count', type=int, default=20, help='網頁數量')
+        parser.add_argument('--compress', action='store_true', help='依 Accept-Encoding 壓縮回應')
+        parser.add_argument('--seed', type=int, default=0)
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> 'StubConfig':
+        return cls(
+            latency_ms=args.latency_ms,
+            jitter_ms=args.jitter_ms,
+            error_rate=args.error_rate,
+            structure_nodes=args.structure_nodes,
+            structure_depth=args.structure_depth,
+            media_count=args.media_count,
+            source_kb=args.source_kb,
+            webpage_count=args.webpage_count,
+            compress=args.compress,
+            seed=args.seed,
+        )
+
+
+def _build_tree(rng: random.Random, nodes: int, max_depth: int, detail: bool) -> dict:
+    """產生類似 agent/retrieve 的元素樹"""
+    element_types = [None, 'ck_editor', 'custom_slider', 'cart_button', 'shop', 'blog_grid']
+
+    def node(depth: int) -> dict:
+        data = {
+            'uuid': str(uuid.UUID(int=rng.getrandbits(128))),
+            'relation_uuid': str(uuid.UUID(int=rng.getrandbits(128))),
+            'name': f"element-{rng.randrange(10 ** 6)}",
+            'tag_name': rng.choice(['div', 'section', 'p', 'button', 'img']),
+            'type': rng.choice(element_types),
+            'children': [],
+        }
+        if detail:
+            data['props'] = {'class': 'container mx-auto', 'style': 'padding: 8px'}
+            data['inner_html'] = '<p>' + 'lorem ipsum ' * rng.randrange(1, 20) + '</p>'
+        return data
+
+    root = node(0)
+    frontier = [(root, 0)]
+    for _ in range(nodes - 1):
+        parent, depth = rng.choice(frontier)
+        child = node(depth + 1)
+        parent['children'].append(child)
+        if depth + 1 < max_depth:
+            frontier.append((child, depth + 1))
+    return root
+
+
+class StubBackend:
+    def __init__(self, config: StubConfig):
+        self.config = config
+        self.requests = 0
+        rng = random.Random(config.seed)
+        self._rng = random.Random(config.seed + 1)
+        # 預先序列化，讓 stub 本身不成為瓶頸
+        self._webpages = json.dumps([
+            {'uuid': str(uuid.UUID(int=rng.getrandbits(128))), 'name': f"page-{i}"}
+            for i in range(config.webpage_count)
+        ]).encode()
+        self._brief = json.dumps(_build_tree(rng, config.structure_nodes, config.structure_depth, detail=False)).encode()
+        self._detail = json.dumps(_build_tree(rng, config.structure_nodes, config.structure_depth, detail=True)).encode()
+        self._media = json.dumps([
+            {
+                'id': i,
+                'url': f"https://cdn.example.com/media/{i}.png",
+                'name': f"image-{i}.png",
+                'size': rng.randrange(10_000, 5_000_000),
+                'width': 1200,
+                'height': 800,
+                'tags': [rng.choice(['banner', 'product', 'blog'])],
+                'created_at': f"2025-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}T00:00:00Z",
+            }
+            for i in range(config.media_count)
+        ]).encode()
+        self._source = ('<template>' + 'x' * (config.source_kb * 1024) + '</template>').encode()
+        self._source_etag = '"' + hashlib.sha256(self._source).hexdigest()[:16] + '"'
+        self._record = json.dumps({
+            'uuid': str(uuid.UUID(int=rng.getrandbits(128))),
+            'name': 'Sample',
+            'price': 100,
+            'stock': 10,
+            'tags': ['sale'],
+            'content': '<p>' + 'content ' * 200 + '</p>',
+        }).encode()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        config = self.config
+        delay = config.latency_ms + self._rng.uniform(0, config.jitter_ms)
+        if delay:
+            await asyncio.sleep(delay / 1000)
+        if config.error_rate and self._rng.random() < config.error_rate:
+            await request.read()
+            return web.json_response({'detail': 'stub error'}, status=503)
+
+        path = request.path
+        if request.method == 'POST' and path.endswith('/store_file/create/'):
+            return await self._upload(request)
+        await request.read()
+        if path.startswith('/website_backend/source-viewer/'):
+            if request.headers.get('If-None-Match') == self._source_etag:
+                return web.Response(status=304, headers={'ETag': self._source_etag})
+            return self._compressed(web.Response(body=self._source, content_type='text/html', headers={'ETag': self._source_etag}))
+        if request.method == 'GET':
+            if path.endswith('/webpage/list/'):
+                return self._json(self._webpages)
+            if path.endswith('/agent/retrieve/'):
+                return self._json(self._detail if request.query.get('detail') == 'true' else self._brief)
+            if '/store_file/list/' in path:
+                return self._json(self._media)
+            if path.endswith('/retrieve/'):
+                return self._json(self._record)
+        if path.endswith('/r_create/') or path.endswith('/webpage/create/'):
+            return web.json_response({
+                'uuid': str(uuid.UUID(int=self._rng.getrandbits(128))),
+                'relation_uuid': str(uuid.UUID(int=self._rng.getrandbits(128))),
+            }, status=201)
+        return web.json_response({'detail': 'ok'})
+
+    async def _upload(self, request: web.Request) -> web.Response:
+        # 逐段讀取後丟棄，上傳大檔時 stub 本身不佔記憶體
+        fields, size = {}, 0
+        async for part in await request.multipart():
+            if part.filename is None:
+                fields[part.name] = await part.text()
+                continue
+            while chunk := await part.read_chunk():
+                size += len(chunk)
+        return web.json_response({
+            'id': self._rng.randrange(10 ** 6),
+            'name': fields.get('name'),
+            'media_type': fields.get('media_type'),
+            'size': size,
+        }, status=201)
+
+    def _json(self, body: bytes) -> web.Response:
+        return self._compressed(web.Response(body=body, content_type='application/json'))
+
+    def _compressed(self, response: web.Response) -> web.Response:
+        if self.config.compress:
+            response.enable_compression()
+        return response
+
+
+async def start_stub_backend(config: StubConfig, host: str = '127.0.0.1', port: int = 0) -> tuple[StubBackend, web.AppRunner, int]:
+    """在目前的 event loop 啟動 stub，回傳 (backend, runner, 實際 port)"""
+    backend = StubBackend(config)
+    runner = web.AppRunner(backend.app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    actual_port = site._server.sockets[0].getsockname()[1]
+    return backend, runner, actual_port
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18080)
+    StubConfig.add_arguments(parser)
+    args = parser.parse_args()
+    backend = StubBackend(StubConfig.from_args(args))
+    web.run_app(backend.app(), host=args.host, port=args.port, access_log=None)
@@ -5,13 +5,26 @@ cd to the `examples/snippets/clients` directory and run:
     uv run server fastmcp_quickstart stdio
 """
 
-from fastmcp import FastMCP
-from fastmcp.server.auth import StaticTokenVerifier
+import time
+
+_PROCESS_STARTED = time.perf_counter()  # 啟動耗時報告的起點，必須在其他 import 之前
+
+from fastmcp import Context, FastMCP
+import fastmcp
+from fastmcp.server.auth import AccessToken, StaticTokenVerifier, TokenVerifier
 import aiohttp
+import brotli
+import ijson
 import json
-from typing import Annotated, Literal, Optional
+import orjson
+from typing import Annotated, Literal, Optional, get_args
+from collections import OrderedDict, deque
 from datetime import datetime
-from pydantic import Field
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, create_model
+from starlette.datastructures import Headers
+from starlette.middleware import Middleware as StarletteMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
 
 # 集中管理 element type 選項，create / update / get_source 共用同一份
 ElementType = Optional[Literal[
@@ -43,29 +56,1819 @@ ElementType = Optional[Literal[
     'dynamic_route_element',
 ]]
 
-from dotenv import load_dotenv
-from fastmcp.server.dependencies import get_access_token
-import os
-import ssl
+from dotenv import load_dotenv
+from fastmcp.exceptions import ToolError
+from fastmcp.server.dependencies import get_access_token, get_http_request
+from fastmcp.server.lifespan import lifespan
+from fastmcp.server.middleware import Middleware, MiddlewareContext
+from fastmcp.utilities.json_schema import dereference_refs
+from mcp import types as mcp_types
+from mcp.shared.version import SUPPORTED_PROTOCOL_VERSIONS
+from mcp.types import DEFAULT_NEGOTIATED_VERSION
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+import asyncio
+import base64
+import contextlib
+import contextvars
+import functools
+import hashlib
+import hmac
+import inspect
+import io
+import logging
+import math
+import mimetypes
+import mmap
+import os
+import random
+import re
+import socket
+import sqlite3
+import ssl
+import yarl
+import zlib
+from multidict import CIMultiDict, CIMultiDictProxy
+
+try:
+    from compression.zstd import ZstdCompressor
+except ImportError:  # Python < 3.14
+    from backports.zstd import ZstdCompressor
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 冷啟動各階段距 process 啟動的秒數，/healthz/ready 與 log 會輸出，用來追蹤啟動時間的回歸
+_startup_timings: dict[str, float] = {}
+
+
+def _mark_startup(phase: str) -> None:
+    _startup_timings[phase] = round(time.perf_counter() - _PROCESS_STARTED, 3)
+
+
+_mark_startup('imports')
+
+dev = os.environ.get('DEV') == 'true'
+
+
+# Prometheus 指標：tool / 租戶（client_id）/ 上游各階段延遲，於 /metrics 輸出
+_SIZE_BUCKETS = tuple(2 ** i for i in range(8, 26, 2))  # 256B ~ 16MB
+
+TOOL_DURATION = Histogram('mcp_tool_duration_seconds', 'MCP tool 呼叫耗時', ['tool', 'client_id', 'outcome'])
+TOOL_IN_FLIGHT = Gauge('mcp_tool_in_flight', '執行中的 tool 呼叫', ['tool'])
+TOOL_RESULT_BYTES = Histogram('mcp_tool_result_bytes', 'tool 回傳內容大小', ['tool', 'client_id'], buckets=_SIZE_BUCKETS)
+AUTH_DURATION = Histogram('mcp_auth_verify_seconds', 'token 驗證耗時', ['outcome'])
+HTTP_DURATION = Histogram('mcp_http_request_duration_seconds', 'MCP HTTP 請求整體耗時（含驗證與 MCP 處理）', ['method', 'status'])
+STARTUP_PHASE = Gauge('mcp_startup_phase_seconds', '冷啟動各階段距 process 啟動的秒數', ['phase'])
+HTTP_RESPONSE_BYTES = Counter('mcp_http_response_bytes_total', 'MCP HTTP 回應 body 位元組數：raw 為壓縮前，sent 為實際送出', ['encoding', 'kind'])
+UPSTREAM_PHASE = Histogram('mcp_upstream_phase_seconds', '上游請求各階段耗時：dns / connect（含 TLS）/ ttfb', ['phase', 'upstream', 'tool', 'client_id'])
+UPSTREAM_RESPONSES = Counter('mcp_upstream_responses_total', '上游回應數（依狀態碼）', ['upstream', 'status', 'tool', 'client_id'])
+UPSTREAM_ERRORS = Counter('mcp_upstream_errors_total', '上游請求例外', ['upstream', 'error', 'tool', 'client_id'])
+UPSTREAM_RESPONSE_BYTES = Counter('mcp_upstream_response_bytes_total', '上游回應 body 位元組數', ['upstream', 'tool', 'client_id'])
+UPSTREAM_CONNECTIONS = Counter('mcp_upstream_connections_total', '上游連線取得方式：new / reused', ['upstream', 'kind'])
+UPSTREAM_IN_FLIGHT = Gauge('mcp_upstream_in_flight', '進行中的上游請求', ['upstream'])
+
+# 租戶 client_id 只有 METRICS_TENANT_LABELS=true 時才當作指標 label，預設記為 '-'，避免 /metrics 列出所有租戶
+METRICS_TENANT_LABELS = os.environ.get('METRICS_TENANT_LABELS') == 'true'
+
+
+def _tenant_label(client_id: str) -> str:
+    return client_id if METRICS_TENANT_LABELS else '-'
+
+
+# 目前的 (tool, client_id)，讓 aiohttp trace hook 能標上是哪個 tool / 租戶發出的請求
+_metric_labels: contextvars.ContextVar[tuple[str, str]] = contextvars.ContextVar('metric_labels', default=('-', '-'))
+
+
+def _upstream_label(url: yarl.URL) -> str:
+    return f"{url.host}:{url.port}"
+
+
+def _metrics_trace_config() -> aiohttp.TraceConfig:
+    trace = aiohttp.TraceConfig()
+
+    async def on_request_start(session, ctx, params):
+        ctx.labels = _metric_labels.get()
+        ctx.upstream = _upstream_label(params.url)
+        ctx.started = time.perf_counter()
+        UPSTREAM_IN_FLIGHT.labels(ctx.upstream).inc()
+
+    async def on_dns_resolvehost_start(session, ctx, params):
+        ctx.dns_started = time.perf_counter()
+
+    async def on_dns_resolvehost_end(session, ctx, params):
+        UPSTREAM_PHASE.labels('dns', ctx.upstream, *ctx.labels).observe(time.perf_counter() - ctx.dns_started)
+
+    async def on_connection_create_start(session, ctx, params):
+        ctx.connect_started = time.perf_counter()
+
+    async def on_connection_create_end(session, ctx, params):
+        UPSTREAM_PHASE.labels('connect', ctx.upstream, *ctx.labels).observe(time.perf_counter() - ctx.connect_started)
+        UPSTREAM_CONNECTIONS.labels(ctx.upstream, 'new').inc()
+
+    async def on_connection_reuseconn(session, ctx, params):
+        UPSTREAM_CONNECTIONS.labels(ctx.upstream, 'reused').inc()
+
+    async def on_request_end(session, ctx, params):
+        UPSTREAM_IN_FLIGHT.labels(ctx.upstream).dec()
+        UPSTREAM_PHASE.labels('ttfb', ctx.upstream, *ctx.labels).observe(time.perf_counter() - ctx.started)
+        UPSTREAM_RESPONSES.labels(ctx.upstream, str(params.response.status), *ctx.labels).inc()
+
+    async def on_request_exception(session, ctx, params):
+        UPSTREAM_IN_FLIGHT.labels(ctx.upstream).dec()
+        UPSTREAM_ERRORS.labels(ctx.upstream, type(params.exception).__name__, *ctx.labels).inc()
+
+    async def on_response_chunk_received(session, ctx, params):
+        UPSTREAM_RESPONSE_BYTES.labels(ctx.upstream, *ctx.labels).inc(len(params.chunk))
+
+    trace.on_request_start.append(on_request_start)
+    trace.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+    trace.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+    trace.on_connection_create_start.append(on_connection_create_start)
+    trace.on_connection_create_end.append(on_connection_create_end)
+    trace.on_connection_reuseconn.append(on_connection_reuseconn)
+    trace.on_request_end.append(on_request_end)
+    trace.on_request_exception.append(on_request_exception)
+    trace.on_response_chunk_received.append(on_response_chunk_received)
+    return trace
+
+
+class _MetricsMiddleware(Middleware):
+    """記錄每個 tool 呼叫的耗時、回傳大小與進行中數量"""
+
+    async def on_call_tool(self, context: MiddlewareContext, call_next):
+        tool = context.message.name
+        token = get_access_token()
+        client_id = _tenant_label(token.client_id) if token is not None else '-'
+        labels = _metric_labels.set((tool, client_id))
+        in_flight = TOOL_IN_FLIGHT.labels(tool)
+        in_flight.inc()
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            result = await call_next(context)
+            outcome = 'ok'
+            TOOL_RESULT_BYTES.labels(tool, client_id).observe(
+                sum(len(getattr(item, 'text', '') or '') for item in result.content)
+            )
+            return result
+        finally:
+            TOOL_DURATION.labels(tool, client_id, outcome).observe(time.perf_counter() - started)
+            in_flight.dec()
+            _metric_labels.reset(labels)
+
+
+_UNMEASURED_PATHS = ('/metrics', '/healthz/live', '/healthz/ready')
+
+
+class _HttpMetricsMiddleware:
+    """ASGI middleware，量測 MCP HTTP 請求整體耗時（/metrics 與健康檢查不算）"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] in _UNMEASURED_PATHS:
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_DURATION.labels(scope['method'], str(status)).observe(time.perf_counter() - started)
+
+
+# MCP 回應壓縮：client 跨 WAN 連線，大回應壓縮後再送
+# MCP_COMPRESSION：off 停用 / speed 低 CPU / size 較高壓縮率
+MCP_COMPRESSION = os.environ.get('MCP_COMPRESSION', 'speed')
+MCP_COMPRESSION_MIN_BYTES = int(os.environ.get('MCP_COMPRESSION_MIN_BYTES', '1024'))
+
+_COMPRESSION_LEVELS = {
+    'speed': {'zstd': 1, 'br': 1, 'gzip': 1},
+    'size': {'zstd': 9, 'br': 6, 'gzip': 6},
+}
+_COMPRESSIBLE_TYPES = ('application/json', 'text/')
+
+
+def _negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """依 Accept-Encoding（含 q 值）選出支援的編碼，同分時偏好 zstd > br > gzip"""
+    accepted = {}
+    for part in accept_encoding.lower().split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        if params.strip().startswith('q='):
+            with contextlib.suppress(ValueError):
+                q = float(params.strip()[2:])
+        accepted[name.strip()] = q
+    candidates = [e for e in ('zstd', 'br', 'gzip') if accepted.get(e, accepted.get('*', 0)) > 0]
+    return max(candidates, key=lambda e: accepted.get(e, accepted.get('*', 0)), default=None)
+
+
+class _StreamCompressor:
+    """逐塊壓縮並 flush，SSE 事件不會卡在壓縮緩衝區裡"""
+
+    def __init__(self, encoding: str, level: int):
+        self.encoding = encoding
+        if encoding == 'zstd':
+            self._compressor = ZstdCompressor(level=level)
+        elif encoding == 'br':
+            self._compressor = brotli.Compressor(quality=level)
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        c = self._compressor
+        if self.encoding == 'zstd':
+            return c.compress(data, ZstdCompressor.FLUSH_FRAME if final else ZstdCompressor.FLUSH_BLOCK)
+        if self.encoding == 'br':
+            return c.process(data) + (c.finish() if final else c.flush())
+        return c.compress(data) + c.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class _CompressionMiddleware:
+    """
+    ASGI middleware，依 Accept-Encoding 壓縮 MCP 回應
+    一次送完的回應小於 MCP_COMPRESSION_MIN_BYTES 時不壓縮；串流回應（SSE）長度未知，一律逐塊壓縮
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or MCP_COMPRESSION not in _COMPRESSION_LEVELS:
+            return await self.app(scope, receive, send)
+        request_headers = dict(scope['headers'])
+        encoding = _negotiate_encoding(request_headers.get(b'accept-encoding', b'').decode('latin-1'))
+        if encoding is None or scope['method'] == 'HEAD':
+            return await self.app(scope, receive, send)
+
+        start = None
+        compressor: Optional[_StreamCompressor] = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, compressor, passthrough
+            if message['type'] == 'http.response.start':
+                start = message
+                return
+            if message['type'] != 'http.response.body' or passthrough:
+                return await send(message)
+            body, more_body = message.get('body', b''), message.get('more_body', False)
+
+            if compressor is None:
+                headers = CIMultiDict((k.decode('latin-1'), v.decode('latin-1')) for k, v in start['headers'])
+                content_type = headers.get('content-type', '')
+                length = int(headers['content-length']) if 'content-length' in headers else (None if more_body else len(body))
+                if ('content-encoding' in headers or start['status'] in (204, 304)
+                        or not content_type.startswith(_COMPRESSIBLE_TYPES)
+                        or (length is not None and length < MCP_COMPRESSION_MIN_BYTES)):
+                    passthrough = True
+                    await send(start)
+                    return await send(message)
+                compressor = _StreamCompressor(encoding, _COMPRESSION_LEVELS[MCP_COMPRESSION][encoding])
+                headers.popall('content-length', None)
+                headers['Content-Encoding'] = encoding
+                headers.add('Vary', 'Accept-Encoding')
+                data = compressor.compress(body, final=not more_body)
+                if not more_body:
+                    headers['Content-Length'] = str(len(data))
+                start['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers.items()]
+                await send(start)
+            else:
+                data = compressor.compress(body, final=not more_body)
+            HTTP_RESPONSE_BYTES.labels(encoding, 'raw').inc(len(body))
+            HTTP_RESPONSE_BYTES.labels(encoding, 'sent').inc(len(data))
+            await send({'type': 'http.response.body', 'body': data, 'more_body': more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+
+# 多用戶 API key 設定：tokens.json，或由它建立的 SQLite 索引（副檔名 .db / .sqlite）
+TOKENS_FILE = os.environ.get("TOKENS_FILE", "tokens.json")
+TOKENS_RELOAD_INTERVAL = float(os.environ.get('TOKENS_RELOAD_INTERVAL', '5'))  # 檢查檔案是否變更的間隔（秒）
+TOKENS_HOT_CACHE_SIZE = int(os.environ.get('TOKENS_HOT_CACHE_SIZE', '4096'))
+
+
+def _hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _file_version(path: str) -> tuple:
+    """檔案被替換或修改時會改變；SQLite 的 WAL 檔也算在內"""
+    version = []
+    for p in (path, f"{path}-wal"):
+        with contextlib.suppress(FileNotFoundError):
+            st = os.stat(p)
+            version.append((st.st_ino, st.st_mtime_ns, st.st_size))
+    if not version:
+        raise FileNotFoundError(path)
+    return tuple(version)
+
+
+class _JsonTokenIndex:
+    """tokens.json 讀進記憶體後以 key hash 建索引，不保留原始 key"""
+
+    def __init__(self, path: str):
+        with open(path) as f:
+            tokens = json.load(f)
+        self._claims = {_hash_token(token): claims for token, claims in tokens.items()}
+
+    def lookup(self, key_hash: str) -> Optional[dict]:
+        return self._claims.get(key_hash)
+
+    def upstream_claims(self, limit: int) -> list[dict]:
+        claims_by_upstream = {}
+        for claims in self._claims.values():
+            claims_by_upstream.setdefault(_upstream_key(claims), claims)
+            if len(claims_by_upstream) >= limit:
+                break
+        return list(claims_by_upstream.values())
+
+
+class _SqliteTokenIndex:
+    """SQLite 索引（tokens(key_hash PRIMARY KEY, claims)），常用的 key 放在 LRU"""
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self._hot: OrderedDict[str, Optional[dict]] = OrderedDict()
+
+    def lookup(self, key_hash: str) -> Optional[dict]:
+        if key_hash in self._hot:
+            self._hot.move_to_end(key_hash)
+            return self._hot[key_hash]
+        row = self._db.execute("SELECT claims FROM tokens WHERE key_hash = ?", (key_hash,)).fetchone()
+        claims = json.loads(row[0]) if row else None
+        self._hot[key_hash] = claims
+        if len(self._hot) > TOKENS_HOT_CACHE_SIZE:
+            self._hot.popitem(last=False)
+        return claims
+
+    def upstream_claims(self, limit: int) -> list[dict]:
+        # 分組條件同 _upstream_key，在 SQLite 內完成，不把所有租戶的 claims 讀進 Python
+        rows = self._db.execute(
+            """
+            SELECT claims FROM tokens
+            GROUP BY
+                COALESCE(json_extract(claims, '$.protocol'), 'https'),
+                COALESCE(json_extract(claims, '$.host'), ''),
+                CASE WHEN COALESCE(json_extract(claims, '$.host'), '') = ''
+                    THEN json_extract(claims, '$.domain')
+                    ELSE CAST(COALESCE(json_extract(claims, '$.port'), '') AS TEXT) END
+            LIMIT ?
+            """,
+            (limit,),
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    def close(self) -> None:
+        self._db.close()
+
+
+def _upstream_key(claims: dict) -> tuple:
+    """claims 連到的上游；有 host 時所有商店共用內部 service，沒有時每個 domain 各自一個"""
+    protocol = claims.get('protocol') or 'https'
+    if claims.get('host'):
+        return protocol, claims['host'], str(claims.get('port') or '')
+    return protocol, '', claims.get('domain')
+
+
+def _open_token_index(path: str):
+    if path.endswith(('.db', '.sqlite')):
+        return _SqliteTokenIndex(path)
+    return _JsonTokenIndex(path)
+
+
+def _build_token_db(tokens_file: str, db_file: str) -> None:
+    """把 tokens.json 轉成 SQLite 索引；先寫暫存檔再 rename，執行中的 server 會在下次檢查時切換過去"""
+    with open(tokens_file) as f:
+        tokens = json.load(f)
+    tmp = f"{db_file}.{os.getpid()}.tmp"
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(tmp)
+    db = sqlite3.connect(tmp)
+    with db:
+        db.execute("CREATE TABLE tokens (key_hash TEXT PRIMARY KEY, claims TEXT NOT NULL) WITHOUT ROWID")
+        db.executemany(
+            "INSERT INTO tokens (key_hash, claims) VALUES (?, ?)",
+            ((_hash_token(token), json.dumps(claims, ensure_ascii=False)) for token, claims in tokens.items()),
+        )
+    db.close()
+    os.replace(tmp, db_file)
+
+
+class IndexedTokenVerifier(TokenVerifier):
+    """
+    以 key hash 查詢的 token verifier，取代把所有 token 放進 StaticTokenVerifier
+    - 第一次驗證時才載入
+    - 每 TOKENS_RELOAD_INTERVAL 秒檢查檔案，有變更就在背景 thread 載入新索引後整個替換，
+      載入失敗則沿用舊索引，不需要重啟 pod
+    """
+
+    def __init__(self, path: str, reload_interval: float = TOKENS_RELOAD_INTERVAL):
+        super().__init__()
+        self.path = path
+        self.reload_interval = reload_interval
+        self._index = None
+        self._version = None
+        self._checked_at = float('-inf')
+        self._reload_lock = asyncio.Lock()
+
+    async def _current_index(self):
+        if time.monotonic() - self._checked_at < self.reload_interval and self._index is not None:
+            return self._index
+        if self._reload_lock.locked() and self._index is not None:
+            # 其他請求正在重新載入，先用舊的
+            return self._index
+        async with self._reload_lock:
+            if time.monotonic() - self._checked_at < self.reload_interval and self._index is not None:
+                return self._index
+            try:
+                version = await asyncio.to_thread(_file_version, self.path)
+                if version != self._version:
+                    index = await asyncio.to_thread(_open_token_index, self.path)
+                    old, self._index, self._version = self._index, index, version
+                    if isinstance(old, _SqliteTokenIndex):
+                        old.close()
+                    logger.info("loaded tokens from %s", self.path)
+            except (OSError, ValueError, sqlite3.Error) as e:
+                if self._index is None:
+                    raise
+                logger.warning("reload tokens from %s failed, keep previous: %r", self.path, e)
+            self._checked_at = time.monotonic()
+        return self._index
+
+    async def verify_token(self, token: str) -> Optional[AccessToken]:
+        started = time.perf_counter()
+        access_token = await self._verify_token(token)
+        AUTH_DURATION.labels('ok' if access_token else 'rejected').observe(time.perf_counter() - started)
+        return access_token
+
+    async def _verify_token(self, token: str) -> Optional[AccessToken]:
+        index = await self._current_index()
+        claims = index.lookup(_hash_token(token))
+        if not claims:
+            return None
+        expires_at = claims.get("expires_at")
+        if expires_at is not None and expires_at < time.time():
+            return None
+        return AccessToken(
+            token=token,
+            client_id=claims["client_id"],
+            scopes=claims.get("scopes", []),
+            expires_at=expires_at,
+            claims=claims,
+        )
+
+    async def upstream_claims(self, limit: int) -> list[dict]:
+        """每個不同上游取一個租戶的 claims，最多 limit 個"""
+        index = await self._current_index()
+        return await asyncio.to_thread(index.upstream_claims, limit)
+
+
+# dev 模式（stdio）不驗證 token
+auth = StaticTokenVerifier(tokens={}) if dev else IndexedTokenVerifier(TOKENS_FILE)
+
+
+# 共用的 aiohttp 連線池：整個 process 共用一個 session，避免每次 tool 呼叫都重新 TCP/TLS 握手
+HTTP_POOL_LIMIT = int(os.environ.get('HTTP_POOL_LIMIT', '100'))
+HTTP_POOL_LIMIT_PER_HOST = int(os.environ.get('HTTP_POOL_LIMIT_PER_HOST', '32'))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get('HTTP_KEEPALIVE_TIMEOUT', '30'))
+HTTP_DNS_CACHE_TTL = int(os.environ.get('HTTP_DNS_CACHE_TTL', '300'))
+# 單一上游請求的逾時：連線（含 TLS）、等待回應 / 兩段資料之間、整個請求；整個 tool 另有 TOOL_TIMEOUT
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', '5'))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', '30'))
+UPSTREAM_TOTAL_TIMEOUT = float(os.environ.get('UPSTREAM_TOTAL_TIMEOUT', '60'))
+# 未設定時由 aiohttp 依已安裝的解壓套件送出 gzip, deflate, br, zstd，並在讀取 body 時串流解壓
+UPSTREAM_ACCEPT_ENCODING = os.environ.get('UPSTREAM_ACCEPT_ENCODING')
+
+_http_session: Optional[aiohttp.ClientSession] = None
+
+
+def _create_http_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        use_dns_cache=True,
+    )
+    # 多租戶共用同一個 session，不能保留 cookie，否則會在租戶之間互相帶到
+    return aiohttp.ClientSession(
+        connector=connector,
+        cookie_jar=aiohttp.DummyCookieJar(),
+        timeout=aiohttp.ClientTimeout(
+            total=UPSTREAM_TOTAL_TIMEOUT,
+            sock_connect=UPSTREAM_CONNECT_TIMEOUT,
+            sock_read=UPSTREAM_READ_TIMEOUT,
+        ),
+        trace_configs=[_metrics_trace_config()],
+        json_serialize=_json_dumps,
+        headers={'Accept-Encoding': UPSTREAM_ACCEPT_ENCODING} if UPSTREAM_ACCEPT_ENCODING else None,
+    )
+
+
+def _get_http_session() -> aiohttp.ClientSession:
+    """取得共用 session；正常由 lifespan 建立，未經 lifespan 啟動時（例如直接呼叫 tool）才延遲建立"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = _create_http_session()
+    return _http_session
+
+
+@lifespan
+async def http_session_lifespan(server):
+    global _http_session
+    _http_session = _create_http_session()
+    try:
+        yield {'http_session': _http_session}
+    finally:
+        session, _http_session = _http_session, None
+        if session is not None and not session.closed:
+            await session.close()
+
+
+# 後端請求的韌性處理：冪等 GET 自動重試（含 jitter backoff）、選用的 hedged request，以及每個上游各自的 circuit breaker
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', '2'))
+UPSTREAM_RETRY_BACKOFF = float(os.environ.get('UPSTREAM_RETRY_BACKOFF', '0.1'))
+UPSTREAM_RETRY_BACKOFF_MAX = float(os.environ.get('UPSTREAM_RETRY_BACKOFF_MAX', '2'))
+UPSTREAM_HEDGE_DELAY = float(os.environ.get('UPSTREAM_HEDGE_DELAY', '0'))  # 秒，0 代表不送 hedged request
+UPSTREAM_BREAKER_THRESHOLD = int(os.environ.get('UPSTREAM_BREAKER_THRESHOLD', '5'))
+UPSTREAM_BREAKER_COOLDOWN = float(os.environ.get('UPSTREAM_BREAKER_COOLDOWN', '10'))
+
+_RETRY_STATUSES = {429, 502, 503, 504}
+_BREAKER_FAILURE_STATUSES = {502, 503, 504}
+
+
+class _CircuitBreaker:
+    """連續失敗達門檻後 open，冷卻期間直接失敗；冷卻後放一個探測請求（half-open）決定是否恢復"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < UPSTREAM_BREAKER_COOLDOWN:
+            return 'open'
+        return 'half_open'
+
+    def before_request(self) -> bool:
+        """回傳此請求是否為 half-open 的探測請求；不允許送出時丟出 ToolError"""
+        state = self.state
+        if state == 'closed':
+            return False
+        if state == 'half_open' and not self.probing:
+            self.probing = True
+            return True
+        raise ToolError(f"後端 {self.name} 暫時無法使用，請稍後再試")
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.probing = False
+        if self.opened_at is not None or self.failures >= UPSTREAM_BREAKER_THRESHOLD:
+            if self.opened_at is None:
+                logger.warning("circuit breaker for %s opened", self.name)
+            self.opened_at = time.monotonic()
+
+
+_circuit_breakers: dict[str, _CircuitBreaker] = {}
+
+
+def _circuit_breaker(url: str) -> _CircuitBreaker:
+    parsed = yarl.URL(url)
+    name = f"{parsed.scheme}://{parsed.host}:{parsed.port}"
+    breaker = _circuit_breakers.get(name)
+    if breaker is None:
+        breaker = _circuit_breakers[name] = _CircuitBreaker(name)
+    return breaker
+
+
+def _retry_delay(attempt: int) -> float:
+    return random.uniform(0, min(UPSTREAM_RETRY_BACKOFF_MAX, UPSTREAM_RETRY_BACKOFF * 2 ** attempt))
+
+
+# 用戶端負載平衡：指向 service 的請求直接分散到背後的各個 pod，不經 kube-proxy，避免單一慢 pod 拖累所有人
+# UPSTREAM_ENDPOINTS（JSON）：{"URL 中的 host 或 host:port": "要解析的 DNS 名稱（例如 headless service）" 或 ["host:port", ...] 固定清單}
+UPSTREAM_ENDPOINTS: dict = json.loads(os.environ.get('UPSTREAM_ENDPOINTS') or '{}')
+UPSTREAM_LB_POLICY = os.environ.get('UPSTREAM_LB_POLICY', 'ewma')  # ewma / least_outstanding
+UPSTREAM_LB_REFRESH_INTERVAL = float(os.environ.get('UPSTREAM_LB_REFRESH_INTERVAL', '10'))
+UPSTREAM_LB_EJECT_AFTER = int(os.environ.get('UPSTREAM_LB_EJECT_AFTER', '3'))  # 連續失敗幾次後暫時移出
+UPSTREAM_LB_EJECT_SECONDS = float(os.environ.get('UPSTREAM_LB_EJECT_SECONDS', '15'))
+UPSTREAM_LB_EWMA_DECAY = float(os.environ.get('UPSTREAM_LB_EWMA_DECAY', '10'))  # 秒，延遲平均的時間常數
+
+
+class _Endpoint:
+    def __init__(self, address: str):
+        self.address = address
+        self.outstanding = 0
+        self.ewma = 0.0
+        self.updated_at = time.monotonic()
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+
+    def score(self) -> float:
+        if UPSTREAM_LB_POLICY == 'least_outstanding':
+            return self.outstanding
+        # peak EWMA：延遲平均乘上進行中請求數，還沒有量測值的新 endpoint 會優先被試
+        return (self.outstanding + 1) * self.ewma
+
+    def observe(self, latency: float) -> None:
+        now = time.monotonic()
+        weight = math.exp(-(now - self.updated_at) / UPSTREAM_LB_EWMA_DECAY) if self.ewma else 0.0
+        self.ewma = self.ewma * weight + latency * (1 - weight)
+        self.updated_at = now
+
+    def record_success(self) -> None:
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= UPSTREAM_LB_EJECT_AFTER:
+            if self.ejected_until <= time.monotonic():
+                logger.warning("upstream endpoint %s ejected", self.address)
+            self.ejected_until = time.monotonic() + UPSTREAM_LB_EJECT_SECONDS
+
+
+class _UpstreamPool:
+    """一個 service 背後的所有 endpoint；DNS 名稱定期重新解析，已知 endpoint 的統計在更新成員時保留"""
+
+    def __init__(self, name: str, source, port: int):
+        self.name = name
+        self.source = source
+        self.port = port
+        self.endpoints: dict[str, _Endpoint] = {}
+        self._refreshed_at = float('-inf')
+        self._refreshing: Optional[asyncio.Task] = None
+
+    async def _resolve(self) -> list[str]:
+        if isinstance(self.source, list):
+            return list(self.source)
+        infos = await asyncio.get_running_loop().getaddrinfo(self.source, self.port, type=socket.SOCK_STREAM)
+        hosts = sorted({info[4][0] for info in infos})
+        return [f"[{host}]:{self.port}" if ':' in host else f"{host}:{self.port}" for host in hosts]
+
+    async def refresh(self) -> None:
+        try:
+            addresses = await self._resolve()
+        except OSError as e:
+            logger.warning("resolve upstream %s failed, keep previous endpoints: %r", self.name, e)
+            addresses = []
+        self._refreshed_at = time.monotonic()
+        if addresses:
+            self.endpoints = {a: self.endpoints.get(a) or _Endpoint(a) for a in addresses}
+
+    async def pick(self) -> Optional[_Endpoint]:
+        stale = time.monotonic() - self._refreshed_at >= UPSTREAM_LB_REFRESH_INTERVAL
+        if stale and (self._refreshing is None or self._refreshing.done()):
+            self._refreshing = asyncio.create_task(self.refresh())
+        if not self.endpoints:
+            await asyncio.shield(self._refreshing)
+        if not self.endpoints:
+            return None
+        now = time.monotonic()
+        # 全部都被移出時照常使用，避免 passive health check 誤判造成完全無法服務
+        healthy = [e for e in self.endpoints.values() if e.ejected_until <= now] or list(self.endpoints.values())
+        # power of two choices：隨機取兩個比分數，避免所有請求同時擠向同一個「最好」的 endpoint
+        candidates = random.sample(healthy, 2) if len(healthy) > 2 else healthy
+        return min(candidates, key=lambda e: e.score())
+
+
+_upstream_pools: dict[str, _UpstreamPool] = {}
+
+
+def _upstream_pool(url: yarl.URL) -> Optional[_UpstreamPool]:
+    key = f"{url.host}:{url.explicit_port}" if url.explicit_port else url.host
+    pool = _upstream_pools.get(key)
+    if pool is None:
+        source = UPSTREAM_ENDPOINTS.get(key)
+        if source is None:
+            return None
+        pool = _upstream_pools[key] = _UpstreamPool(key, source, url.port)
+    return pool
+
+
+async def _send(method: str, url: str, kwargs: dict) -> aiohttp.ClientResponse:
+    parsed = yarl.URL(url)
+    pool = _upstream_pool(parsed) if UPSTREAM_ENDPOINTS else None
+    endpoint = await pool.pick() if pool is not None else None
+    if endpoint is None:
+        return await _get_http_session().request(method, url, **kwargs)
+
+    host, _, port = endpoint.address.rpartition(':')
+    headers = CIMultiDict(kwargs.get('headers') or {})
+    # 保留原本的 Host（cluster 內請求已帶租戶 domain）與 TLS SNI
+    headers.setdefault('Host', f"{parsed.host}:{parsed.explicit_port}" if parsed.explicit_port else parsed.host)
+    kwargs = {**kwargs, 'headers': headers}
+    if parsed.scheme == 'https':
+        kwargs['server_hostname'] = parsed.host
+    endpoint.outstanding += 1
+    endpoint.requests += 1
+    started = time.perf_counter()
+    try:
+        resp = await _get_http_session().request(method, parsed.with_host(host.strip('[]')).with_port(int(port)), **kwargs)
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+        endpoint.record_failure()
+        raise
+    finally:
+        endpoint.outstanding -= 1
+    endpoint.observe(time.perf_counter() - started)
+    if resp.status in _BREAKER_FAILURE_STATUSES:
+        endpoint.record_failure()
+    else:
+        endpoint.record_success()
+    return resp
+
+
+async def _hedged_send(method: str, url: str, kwargs: dict) -> aiohttp.ClientResponse:
+    """第一個請求超過 UPSTREAM_HEDGE_DELAY 還沒回應 header 時，再送一個，取先成功的"""
+    first = asyncio.ensure_future(_send(method, url, kwargs))
+    tasks = [first]
+    winner = None
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=UPSTREAM_HEDGE_DELAY)
+        if not done:
+            tasks.append(asyncio.ensure_future(_send(method, url, kwargs)))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception() is None:
+                    winner = task
+                    return task.result()
+        return first.result()
+    finally:
+        for task in tasks:
+            if task is winner:
+                continue
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                task.result().release()
+
+
+@contextlib.asynccontextmanager
+async def _upstream_request(method: str, url: str, *, coalesce: bool = False, **kwargs):
+    """
+    取代 session.get/post/put/delete 的 async context manager，yield 的是 aiohttp 的 response
+    只有 GET 會重試 / hedge；寫入請求只送一次，避免重複寫入
+    coalesce=True 的 GET 會與同時進行中、URL 與 headers 完全相同的請求共用同一個上游回應
+    （body 會整份讀進記憶體，需要串流解析的大型回應不要用）
+    """
+    if coalesce and method == 'GET' and UPSTREAM_COALESCE:
+        yield await _coalesced_get(url, kwargs)
+        return
+    async with _open_upstream(method, url, kwargs) as resp:
+        yield resp
+
+
+@contextlib.asynccontextmanager
+async def _open_upstream(method: str, url: str, kwargs: dict):
+    breaker = _circuit_breaker(url)
+    idempotent = method == 'GET'
+    attempts = 1 + UPSTREAM_RETRIES if idempotent else 1
+    for attempt in range(attempts):
+        probe = breaker.before_request()
+        try:
+            if idempotent and UPSTREAM_HEDGE_DELAY > 0 and not probe:
+                resp = await _hedged_send(method, url, kwargs)
+            else:
+                resp = await _send(method, url, kwargs)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            breaker.record_failure()
+            if attempt + 1 >= attempts:
+                raise
+            await asyncio.sleep(_retry_delay(attempt))
+            continue
+        except BaseException:
+            if probe:
+                breaker.probing = False
+            raise
+
+        if resp.status in _BREAKER_FAILURE_STATUSES:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        if resp.status in _RETRY_STATUSES and attempt + 1 < attempts:
+            resp.release()
+            await asyncio.sleep(_retry_delay(attempt))
+            continue
+        try:
+            yield resp
+        finally:
+            resp.release()
+        return
+
+
+# 相同的 GET 同時進行時只送一次（single-flight）：headers 含 Authorization / Host，所以只會合併同一租戶的請求
+UPSTREAM_COALESCE = os.environ.get('UPSTREAM_COALESCE', 'true') == 'true'
+
+_coalesce_stats = {'leaders': 0, 'followers': 0}
+_inflight_gets: dict[tuple, dict] = {}
+
+
+class _BufferedStream:
+    def __init__(self, body: bytes):
+        self._buffer = io.BytesIO(body)
+
+    async def read(self, n: int = -1) -> bytes:
+        return self._buffer.read(n)
+
+
+class _BufferedResponse:
+    """已讀完 body 的回應，提供 tool 用到的 aiohttp ClientResponse 介面，可給多個呼叫端共用"""
+
+    def __init__(self, resp: aiohttp.ClientResponse, body: bytes):
+        self.status = resp.status
+        self.headers = CIMultiDictProxy(CIMultiDict(resp.headers))
+        self.content_type = resp.content_type
+        self.charset = resp.charset
+        self.content_length = len(body)
+        self._body = body
+
+    @property
+    def content(self) -> _BufferedStream:
+        # 每個呼叫端各自一個讀取位置
+        return _BufferedStream(self._body)
+
+    async def read(self) -> bytes:
+        return self._body
+
+    async def text(self) -> str:
+        return _decode_body(self, self._body)
+
+    def release(self) -> None:
+        pass
+
+
+async def _fetch_buffered(url: str, kwargs: dict) -> _BufferedResponse:
+    async with _open_upstream('GET', url, kwargs) as resp:
+        return _BufferedResponse(resp, await resp.read())
+
+
+async def _coalesced_get(url: str, kwargs: dict) -> _BufferedResponse:
+    """
+    上游請求在獨立的 task 中執行，呼叫端以 shield 等待：
+    單一呼叫端斷線不會影響其他人，全部呼叫端都離開時才取消上游請求
+    """
+    headers = kwargs.get('headers') or {}
+    key = (url, tuple(sorted((k.lower(), str(v)) for k, v in headers.items())))
+    flight = _inflight_gets.get(key)
+    if flight is None:
+        flight = {'task': asyncio.create_task(_fetch_buffered(url, kwargs)), 'waiters': 0}
+        _inflight_gets[key] = flight
+        flight['task'].add_done_callback(lambda _: _inflight_gets.pop(key, None) if _inflight_gets.get(key) is flight else None)
+        _coalesce_stats['leaders'] += 1
+    else:
+        _coalesce_stats['followers'] += 1
+    flight['waiters'] += 1
+    try:
+        return await asyncio.shield(flight['task'])
+    finally:
+        flight['waiters'] -= 1
+        if flight['waiters'] == 0 and not flight['task'].done():
+            # 同時移出 in-flight 表，之後的呼叫端會發新的請求，不會等到已取消的 task
+            if _inflight_gets.get(key) is flight:
+                del _inflight_gets[key]
+            flight['task'].cancel()
+
+
+# element 組件原始碼快取：內容幾乎不變，以 (domain, component) 為 key
+SOURCE_CACHE_MAX_ENTRIES = int(os.environ.get('SOURCE_CACHE_MAX_ENTRIES', '512'))
+SOURCE_CACHE_TTL = float(os.environ.get('SOURCE_CACHE_TTL', '300'))  # 這段時間內直接回傳，超過才用 ETag/Last-Modified 重新驗證
+SOURCE_CACHE_DIR = os.environ.get('SOURCE_CACHE_DIR')  # 有設定才寫入磁碟，pod 重啟後可沿用
+SOURCE_CACHE_PREFETCH = os.environ.get('SOURCE_CACHE_PREFETCH') == 'true'
+SOURCE_CACHE_PREFETCH_CONCURRENCY = int(os.environ.get('SOURCE_CACHE_PREFETCH_CONCURRENCY', '8'))
+SOURCE_CACHE_PREFETCH_MAX_STORES = int(os.environ.get('SOURCE_CACHE_PREFETCH_MAX_STORES', '4'))  # 預熱的商店數（每個不同上游一家）
+
+
+class _SourceCache:
+    """記憶體 LRU + 選用的磁碟儲存，過期後以條件式 GET 重新驗證"""
+
+    def __init__(self, max_entries: int, ttl: float, cache_dir: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self._entries: OrderedDict[tuple, dict] = OrderedDict()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    async def get(self, config: dict, component) -> str:
+        key = (str(config['domain']), str(component))
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        else:
+            entry = await self._load(key)
+
+        if entry is not None and time.monotonic() - entry['checked_at'] < self.ttl:
+            return entry['text']
+
+        headers = _base_headers(config)
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            async with _upstream_request(
+                'GET',
+                _build_source_viewer_url(config, f"/website_backend/source-viewer/{component}.html"),
+                coalesce=True,
+                ssl=ssl_context,
+                headers=headers,
+            ) as resp:
+                if resp.status == 304 and entry is not None:
+                    entry['checked_at'] = time.monotonic()
+                    self._put(key, entry)
+                    return entry['text']
+                text = await _read_text(resp)
+                if resp.status != 200:
+                    # 上游錯誤時若手上有舊版本就先回舊的，沒有就照原樣回傳錯誤內容
+                    return entry['text'] if entry is not None else text
+                entry = {
+                    'text': text,
+                    'etag': resp.headers.get('ETag'),
+                    'last_modified': resp.headers.get('Last-Modified'),
+                    'checked_at': time.monotonic(),
+                }
+        except (aiohttp.ClientError, ToolError):
+            if entry is not None:
+                return entry['text']
+            raise
+
+        self._put(key, entry)
+        await self._save(key, entry)
+        return text
+
+    async def prefetch(self, configs: list[dict]) -> None:
+        """預先抓取 ElementType 組件，失敗的略過，等實際呼叫時再抓；最多佔 LRU 的一半，不擠掉實際在用的項目"""
+        components = get_args(get_args(ElementType)[0])
+        targets = [(config, component) for config in configs for component in components][:self.max_entries // 2]
+        semaphore = asyncio.Semaphore(SOURCE_CACHE_PREFETCH_CONCURRENCY)
+
+        async def fetch(config: dict, component: str) -> None:
+            async with semaphore:
+                try:
+                    await self.get(config, component)
+                except Exception as e:
+                    logger.warning("prefetch source %s for %s failed: %r", component, config['domain'], e)
+
+        await asyncio.gather(*(fetch(config, component) for config, component in targets))
+
+    def _put(self, key: tuple, entry: dict) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _path(self, key: tuple) -> str:
+        digest = hashlib.sha256('\n'.join(key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.json")
+
+    async def _load(self, key: tuple) -> Optional[dict]:
+        if not self.cache_dir:
+            return None
+
+        def read() -> Optional[dict]:
+            try:
+                with open(self._path(key)) as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                return None
+
+        stored = await asyncio.to_thread(read)
+        if stored is None:
+            return None
+        # 磁碟上的內容一律視為過期，第一次使用時用條件式 GET 確認
+        entry = {**stored, 'checked_at': float('-inf')}
+        self._put(key, entry)
+        return entry
+
+    async def _save(self, key: tuple, entry: dict) -> None:
+        if not self.cache_dir:
+            return
+
+        def write() -> None:
+            path = self._path(key)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump({k: entry[k] for k in ('text', 'etag', 'last_modified')}, f)
+            os.replace(tmp, path)
+
+        try:
+            await asyncio.to_thread(write)
+        except OSError as e:
+            logger.warning("persist source cache failed: %r", e)
+
+
+_source_cache = _SourceCache(SOURCE_CACHE_MAX_ENTRIES, SOURCE_CACHE_TTL, SOURCE_CACHE_DIR)
+
+
+async def _upstream_configs(limit: int) -> list[dict]:
+    """每個不同上游各一組 config（最多 limit 組），不載入所有租戶；dev 模式只有 .env 那一組"""
+    if dev:
+        return [get_user_config()]
+    return [_config_from_claims(claims) for claims in await auth.upstream_claims(limit)]
+
+
+async def _prefetch_sources() -> None:
+    await _source_cache.prefetch(await _upstream_configs(SOURCE_CACHE_PREFETCH_MAX_STORES))
+
+
+@lifespan
+async def source_cache_lifespan(server):
+    task = None
+    if SOURCE_CACHE_PREFETCH:
+        # 背景預熱，不阻塞啟動
+        task = asyncio.create_task(_prefetch_sources())
+    try:
+        yield {'source_cache': _source_cache}
+    finally:
+        if task is not None and not task.done():
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+
+# 暖機：先載入 token、解析上游 DNS 並建立連線池中的連線，完成（或逾時）後才回報 ready
+WARMUP_ENABLED = os.environ.get('WARMUP', 'true') == 'true'
+WARMUP_TIMEOUT = float(os.environ.get('WARMUP_TIMEOUT', '20'))
+WARMUP_CONNECTIONS_PER_HOST = int(os.environ.get('WARMUP_CONNECTIONS_PER_HOST', '2'))
+WARMUP_MAX_HOSTS = int(os.environ.get('WARMUP_MAX_HOSTS', '16'))
+WARMUP_PATH = os.environ.get('WARMUP_PATH', '/')
+
+_readiness = {'ready': False, 'warmup_errors': []}
+
+
+def _upstream_origins(configs: list[dict]) -> list[str]:
+    """這些租戶會用到的後端與 source-viewer origin；cluster 內通常只有兩個"""
+    origins = []
+    for config in configs:
+        for url in (_build_api_url(config, '/'), _build_source_viewer_url(config, '/')):
+            origin = str(yarl.URL(url).origin())
+            if origin not in origins:
+                origins.append(origin)
+    return origins[:WARMUP_MAX_HOSTS]
+
+
+async def _warm_connection(origin: str) -> None:
+    # 回應狀態不重要，只要完成 DNS / TCP / TLS 並把連線留在 pool 裡
+    resp = await _send('HEAD', f"{origin}{WARMUP_PATH}", {'ssl': ssl_context, 'allow_redirects': False})
+    resp.release()
+
+
+async def _warm_up() -> None:
+    if isinstance(auth, IndexedTokenVerifier):
+        await auth._current_index()
+    _mark_startup('tokens_loaded')
+    targets = []
+    for origin in _upstream_origins(await _upstream_configs(WARMUP_MAX_HOSTS)):
+        # 有用戶端負載平衡時，每個 endpoint 都要建立連線
+        pool = _upstream_pool(yarl.URL(origin)) if UPSTREAM_ENDPOINTS else None
+        if pool is not None:
+            await pool.refresh()
+        targets += [origin] * WARMUP_CONNECTIONS_PER_HOST * max(1, len(pool.endpoints) if pool else 1)
+    results = await asyncio.gather(*(_warm_connection(origin) for origin in targets), return_exceptions=True)
+    _readiness['warmup_errors'] = sorted({
+        f"{origin}: {type(result).__name__}: {result}"
+        for origin, result in zip(targets, results)
+        if isinstance(result, Exception)
+    })
+    _mark_startup('connections_warm')
+
+
+async def _run_warm_up() -> None:
+    try:
+        if WARMUP_ENABLED:
+            await asyncio.wait_for(_warm_up(), WARMUP_TIMEOUT)
+    except Exception as e:
+        # 後端暫時連不上不應讓 pod 永遠不 ready，第一個請求會照常重試
+        logger.warning("warm-up failed: %r", e)
+        _readiness['warmup_errors'].append(f"{type(e).__name__}: {e}")
+    finally:
+        _readiness['ready'] = True
+        _mark_startup('ready')
+        for phase, seconds in _startup_timings.items():
+            STARTUP_PHASE.labels(phase).set(seconds)
+        logger.info("startup timings (s since process start): %s", _startup_timings)
+
+
+@lifespan
+async def warmup_lifespan(server):
+    _mark_startup('lifespan')
+    task = asyncio.create_task(_run_warm_up())
+    try:
+        yield {}
+    finally:
+        if not task.done():
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+
+# 租戶隔離：所有租戶共用同一個 process，限制每個租戶同時執行的 tool 數與呼叫頻率，
+# 全域名額不足時各租戶的等待佇列輪流取得名額，避免單一 agent 大量平行呼叫餓死其他商店
+# tokens.json 每個 entry 可用 max_concurrency / max_queue / rate_limit / rate_burst 覆寫預設值
+TOOL_MAX_CONCURRENCY = int(os.environ.get('TOOL_MAX_CONCURRENCY', '64'))  # 整個 process 同時執行的 tool 呼叫數
+TENANT_MAX_CONCURRENCY = int(os.environ.get('TENANT_MAX_CONCURRENCY', '8'))
+TENANT_MAX_QUEUE = int(os.environ.get('TENANT_MAX_QUEUE', '16'))  # 超過就直接回 backpressure 錯誤
+TENANT_QUEUE_TIMEOUT = float(os.environ.get('TENANT_QUEUE_TIMEOUT', '10'))  # 秒，排隊超過這段時間也回錯誤
+TENANT_RATE_LIMIT = float(os.environ.get('TENANT_RATE_LIMIT', '0'))  # 每秒 tool 呼叫數，0 代表不限
+TENANT_RATE_BURST = int(os.environ.get('TENANT_RATE_BURST', '20'))
+
+TENANT_QUEUE_DEPTH = Gauge('mcp_tenant_queue_depth', '排隊中的 tool 呼叫', ['client_id'])
+TENANT_QUEUE_WAIT = Histogram('mcp_tenant_queue_wait_seconds', 'tool 呼叫取得執行名額前的等待時間', ['client_id'])
+TENANT_REJECTED = Counter('mcp_tenant_rejected_total', '因 backpressure 拒絕的 tool 呼叫', ['client_id', 'reason'])
+
+
+class _Backpressure(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _TenantState:
+    def __init__(self):
+        self.in_flight = 0
+        self.waiters: deque[asyncio.Future] = deque()
+        self.max_concurrency = TENANT_MAX_CONCURRENCY
+        self.max_queue = TENANT_MAX_QUEUE
+        self.rate = TENANT_RATE_LIMIT
+        self.burst = TENANT_RATE_BURST
+        self.tokens = float(TENANT_RATE_BURST)
+        self.refilled_at = time.monotonic()
+        self.admitted = 0
+        self.rejected = 0
+
+    def configure(self, claims: dict) -> None:
+        # 每次呼叫都從 claims 讀，tokens.json 重新載入後立即生效
+        self.max_concurrency = max(1, int(claims.get('max_concurrency', TENANT_MAX_CONCURRENCY)))
+        self.max_queue = max(0, int(claims.get('max_queue', TENANT_MAX_QUEUE)))
+        self.rate = float(claims.get('rate_limit', TENANT_RATE_LIMIT))
+        self.burst = max(1, int(claims.get('rate_burst', TENANT_RATE_BURST)))
+
+    def take_rate_token(self) -> None:
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+        if self.tokens < 1:
+            raise _Backpressure('rate_limited', (1 - self.tokens) / self.rate)
+        self.tokens -= 1
+
+
+class _FairScheduler:
+    """
+    全域 TOOL_MAX_CONCURRENCY 個執行名額；租戶未達自己的上限且全域有空位時直接執行，
+    否則進入該租戶的佇列，名額釋出時以 round robin 輪流分給有人排隊的租戶
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_use = 0
+        self.tenants: dict[str, _TenantState] = {}
+        self._ring: deque[str] = deque()  # 有人排隊的租戶
+
+    def state(self, tenant: str) -> _TenantState:
+        state = self.tenants.get(tenant)
+        if state is None:
+            state = self.tenants[tenant] = _TenantState()
+        return state
+
+    async def acquire(self, tenant: str, claims: dict) -> float:
+        """取得執行名額，回傳排隊秒數；超過上限時丟 _Backpressure"""
+        state = self.state(tenant)
+        state.configure(claims)
+        try:
+            state.take_rate_token()
+        except _Backpressure:
+            state.rejected += 1
+            raise
+        if not state.waiters and state.in_flight < state.max_concurrency and self.in_use < self.capacity:
+            self._grant(state)
+            return 0.0
+        if len(state.waiters) >= state.max_queue:
+            state.rejected += 1
+            raise _Backpressure('queue_full', 1.0)
+
+        waiter = asyncio.get_running_loop().create_future()
+        state.waiters.append(waiter)
+        if tenant not in self._ring:
+            self._ring.append(tenant)
+        TENANT_QUEUE_DEPTH.labels(_tenant_label(tenant)).inc()
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter, TENANT_QUEUE_TIMEOUT)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # 剛好在放棄時拿到名額，要還回去
+                self.release(tenant)
+            elif waiter in state.waiters:
+                state.waiters.remove(waiter)
+            if isinstance(e, TimeoutError):
+                state.rejected += 1
+                raise _Backpressure('queue_timeout', TENANT_QUEUE_TIMEOUT) from None
+            raise
+        finally:
+            TENANT_QUEUE_DEPTH.labels(_tenant_label(tenant)).dec()
+        return time.monotonic() - started
+
+    def release(self, tenant: str) -> None:
+        self.tenants[tenant].in_flight -= 1
+        self.in_use -= 1
+        self._dispatch()
+
+    def _grant(self, state: _TenantState) -> None:
+        state.in_flight += 1
+        state.admitted += 1
+        self.in_use += 1
+
+    def _dispatch(self) -> None:
+        skipped = 0
+        while self.in_use < self.capacity and self._ring and skipped < len(self._ring):
+            tenant = self._ring[0]
+            self._ring.rotate(-1)
+            state = self.tenants[tenant]
+            # 已取消或逾時的 waiter 可能還沒被 acquire 移出佇列，直接丟掉，不能給它名額
+            while state.waiters and state.waiters[0].done():
+                state.waiters.popleft()
+            if not state.waiters:
+                self._ring.remove(tenant)
+                continue
+            if state.in_flight >= state.max_concurrency:
+                skipped += 1
+                continue
+            skipped = 0
+            self._grant(state)
+            state.waiters.popleft().set_result(None)
+            if not state.waiters:
+                self._ring.remove(tenant)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'capacity': self.capacity,
+            'in_use': self.in_use,
+            'tenants': {
+                tenant: {
+                    'in_flight': state.in_flight,
+                    'queued': len(state.waiters),
+                    'max_concurrency': state.max_concurrency,
+                    'max_queue': state.max_queue,
+                    'rate_limit': state.rate,
+                    'admitted': state.admitted,
+                    'rejected': state.rejected,
+                }
+                for tenant, state in self.tenants.items()
+            },
+        }
+
+
+_tool_scheduler = _FairScheduler(TOOL_MAX_CONCURRENCY)
+
+
+class _TenantAdmissionMiddleware(Middleware):
+    """tool 呼叫前依租戶取得執行名額，超過上限回明確的 backpressure 錯誤讓 agent 稍後重試"""
+
+    async def on_call_tool(self, context: MiddlewareContext, call_next):
+        token = get_access_token()
+        if token is None:
+            # dev 模式（stdio）只有一個使用者
+            return await call_next(context)
+        tenant = token.client_id
+        try:
+            waited = await _tool_scheduler.acquire(tenant, token.claims)
+        except _Backpressure as e:
+            TENANT_REJECTED.labels(_tenant_label(tenant), e.reason).inc()
+            raise ToolError(
+                f"Server busy for this account ({e.reason}): too many concurrent tool calls. "
+                f"Retry after {e.retry_after:.1f}s and reduce parallel calls."
+            ) from None
+        TENANT_QUEUE_WAIT.labels(_tenant_label(tenant)).observe(waited)
+        try:
+            return await call_next(context)
+        finally:
+            _tool_scheduler.release(tenant)
+
+
+# tool 呼叫期限：逾時或 client 斷線時取消整個 tool，進行中的上游請求會跟著取消並關閉連線
+# 預設 TOOL_TIMEOUT，TOOL_TIMEOUTS（JSON，tool 名稱 -> 秒）個別覆寫；
+# 單次呼叫可在 tools/call 的 _meta 帶 {"timeout": 秒}，最多 TOOL_TIMEOUT_MAX
+TOOL_TIMEOUT = float(os.environ.get('TOOL_TIMEOUT', '60'))
+TOOL_TIMEOUT_MAX = float(os.environ.get('TOOL_TIMEOUT_MAX', '600'))
+TOOL_TIMEOUTS = {
+    # 會依序打很多次後端的 tool 預設給比較長的期限
+    'my_application_batch_element_operations': 180,
+    'my_application_bulk_update_products': 300,
+    'my_application_get_website_snapshot': 180,
+    'my_application_upload_media': 1800,
+    **json.loads(os.environ.get('TOOL_TIMEOUTS', '{}')),
+}
+
+TOOL_TIMEOUTS_TOTAL = Counter('mcp_tool_timeouts_total', 'tool 呼叫逾時：deadline 為整體期限，upstream 為單一上游請求逾時', ['tool', 'kind'])
+TOOL_CANCELLED = Counter('mcp_tool_cancelled_total', 'client 斷線而取消的 tool 呼叫', ['tool'])
+
+
+def _tool_timeout(tool: str, context: MiddlewareContext) -> float:
+    timeout = float(TOOL_TIMEOUTS.get(tool, TOOL_TIMEOUT))
+    request_context = context.fastmcp_context.request_context if context.fastmcp_context is not None else None
+    meta = request_context.meta if request_context is not None else None
+    requested = getattr(meta, 'timeout', None) if meta is not None else None
+    if isinstance(requested, (int, float)) and requested > 0:
+        timeout = min(float(requested), TOOL_TIMEOUT_MAX)
+    return timeout
+
+
+def _current_http_request() -> Optional[Request]:
+    try:
+        return get_http_request()
+    except RuntimeError:
+        # stdio 沒有 HTTP 請求
+        return None
+
+
+async def _wait_for_disconnect(request: Request) -> None:
+    # body 已由 MCP transport 讀完，之後 receive 只會在 client 斷線（或回應送完）時回 http.disconnect
+    while (await request.receive())['type'] != 'http.disconnect':
+        pass
+
+
+class _DeadlineMiddleware(Middleware):
+    """替 tool 呼叫套上期限，逾時或 client 斷線時取消，並依 tool 記錄逾時次數"""
+
+    async def on_call_tool(self, context: MiddlewareContext, call_next):
+        tool = context.message.name
+        timeout = _tool_timeout(tool, context)
+        request = _current_http_request()
+        watcher = None
+        disconnected = False
+        try:
+            async with asyncio.timeout(timeout) as deadline:
+                if request is not None:
+                    def on_disconnect(task: asyncio.Task) -> None:
+                        nonlocal disconnected
+                        if task.cancelled() or task.exception() is not None:
+                            return
+                        disconnected = True
+                        # 讓期限立刻到期，由 asyncio.timeout 負責取消與收尾
+                        with contextlib.suppress(RuntimeError):
+                            deadline.reschedule(asyncio.get_running_loop().time())
+
+                    watcher = asyncio.create_task(_wait_for_disconnect(request))
+                    watcher.add_done_callback(on_disconnect)
+                try:
+                    return await call_next(context)
+                finally:
+                    if watcher is not None:
+                        watcher.cancel()
+        except TimeoutError:
+            if disconnected:
+                TOOL_CANCELLED.labels(tool).inc()
+                raise ToolError("Client disconnected; tool call cancelled.") from None
+            if deadline.expired():
+                TOOL_TIMEOUTS_TOTAL.labels(tool, 'deadline').inc()
+                raise ToolError(
+                    f"Tool call exceeded its {timeout:g}s deadline and was cancelled. "
+                    f"Narrow the request or retry with a larger _meta.timeout (max {TOOL_TIMEOUT_MAX:g}s)."
+                ) from None
+            raise
+        except ToolError as e:
+            # FastMCP 把 tool 內的例外包成 ToolError，上游請求逾時（aiohttp 的 ServerTimeoutError 等）在 __cause__
+            if isinstance(e.__cause__, TimeoutError):
+                TOOL_TIMEOUTS_TOTAL.labels(tool, 'upstream').inc()
+                raise ToolError("Backend did not respond in time, please retry later.") from e.__cause__
+            raise
+
+
+# 背景工作：耗時的操作（例如大範圍的 clone / mirror）可改為背景執行，tool 立即回傳 job id，
+# 之後用 my_application_get_job 查詢狀態 / 進度 / 結果；工作只存在接受它的 process 記憶體中，
+# stateless HTTP 沒有 session 可以黏住同一個 pod，多副本部署時查詢可能落到別的 pod。
+# job id 以 process 的 id 開頭，落到別的 process 時回明確的錯誤，而不是當成過期
+JOB_MAX_CONCURRENCY = int(os.environ.get('JOB_MAX_CONCURRENCY', '8'))
+JOB_MAX_PENDING = int(os.environ.get('JOB_MAX_PENDING', '16'))  # 每個租戶未完成的工作上限
+JOB_TIMEOUT = float(os.environ.get('JOB_TIMEOUT', '1800'))
+JOB_RESULT_TTL = float(os.environ.get('JOB_RESULT_TTL', '900'))
+JOB_WAIT_MAX = float(os.environ.get('JOB_WAIT_MAX', '50'))  # my_application_get_job 長輪詢的上限，需小於 TOOL_TIMEOUT
+
+_JOB_PROCESS_ID = os.urandom(4).hex()
+
+JOBS_RUNNING = Gauge('mcp_jobs_running', '執行中的背景工作')
+JOBS_FINISHED = Counter('mcp_jobs_finished_total', '結束的背景工作', ['kind', 'status'])
+
+
+class _Job:
+    def __init__(self, job_id: str, tenant: str, kind: str, params: dict):
+        self.id = job_id
+        self.tenant = tenant
+        self.kind = kind
+        self.params = params
+        self.status = 'queued'
+        self.progress = 0
+        self.total: Optional[float] = None
+        self.message: Optional[str] = None
+        self.result = None
+        self.error: Optional[str] = None
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        # 每次變化時 set 後換新，等待中的長輪詢就會醒來
+        self.changed = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.finished is not None
+
+    def report(self, progress: float, total: Optional[float] = None, message: Optional[str] = None) -> None:
+        self.progress, self.total, self.message = progress, total, message
+        self.notify()
+
+    def notify(self) -> None:
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        data = {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'params': self.params,
+            'progress': self.progress,
+            'total': self.total,
+            'message': self.message,
+            'created_at': datetime.fromtimestamp(self.created).isoformat(timespec='seconds'),
+            'elapsed_ms': round(((self.finished or now) - (self.started or now)) * 1000, 1),
+        }
+        if self.done:
+            data['expires_in'] = max(0, round(self.finished + JOB_RESULT_TTL - now))
+            data['result'] = self.result
+            data['error'] = self.error
+        return data
+
+
+class _JobManager:
+    """
+    背景工作池：最多 max_concurrency 個同時執行，其餘排隊；每個租戶最多 max_pending 個未完成的工作
+    結束的工作保留 ttl 秒供查詢，之後在下次存取時清掉
+    """
+
+    def __init__(self, max_concurrency: int, max_pending: int, timeout: float, ttl: float):
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.ttl = ttl
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._jobs: dict[str, _Job] = {}
+        self.stats = {'submitted': 0, 'rejected': 0, 'expired': 0}
+
+    def submit(self, tenant: str, kind: str, params: dict, work) -> _Job:
+        """work(job) 是 coroutine function，回傳值即工作結果，可用 job.report 回報進度"""
+        self._sweep()
+        pending = sum(1 for job in self._jobs.values() if job.tenant == tenant and not job.done)
+        if pending >= self.max_pending:
+            self.stats['rejected'] += 1
+            raise ToolError(
+                f"Too many unfinished background jobs for this account ({pending}). "
+                "Wait for some to finish (my_application_get_job) and retry."
+            )
+        job = _Job(f"{_JOB_PROCESS_ID}-{os.urandom(8).hex()}", tenant, kind, params)
+        self._jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(job, work))
+        self.stats['submitted'] += 1
+        return job
+
+    async def _run(self, job: _Job, work) -> None:
+        try:
+            async with self._slots:
+                job.status, job.started = 'running', time.time()
+                job.notify()
+                JOBS_RUNNING.inc()
+                try:
+                    async with asyncio.timeout(self.timeout):
+                        job.result = await work(job)
+                finally:
+                    JOBS_RUNNING.dec()
+            job.status = 'succeeded'
+        except asyncio.CancelledError:
+            job.status = 'cancelled'
+        except TimeoutError:
+            job.status, job.error = 'failed', f"Job exceeded its {self.timeout:g}s limit and was cancelled."
+        except Exception as e:
+            job.status, job.error = 'failed', str(e) if isinstance(e, ToolError) else f"{type(e).__name__}: {e}"
+        finally:
+            job.started = job.started or time.time()
+            job.finished = time.time()
+            JOBS_FINISHED.labels(job.kind, job.status).inc()
+            job.notify()
+
+    def get(self, tenant: str, job_id: str) -> Optional[_Job]:
+        if not job_id.startswith(f"{_JOB_PROCESS_ID}-"):
+            raise ToolError(
+                f"Job {job_id!r} was not started by this server process (another replica, or the server restarted). "
+                "Background jobs are kept only in the process that accepted them, so they need a single-replica deployment; "
+                "check the target element and run the action again if needed."
+            )
+        self._sweep()
+        job = self._jobs.get(job_id)
+        # 只能看到自己租戶的工作
+        return job if job is not None and job.tenant == tenant else None
+
+    def cancel(self, job: _Job) -> bool:
+        if job.done or job.task is None:
+            return False
+        return job.task.cancel()
+
+    def _sweep(self) -> None:
+        cutoff = time.time() - self.ttl
+        expired = [job_id for job_id, job in self._jobs.items() if job.done and job.finished < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+        self.stats['expired'] += len(expired)
+
+    async def shutdown(self) -> None:
+        tasks = [job.task for job in self._jobs.values() if job.task is not None and not job.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    @property
+    def summary(self) -> dict:
+        self._sweep()
+        tenants: dict[str, dict] = {}
+        for job in self._jobs.values():
+            counts = tenants.setdefault(job.tenant, {})
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {**self.stats, 'jobs': len(self._jobs), 'tenants': tenants}
+
+
+_jobs = _JobManager(JOB_MAX_CONCURRENCY, JOB_MAX_PENDING, JOB_TIMEOUT, JOB_RESULT_TTL)
+
+
+def _job_owner() -> str:
+    token = get_access_token()
+    # dev 模式（stdio）只有一個使用者
+    return token.client_id if token is not None else '-'
+
+
+@lifespan
+async def jobs_lifespan(server):
+    try:
+        yield {'jobs': _jobs}
+    finally:
+        await _jobs.shutdown()
+
+
+# tool 分組：tokens.json 的 scopes 決定 client 看得到、呼叫得到哪些 tool；沒有設定 scopes 的 token 可使用全部
+# 寫入的 scope 同時包含同一區的讀取（寫入前通常需要先讀取 uuid）
+TOOL_SCOPES = {
+    'website:read': {
+        'my_application_list_all_webpages',
+        'my_application_get_brief_webpage_structure',
+        'my_application_get_detail_element_structure',
+        'my_application_get_website_snapshot',
+        'my_application_query_elements',
+        'my_application_get_element_component_source',
+        'my_application_list_my_media_assets',
+    },
+    'website:write': {
+        'my_application_create_webpage',
+        'my_application_update_webpage',
+        'my_application_delete_webpage',
+        'my_application_create_element',
+        'my_application_update_element',
+        'my_application_delete_element',
+        'my_application_action_to_target_element',
+        'my_application_batch_element_operations',
+        'my_application_get_job',
+        'my_application_upload_media',
+    },
+    'content:read': {
+        'my_application_retrieve_product',
+        'my_application_retrieve_blog_post',
+    },
+    'content:write': {
+        'my_application_update_product',
+        'my_application_bulk_update_products',
+        'my_application_update_blog_post',
+    },
+}
+_SCOPE_IMPLIES = {'website:write': 'website:read', 'content:write': 'content:read'}
+# 分組前的 tokens.json 使用 read / write，對應到兩區的讀取 / 寫入
+_LEGACY_SCOPES = {'read': ('website:read', 'content:read'), 'write': ('website:write', 'content:write')}
+
+# tools/list 的 schema 模式：full 為 FastMCP 原樣輸出；compact 去掉 title / Optional 的 null 分支等重複資訊
+# 預設 TOOL_SCHEMA_MODE，tokens.json 的 entry 可用 tool_schema 個別設定
+TOOL_SCHEMA_MODE = os.environ.get('TOOL_SCHEMA_MODE', 'full')
+
+
+def _allowed_tools(scopes) -> Optional[frozenset[str]]:
+    """token 可使用的 tool 名稱；None 代表不限制（沒有 scopes，或沒有任何認得的 scope）"""
+    groups = set()
+    for scope in scopes or ():
+        for group in _LEGACY_SCOPES.get(scope, (scope,)):
+            if group in TOOL_SCOPES:
+                groups.add(group)
+                groups.add(_SCOPE_IMPLIES.get(group, group))
+    if not groups:
+        return None
+    return frozenset().union(*(TOOL_SCOPES[group] for group in groups))
+
+
+def _schema_mode(claims: dict) -> str:
+    mode = claims.get('tool_schema', TOOL_SCHEMA_MODE)
+    return mode if mode in ('full', 'compact') else 'full'
+
+
+def _compact_schema(schema):
+    """精簡 JSON schema：去掉 title、Optional[X] = None 改寫為 X（是否必填已由 required 表達）"""
+    if not isinstance(schema, dict):
+        return schema
+    schema = {key: value for key, value in schema.items() if key != 'title'}
+    options = schema.get('anyOf')
+    if (
+        isinstance(options, list) and len(options) == 2 and {'type': 'null'} in options
+        and 'default' in schema and schema['default'] is None
+    ):
+        inner = options[0] if options[1] == {'type': 'null'} else options[1]
+        del schema['anyOf'], schema['default']
+        schema = {**inner, **schema}
+    if schema.get('items') == {}:
+        del schema['items']
+    for key in ('properties', '$defs'):
+        if isinstance(schema.get(key), dict):
+            schema[key] = {name: _compact_schema(value) for name, value in schema[key].items()}
+    for key in ('items', 'additionalProperties'):
+        if isinstance(schema.get(key), dict):
+            schema[key] = _compact_schema(schema[key])
+    for key in ('anyOf', 'oneOf', 'allOf'):
+        if isinstance(schema.get(key), list):
+            schema[key] = [_compact_schema(value) for value in schema[key]]
+    return schema
+
+
+class _ToolManifest:
+    """
+    tools/list 的結果在 process 內只建一次：依 (可用 tool, schema 模式) 快取 tool 清單與序列化後的 result bytes
+    tool 在 import 時就註冊完成，之後不會變動，因此不需要失效
+    """
+
+    def __init__(self):
+        self._tools: dict[tuple, list] = {}
+        self._payloads: dict[tuple, bytes] = {}
+        self.stats = {'hits': 0, 'builds': 0}
+
+    async def tools(self, allowed: Optional[frozenset[str]], mode: str) -> list:
+        key = (allowed, mode)
+        tools = self._tools.get(key)
+        if tools is None:
+            # 與 FastMCP 預設的 DereferenceRefsMiddleware 相同，先展開 $ref 讓每個 tool 的 schema 自成一體
+            tools = []
+            for tool in await mcp.list_tools(run_middleware=False):
+                if allowed is not None and tool.name not in allowed:
+                    continue
+                parameters = dereference_refs(tool.parameters)
+                tools.append(tool.model_copy(update={'parameters': _compact_schema(parameters) if mode == 'compact' else parameters}))
+            self._tools[key] = tools
+        return tools
 
-load_dotenv()
+    async def payload(self, allowed: Optional[frozenset[str]], mode: str) -> bytes:
+        """序列化後的 ListToolsResult，格式與 MCP SDK 輸出相同（by_alias、exclude_none）"""
+        key = (allowed, mode)
+        payload = self._payloads.get(key)
+        if payload is not None:
+            self.stats['hits'] += 1
+            return payload
+        tools = [
+            # compact 模式不送 FastMCP 的 _meta（tags 等）
+            tool.to_mcp_tool(name=tool.name, **({'_meta': None} if mode == 'compact' else {}))
+            for tool in await self.tools(allowed, mode)
+        ]
+        payload = mcp_types.ListToolsResult(tools=tools).model_dump_json(by_alias=True, exclude_none=True).encode()
+        self._payloads[key] = payload
+        self.stats['builds'] += 1
+        return payload
 
-dev = os.environ.get('DEV') == 'true'
 
+_tool_manifest = _ToolManifest()
 
-def _load_tokens() -> dict:
-    """從 tokens.json 載入多用戶 API key 設定（dev 模式不需要）"""
-    if dev:
-        return {}
-    tokens_file = os.environ.get("TOKENS_FILE", "tokens.json")
-    with open(tokens_file) as f:
-        return json.load(f)
 
+class _ToolScopeMiddleware(Middleware):
+    """依 token 的 scopes 過濾 tools/list 並拒絕呼叫範圍外的 tool；tools/list 走 _tool_manifest 的快取"""
+
+    async def on_list_tools(self, context: MiddlewareContext, call_next):
+        token = get_access_token()
+        if token is None:
+            return await call_next(context)
+        return await _tool_manifest.tools(_allowed_tools(token.scopes), _schema_mode(token.claims))
+
+    async def on_call_tool(self, context: MiddlewareContext, call_next):
+        token = get_access_token()
+        allowed = _allowed_tools(token.scopes) if token is not None else None
+        if allowed is not None and context.message.name not in allowed:
+            raise ToolError(f"This token is not allowed to call {context.message.name} (scopes: {', '.join(token.scopes)}).")
+        return await call_next(context)
+
+
+class _ToolListMiddleware:
+    """
+    ASGI middleware：單一 tools/list 請求直接回傳 _tool_manifest 預先序列化的 bytes，不經過 MCP session
+    其他請求（以及 header / token 不符合預期的 tools/list）原樣交給 MCP transport 處理
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.path = fastmcp.settings.streamable_http_path.rstrip('/')
+        self.json_response = fastmcp.settings.json_response
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'POST' or scope['path'].rstrip('/') != self.path:
+            return await self.app(scope, receive, send)
+        chunks, more_body = [], True
+        while more_body:
+            message = await receive()
+            if message['type'] != 'http.request':
+                break
+            chunks.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        body = b''.join(chunks)
+        response = await self._tools_list_response(scope, body) if b'tools/list' in body else None
+        if response is not None:
+            return await response(scope, receive, send)
+
+        replayed = False
+
+        async def replay():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            return await receive()
+
+        await self.app(scope, replay, send)
+
+    async def _tools_list_response(self, scope, body: bytes) -> Optional[Response]:
+        headers = Headers(scope=scope)
+        accept = [part.strip() for part in headers.get('accept', '').split(',')]
+        if not (
+            headers.get('content-type', '').split(';')[0].strip() == 'application/json'
+            and any(part.startswith('application/json') for part in accept)
+            and (self.json_response or any(part.startswith('text/event-stream') for part in accept))
+            and headers.get('mcp-protocol-version', DEFAULT_NEGOTIATED_VERSION) in SUPPORTED_PROTOCOL_VERSIONS
+            and 'mcp-session-id' not in headers
+        ):
+            return None
+        try:
+            message = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            return None
+        if not (
+            isinstance(message, dict) and message.get('jsonrpc') == '2.0' and message.get('method') == 'tools/list'
+            and isinstance(message.get('id'), (str, int)) and not isinstance(message.get('id'), bool)
+            and not (message.get('params') or {}).get('cursor')
+        ):
+            return None
+        scheme, _, token = headers.get('authorization', '').partition(' ')
+        access_token = await auth.verify_token(token) if scheme.lower() == 'bearer' and token else None
+        if access_token is None:
+            # 交給 MCP transport 回 401
+            return None
+        payload = await _tool_manifest.payload(_allowed_tools(access_token.scopes), _schema_mode(access_token.claims))
+        data = b'{"jsonrpc":"2.0","id":' + orjson.dumps(message['id']) + b',"result":' + payload + b'}'
+        if self.json_response:
+            return Response(data, media_type='application/json')
+        return Response(
+            b'event: message\r\ndata: ' + data + b'\r\n\r\n',
+            headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache, no-transform', 'X-Accel-Buffering': 'no'},
+        )
 
-auth = StaticTokenVerifier(tokens=_load_tokens())
 
 # Create an MCP server
-mcp = FastMCP("TNT-MCP", auth=auth)
+mcp = FastMCP(
+    "TNT-MCP",
+    auth=auth,
+    lifespan=http_session_lifespan | warmup_lifespan | source_cache_lifespan | jobs_lifespan,
+    middleware=[_MetricsMiddleware(), _ToolScopeMiddleware(), _DeadlineMiddleware(), _TenantAdmissionMiddleware()],
+)
 
 
 
@@ -86,17 +1889,23 @@ def get_user_config() -> dict:
             'protocol': protocol,
         }
     token = get_access_token()
-    protocol = token.claims.get('protocol', 'https')
-    host = token.claims.get('host')
-    port = token.claims.get('port', '')
+    return _config_from_claims(token.claims)
+
+
+def _config_from_claims(claims: dict) -> dict:
+    """把 tokens.json 單一用戶的設定（即 token claims）轉成 tool 使用的 config"""
+    protocol = claims.get('protocol', 'https')
+    host = claims.get('host')
+    port = claims.get('port', '')
     if host:
         base = f"{protocol}://{host}:{port}" if port else f"{protocol}://{host}"
     else:
         base = None
     return {
-        'user_access_token': token.claims.get('user_access_token'),
-        'domain': token.claims.get('domain'),
-        'store_uuid': token.claims.get('store_uuid'),
+        'user_access_token': claims.get('user_access_token'),
+        'domain': claims.get('domain'),
+        'store_uuid': claims.get('store_uuid'),
+        'protocol': protocol,
         'internal_base_url': base,
     }
 
@@ -131,6 +1940,72 @@ def _base_headers(config: dict, content_type: Optional[str] = "application/json"
     return headers
 
 
+def _json_dumps(value) -> str:
+    """tool 回傳與請求 body 共用的 JSON 編碼（orjson，輸出等同 ensure_ascii=False 的精簡格式）"""
+    return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+def _decode_body(resp, body: bytes) -> str:
+    """JSON 依規格就是 UTF-8，其餘沒有宣告 charset 的回應也當 UTF-8，不做 charset 偵測"""
+    return body.decode(resp.charset or 'utf-8', errors='replace')
+
+
+async def _read_text(resp) -> str:
+    """取代 resp.text()：讀 bytes 後直接解碼一次"""
+    return _decode_body(resp, await resp.read())
+
+
+def _fits_in_memory(resp, max_bytes: int) -> bool:
+    """
+    body 已在記憶體中（coalesce 的回應）或 Content-Length 不超過 max_bytes 時，整份讀取後用 orjson 解析最快；
+    大小未知或過大的回應改為串流解析。壓縮過的 body 解開後通常大好幾倍，以 1/8 計算
+    """
+    if isinstance(resp, _BufferedResponse):
+        return True
+    if resp.content_length is None:
+        return False
+    if resp.headers.get('Content-Encoding', 'identity') != 'identity':
+        max_bytes //= 8
+    return resp.content_length <= max_bytes
+
+
+class _SyncStreamReader:
+    """
+    給 worker thread 中同步解析器（ijson C backend）用的 file-like 物件：每次 read 從 event loop 取上游 body 的下一段，
+    記憶體只保留目前的區塊，同時避免逐事件 await 的成本
+    """
+
+    def __init__(self, stream, loop: asyncio.AbstractEventLoop):
+        self._stream = stream
+        self._loop = loop
+        self._future = None
+        self._cancelled = False
+
+    def read(self, size: int = -1) -> bytes:
+        if size == 0:
+            # ijson 以 read(0) 判斷回傳型別
+            return b''
+        if self._cancelled:
+            raise asyncio.CancelledError()
+        self._future = asyncio.run_coroutine_threadsafe(self._stream.read(size if size > 0 else 65536), self._loop)
+        return self._future.result()
+
+    def cancel(self) -> None:
+        self._cancelled = True
+        if self._future is not None:
+            self._future.cancel()
+
+
+async def _parse_in_thread(resp, parse):
+    """在 worker thread 中以 parse(reader) 邊讀邊解析上游 body，不阻塞 event loop"""
+    reader = _SyncStreamReader(resp.content, asyncio.get_running_loop())
+    try:
+        return await asyncio.to_thread(parse, reader)
+    finally:
+        # 呼叫端被取消時，讓 worker thread 不再等待上游資料
+        reader.cancel()
+
+
 def _to_form_data(body: dict) -> aiohttp.FormData:
     """把 body dict 轉成 multipart/form-data，給只吃 multipart 的後端 endpoint 用"""
     form = aiohttp.FormData(default_to_multipart=True)
@@ -138,12 +2013,883 @@ def _to_form_data(body: dict) -> aiohttp.FormData:
         if isinstance(value, bool):
             form.add_field(key, str(value).lower())
         elif isinstance(value, (list, dict)):
-            form.add_field(key, json.dumps(value))
+            form.add_field(key, _json_dumps(value))
         else:
             form.add_field(key, str(value))
     return form
 
 
+# 元素/網頁結構回應的欄位篩選與大小上限：不大的回應以 orjson 解析後在記憶體中套用；
+# 大小未知或超過 PROJECTION_IN_MEMORY_MAX_BYTES 的回應邊讀邊以 ijson 事件走訪，不整份載入，也不建出整棵物件樹
+PROJECTION_IN_MEMORY_MAX_BYTES = int(os.environ.get('PROJECTION_IN_MEMORY_MAX_BYTES', str(4 * 1024 * 1024)))
+
+StructureFields = Annotated[
+    Optional[list[str]],
+    Field(description="只回傳每個節點的這些欄位；uuid 與陣列欄位（子節點）一律保留"),
+]
+StructureMaxDepth = Annotated[
+    Optional[int],
+    Field(ge=0, description="子節點最大深度，超過的子節點陣列以 {\"$truncated\": 數量} 表示"),
+]
+StructureSubtreeRoot = Annotated[
+    Optional[str],
+    Field(description="只回傳 uuid 等於此值的節點及其子樹"),
+]
+StructureMaxBytes = Annotated[
+    Optional[int],
+    Field(ge=256, description="回傳內容的約略位元組上限，超過後剩餘的子節點以 {\"$truncated\": 數量} 表示"),
+]
+
+
+class _SubtreeFound(Exception):
+    def __init__(self, node: dict):
+        self.node = node
+
+
+class _StructureProjection:
+    def __init__(self, fields: Optional[list[str]], max_depth: Optional[int], subtree_root: Optional[str], max_bytes: Optional[int]):
+        self.fields = set(fields) | {'uuid'} if fields else None
+        self.max_depth = max_depth
+        self.subtree_root = subtree_root
+        self.max_bytes = max_bytes
+        self.remaining = max_bytes if max_bytes is not None else math.inf
+        self.searching = subtree_root is not None
+
+    @property
+    def requested(self) -> bool:
+        return any(v is not None for v in (self.fields, self.max_depth, self.subtree_root, self.max_bytes))
+
+    @property
+    def exhausted(self) -> bool:
+        return not self.searching and self.remaining <= 0
+
+    def keep_key(self, key: str, event: str) -> bool:
+        return self.fields is None or key in self.fields or event == 'start_array'
+
+    def truncate_children(self, depth: int, first_item_event: str) -> bool:
+        """只截斷「物件陣列」（即子節點），一般值的陣列不算深度"""
+        return (not self.searching and self.max_depth is not None
+                and first_item_event == 'start_map' and depth + 1 > self.max_depth)
+
+    def charge(self, size: int) -> None:
+        if not self.searching:
+            self.remaining -= size
+
+
+def _skip_json_value(events, event: str) -> int:
+    """略過一個值（start 事件已讀取），回傳其直接子項數量"""
+    if event not in ('start_map', 'start_array'):
+        return 0
+    nesting, count = 1, 0
+    while nesting:
+        event, _ = next(events)
+        if nesting == 1 and event not in ('end_map', 'end_array', 'map_key'):
+            count += 1
+        if event in ('start_map', 'start_array'):
+            nesting += 1
+        elif event in ('end_map', 'end_array'):
+            nesting -= 1
+    return count
+
+
+def _read_json_value(events, event: str, value, depth: int, p: _StructureProjection, frames: list[dict]):
+    """
+    從 ijson 事件串流讀出一個值並套用 projection
+    frames 是目前所在的物件；搜尋 subtree_root 時，只要祖先都已確定不是目標，完成的子節點就直接丟棄
+    """
+    if event == 'start_map':
+        node, frame = {}, {'maybe_root': p.searching}
+        frames.append(frame)
+        while True:
+            event, key = next(events)
+            if event == 'end_map':
+                break
+            event, value = next(events)
+            if not p.keep_key(key, event):
+                _skip_json_value(events, event)
+                continue
+            if p.exhausted:
+                skipped = _skip_json_value(events, event)
+                if event == 'start_array' and skipped:
+                    node[key] = {'$truncated': skipped}
+                continue
+            node[key] = _read_json_value(events, event, value, depth, p, frames)
+            p.charge(len(key) + 4)
+            if p.searching and key == 'uuid':
+                frame['maybe_root'] = node[key] == p.subtree_root
+        frames.pop()
+        if p.searching and node.get('uuid') == p.subtree_root:
+            raise _SubtreeFound(node)
+        return node
+
+    if event == 'start_array':
+        items = []
+        event, value = next(events)
+        if event != 'end_array' and p.truncate_children(depth, event):
+            _skip_json_value(events, event)
+            return {'$truncated': 1 + _skip_json_value(events, 'start_array')}
+        while event != 'end_array':
+            if p.exhausted:
+                _skip_json_value(events, event)
+                items.append({'$truncated': 1 + _skip_json_value(events, 'start_array')})
+                break
+            item = _read_json_value(events, event, value, depth + 1, p, frames)
+            if not p.searching or any(f['maybe_root'] for f in frames):
+                items.append(item)
+            event, value = next(events)
+        return items
+
+    p.charge(len(str(value)) + 2)
+    return value
+
+
+def _limit_tree(value, p: _StructureProjection, depth: int = 0):
+    """在記憶體中套用與事件走訪相同的欄位 / 深度 / 大小規則"""
+    if isinstance(value, dict):
+        node = {}
+        for key, child in value.items():
+            if not p.keep_key(key, 'start_array' if isinstance(child, list) else 'value'):
+                continue
+            if p.exhausted:
+                if isinstance(child, list) and child:
+                    node[key] = {'$truncated': len(child)}
+                continue
+            node[key] = _limit_tree(child, p, depth)
+            p.charge(len(key) + 4)
+        return node
+    if isinstance(value, list):
+        if value and p.truncate_children(depth, 'start_map' if isinstance(value[0], dict) else 'scalar'):
+            return {'$truncated': len(value)}
+        items = []
+        for index, item in enumerate(value):
+            if p.exhausted:
+                items.append({'$truncated': len(value) - index})
+                break
+            items.append(_limit_tree(item, p, depth + 1))
+        return items
+    p.charge(len(str(value)) + 2)
+    return value
+
+
+def _find_subtree(value, uuid: str) -> Optional[dict]:
+    stack = [value]
+    while stack:
+        current = stack.pop()
+        if isinstance(current, dict):
+            if current.get('uuid') == uuid:
+                return current
+            stack.extend(current.values())
+        elif isinstance(current, list):
+            stack.extend(current)
+    return None
+
+
+def _project_structure_body(body: bytes, p: _StructureProjection) -> str:
+    """
+    不大的回應直接用 orjson 解析後在記憶體中套用 projection，比逐事件走訪快一個數量級；
+    超過 PROJECTION_IN_MEMORY_MAX_BYTES 才走 ijson 事件，避免建出巨大的物件樹
+    """
+    if len(body) > PROJECTION_IN_MEMORY_MAX_BYTES:
+        return _project_structure(ijson.basic_parse(body, use_float=True), p)
+    tree = orjson.loads(body)
+    if p.subtree_root is not None:
+        tree = _find_subtree(tree, p.subtree_root)
+        if tree is None:
+            return _json_dumps({'error': f"找不到 uuid 為 {p.subtree_root} 的節點"})
+        p.searching = False
+    return _json_dumps(_limit_tree(tree, p))
+
+
+async def _read_structure_response(resp: aiohttp.ClientResponse, p: _StructureProjection) -> str:
+    """沒有要求 projection 或上游不是成功的 JSON 回應時，照原樣回傳"""
+    if not p.requested or resp.status != 200 or resp.content_type != 'application/json':
+        return await _read_text(resp)
+    if _fits_in_memory(resp, PROJECTION_IN_MEMORY_MAX_BYTES):
+        return _project_structure_body(await resp.read(), p)
+    return await _parse_in_thread(resp, lambda reader: _project_structure(ijson.basic_parse(reader, use_float=True), p))
+
+
+def _project_structure_text(text: str, p: _StructureProjection) -> str:
+    """對已在記憶體中的回應（例如快取）套用 projection"""
+    if not p.requested:
+        return text
+    return _project_structure_body(text.encode(), p)
+
+
+def _project_structure(events, p: _StructureProjection) -> str:
+    # 以同步方式走訪 ijson C backend 的事件，逐事件 await 的成本遠高於解析本身
+    try:
+        event, value = next(events)
+        result = _read_json_value(events, event, value, 0, p, [])
+    except _SubtreeFound as found:
+        p.searching = False
+        result = _limit_tree(found.node, p)
+    else:
+        if p.searching:
+            return _json_dumps({'error': f"找不到 uuid 為 {p.subtree_root} 的節點"})
+    return _json_dumps(result)
+
+
+# 網站結構讀取快取：以租戶（store_uuid + domain）區分，寫入操作精準失效
+# 快取在 process 記憶體中，寫入只失效本機的項目；SERVER_REPLICAS > 1 時同一個 agent 的下一次讀取可能落到別的 pod，
+# 為了讓讀取看得到自己的寫入，預設停用（明確設定 SITE_CACHE_TTL 代表接受最多 TTL 秒的舊資料）
+SERVER_REPLICAS = int(os.environ.get('SERVER_REPLICAS', '1'))
+SITE_CACHE_TTL = float(os.environ.get('SITE_CACHE_TTL', '30' if SERVER_REPLICAS <= 1 else '0'))  # 0 代表停用
+SITE_CACHE_MAX_ENTRIES = int(os.environ.get('SITE_CACHE_MAX_ENTRIES', '1024'))
+SITE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get('SITE_CACHE_MAX_ENTRY_BYTES', str(2 * 1024 * 1024)))
+
+_UUID_VALUE_PATTERN = re.compile(r'"\w*uuid"\s*:\s*"([^"]+)"')
+
+
+class _SiteCache:
+    """
+    list_all_webpages / get_brief_webpage_structure 的 read-through 快取（TTL + LRU）
+    每筆結構記錄其中出現的所有 uuid，元素 / 網頁寫入時只失效包含相關 uuid 的項目；
+    找不到任何包含該 uuid 的項目時，保守地失效該租戶所有結構
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple, dict] = OrderedDict()
+        self._generations: dict[tuple, int] = {}
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'invalidations': 0, 'evictions': 0}
+
+    @staticmethod
+    def tenant(config: dict) -> tuple:
+        return (config['store_uuid'], config['domain'])
+
+    def generation(self, config: dict) -> int:
+        return self._generations.get(self.tenant(config), 0)
+
+    def get(self, config: dict, key: tuple) -> Optional[str]:
+        if self.ttl <= 0:
+            return None
+        full_key = (self.tenant(config), *key)
+        entry = self._entries.get(full_key)
+        if entry is None or entry['expires_at'] <= time.monotonic():
+            if entry is not None:
+                del self._entries[full_key]
+            self.stats['misses'] += 1
+            return None
+        self._entries.move_to_end(full_key)
+        self.stats['hits'] += 1
+        return entry['text']
+
+    def put(self, config: dict, key: tuple, text: str, generation: int) -> None:
+        """generation 與讀取開始時不同，代表期間有寫入，這份結果可能是舊的，不存"""
+        if self.ttl <= 0 or len(text) > SITE_CACHE_MAX_ENTRY_BYTES or generation != self.generation(config):
+            return
+        full_key = (self.tenant(config), *key)
+        self._entries[full_key] = {
+            'text': text,
+            'ids': frozenset(_UUID_VALUE_PATTERN.findall(text)),
+            'expires_at': time.monotonic() + self.ttl,
+        }
+        self._entries.move_to_end(full_key)
+        self.stats['stores'] += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def invalidate(self, config: dict, ids=(), webpages: bool = False) -> None:
+        """
+        ids：受影響的元素 / relation / 網頁 uuid；webpages=True 時一併失效網頁列表
+        寫入請求即使失敗也可能已在後端生效，所以呼叫端在 finally 中呼叫
+        """
+        tenant = self.tenant(config)
+        self._generations[tenant] = self._generations.get(tenant, 0) + 1
+        ids = {i for i in ids if i}
+        structures = [k for k in self._entries if k[0] == tenant and k[1] == 'structure']
+        affected = [k for k in structures if ids & self._entries[k]['ids']]
+        if ids and not affected:
+            affected = structures
+        if webpages:
+            affected += [k for k in self._entries if k[0] == tenant and k[1] == 'webpages']
+        for k in affected:
+            del self._entries[k]
+        self.stats['invalidations'] += len(affected)
+
+
+_site_cache = _SiteCache(SITE_CACHE_TTL, SITE_CACHE_MAX_ENTRIES)
+
+
+# 結構 delta：記住每個租戶 / 網頁最近回傳版本中各節點的 hash，之後帶 since 只回傳新增、刪除與變更的節點
+STRUCTURE_DELTA_TTL = float(os.environ.get('STRUCTURE_DELTA_TTL', '1800'))
+STRUCTURE_DELTA_MAX_VERSIONS = int(os.environ.get('STRUCTURE_DELTA_MAX_VERSIONS', '1024'))
+
+
+def _is_node_list(value) -> bool:
+    return isinstance(value, list) and bool(value) and all(isinstance(item, dict) for item in value)
+
+
+def _flatten_structure(value, fields: Optional[set[str]]) -> dict[str, dict]:
+    """
+    把結構樹攤平成 uuid -> 節點本身的欄位（不含子節點），子節點陣列只保留 uuid 清單，並記錄 parent_uuid
+    沒有 uuid 的外層物件 / 陣列直接穿過
+    """
+    nodes: dict[str, dict] = {}
+    stack = [(value, None)]
+    while stack:
+        current, parent = stack.pop()
+        if isinstance(current, list):
+            stack.extend((item, parent) for item in reversed(current))
+            continue
+        if not isinstance(current, dict):
+            continue
+        uuid = current.get('uuid')
+        if not isinstance(uuid, str):
+            stack.extend((child, parent) for child in reversed(list(current.values())))
+            continue
+        record = {'parent_uuid': parent}
+        for key, child in current.items():
+            if _is_node_list(child):
+                record[key] = [item.get('uuid') for item in child]
+                stack.extend((item, uuid) for item in reversed(child))
+            elif fields is None or key in fields:
+                record[key] = child
+        nodes[uuid] = record
+    return nodes
+
+
+def _node_hash(record: dict) -> bytes:
+    return hashlib.blake2b(orjson.dumps(record, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS), digest_size=8).digest()
+
+
+class _StructureVersions:
+    """回傳過的結構版本（uuid -> 節點 hash），以 (租戶, 網頁, projection, version) 為 key，TTL + LRU"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple, dict] = OrderedDict()
+        self.stats = {'full': 0, 'deltas': 0, 'unchanged': 0, 'expired': 0}
+
+    def get(self, key: tuple) -> Optional[dict[str, bytes]]:
+        entry = self._entries.get(key)
+        if entry is None or entry['expires_at'] <= time.monotonic():
+            self._entries.pop(key, None)
+            return None
+        self._entries.move_to_end(key)
+        return entry['hashes']
+
+    def put(self, key: tuple, hashes: dict[str, bytes]) -> None:
+        self._entries[key] = {'hashes': hashes, 'expires_at': time.monotonic() + self.ttl}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+_structure_versions = _StructureVersions(STRUCTURE_DELTA_TTL, STRUCTURE_DELTA_MAX_VERSIONS)
+
+
+def _structure_delta(config: dict, page: tuple, text: str, p: _StructureProjection, since: Optional[str]) -> str:
+    """
+    沒有 since 或 since 已過期（TTL、LRU、或請求落在別的 pod）時回傳完整結構與 version；
+    否則只回傳與 since 版本相比新增、變更的節點（攤平，子節點以 uuid 清單表示）與刪除的 uuid
+    """
+    tree = orjson.loads(text)
+    if p.subtree_root is not None:
+        tree = _find_subtree(tree, p.subtree_root)
+    nodes = _flatten_structure(tree, p.fields)
+    hashes = {uuid: _node_hash(record) for uuid, record in nodes.items()}
+    version = hashlib.blake2b(b''.join(uuid.encode() + h for uuid, h in sorted(hashes.items())), digest_size=8).hexdigest()
+    scope = (_SiteCache.tenant(config), *page, tuple(sorted(p.fields or ())), p.subtree_root)
+    previous = _structure_versions.get((*scope, since)) if since else None
+    _structure_versions.put((*scope, version), hashes)
+
+    if previous is None:
+        if since:
+            _structure_versions.stats['expired'] += 1
+        _structure_versions.stats['full'] += 1
+        return _json_dumps({
+            'version': version,
+            'full': True,
+            'structure': orjson.Fragment(_project_structure_text(text, p) if p.requested else text),
+        })
+    if since == version:
+        _structure_versions.stats['unchanged'] += 1
+        return _json_dumps({'version': version, 'since': since, 'unchanged': True})
+    _structure_versions.stats['deltas'] += 1
+    return _json_dumps({
+        'version': version,
+        'since': since,
+        'added': [{'uuid': uuid, **record} for uuid, record in nodes.items() if uuid not in previous],
+        'changed': [
+            {'uuid': uuid, **record}
+            for uuid, record in nodes.items()
+            if uuid in previous and previous[uuid] != hashes[uuid]
+        ],
+        'removed': [uuid for uuid in previous if uuid not in hashes],
+    })
+
+
+# 元素索引：從結構讀取結果建立每個租戶的 uuid -> 節點索引，另以 type / tag_name / name 建次要索引，
+# 讓 agent 不必拉整棵結構逐一掃描；元素寫入 tool 成功時就地更新，無法確定結果時丟掉受影響的來源
+ELEMENT_INDEX_TTL = float(os.environ.get('ELEMENT_INDEX_TTL', '600'))  # 來源超過這段時間未重新讀取就視為過期
+ELEMENT_INDEX_MAX_TENANTS = int(os.environ.get('ELEMENT_INDEX_MAX_TENANTS', '256'))
+
+_INDEXED_FIELDS = ('relation_uuid', 'name', 'tag_name', 'type')
+
+
+class _TenantElementIndex:
+    def __init__(self):
+        self.nodes: dict[str, dict] = {}
+        self.by_relation: dict[str, str] = {}
+        self.by_type: dict[Optional[str], set[str]] = {}
+        self.by_tag: dict[str, set[str]] = {}
+        self.by_name: dict[str, set[str]] = {}
+        # 來源（page:<name> / element:<uuid>）-> raw（尚未解析的回應）、fingerprint、讀取時間、所屬節點
+        self.sources: dict[str, dict] = {}
+
+    def _secondary(self, node: dict):
+        return (
+            (self.by_type, node.get('type')),
+            (self.by_tag, (node.get('tag_name') or '').lower()),
+            (self.by_name, (node.get('name') or '').lower()),
+        )
+
+    def add(self, node: dict) -> None:
+        self.discard(node['uuid'], detach=False)
+        self.nodes[node['uuid']] = node
+        if node.get('relation_uuid'):
+            self.by_relation[node['relation_uuid']] = node['uuid']
+        for index, key in self._secondary(node):
+            index.setdefault(key, set()).add(node['uuid'])
+        self.sources[node['source']]['nodes'].add(node['uuid'])
+
+    def discard(self, uuid: str, detach: bool = True) -> Optional[dict]:
+        node = self.nodes.pop(uuid, None)
+        if node is None:
+            return None
+        if self.by_relation.get(node.get('relation_uuid')) == uuid:
+            del self.by_relation[node['relation_uuid']]
+        for index, key in self._secondary(node):
+            members = index.get(key)
+            if members is not None:
+                members.discard(uuid)
+                if not members:
+                    del index[key]
+        source = self.sources.get(node['source'])
+        if source is not None:
+            source['nodes'].discard(uuid)
+        if detach:
+            parent = self.nodes.get(node['parent_uuid'])
+            if parent is not None and uuid in parent['children']:
+                parent['children'].remove(uuid)
+        return node
+
+    def discard_subtree(self, uuid: str) -> None:
+        stack = [uuid]
+        while stack:
+            node = self.discard(stack.pop())
+            if node is not None:
+                stack.extend(node['children'])
+
+    def drop_source(self, source: str) -> None:
+        entry = self.sources.pop(source, None)
+        if entry is None:
+            return
+        for uuid in list(entry['nodes']):
+            if self.nodes.get(uuid, {}).get('source') == source:
+                self.discard(uuid, detach=False)
+
+    def ingest(self, source: str, entry: dict) -> None:
+        raw = entry.pop('raw')
+        for uuid in list(entry['nodes']):
+            if self.nodes.get(uuid, {}).get('source') == source:
+                self.discard(uuid, detach=False)
+        entry['nodes'] = set()
+        stack = [(orjson.loads(raw), None, None)]
+        while stack:
+            current, parent, siblings = stack.pop()
+            if isinstance(current, list):
+                stack.extend((item, parent, siblings) for item in reversed(current))
+                continue
+            if not isinstance(current, dict):
+                continue
+            uuid = current.get('uuid')
+            if not isinstance(uuid, str):
+                stack.extend((child, parent, siblings) for child in reversed(list(current.values())))
+                continue
+            node = {'uuid': uuid, **{k: current.get(k) for k in _INDEXED_FIELDS}, 'parent_uuid': parent, 'source': source, 'children': []}
+            existing = self.nodes.get(uuid)
+            if existing is not None and existing['source'] != source and existing['source'].startswith('page:'):
+                # 元素詳細結構與網頁結構重疊時，節點仍歸屬網頁，只更新欄位
+                node.update(parent_uuid=existing['parent_uuid'], source=existing['source'], children=existing['children'])
+            if siblings is not None:
+                siblings.append(uuid)
+            self.add(node)
+            children = node['children'] if node['source'] == source else []
+            for child in current.values():
+                if _is_node_list(child):
+                    stack.extend((item, uuid, children) for item in reversed(child))
+
+    def resolve(self, ref: Optional[str]) -> Optional[dict]:
+        """ref 可以是元素 uuid 或 relation uuid"""
+        if not ref:
+            return None
+        return self.nodes.get(ref) or self.nodes.get(self.by_relation.get(ref))
+
+    def sources_with(self, refs) -> set[str]:
+        return {node['source'] for node in map(self.resolve, refs) if node is not None}
+
+
+class _ElementIndex:
+    def __init__(self, ttl: float, max_tenants: int):
+        self.ttl = ttl
+        self.max_tenants = max_tenants
+        self._tenants: OrderedDict[tuple, _TenantElementIndex] = OrderedDict()
+        self.stats = {'ingested': 0, 'queries': 0, 'incremental': 0, 'dropped': 0}
+
+    def tenant(self, config: dict, create: bool = False) -> Optional[_TenantElementIndex]:
+        key = _SiteCache.tenant(config)
+        index = self._tenants.get(key)
+        if index is None and create:
+            index = self._tenants[key] = _TenantElementIndex()
+            while len(self._tenants) > self.max_tenants:
+                self._tenants.popitem(last=False)
+        if index is not None:
+            self._tenants.move_to_end(key)
+        return index
+
+    def offer(self, config: dict, source: str, raw) -> None:
+        """
+        記下一份完整的結構回應，查詢時才解析（讀取路徑只多一次 dict 寫入）
+        同一份快取內容重複讀取時 fingerprint 相同（str / bytes 的 hash 會快取在物件上），不重複解析
+        """
+        index = self.tenant(config, create=True)
+        fingerprint = (len(raw), hash(raw))
+        entry = index.sources.get(source)
+        if entry is not None and entry['fingerprint'] == fingerprint:
+            return
+        index.sources[source] = {
+            'raw': raw,
+            'fingerprint': fingerprint,
+            'read_at': time.monotonic(),
+            'nodes': entry['nodes'] if entry is not None else set(),
+        }
+
+    def materialize(self, config: dict) -> Optional[_TenantElementIndex]:
+        """
+        解析還沒解析的來源並丟掉過期的來源
+        寫入 hook 也先呼叫這裡，讓還沒解析的來源一樣能就地更新或丟棄，不會在查詢時還原成寫入前的結構
+        """
+        index = self.tenant(config)
+        if index is None:
+            return None
+        now = time.monotonic()
+        for source, entry in list(index.sources.items()):
+            if entry['read_at'] + self.ttl <= now:
+                index.drop_source(source)
+                self.stats['dropped'] += 1
+            elif 'raw' in entry:
+                try:
+                    index.ingest(source, entry)
+                    self.stats['ingested'] += 1
+                except orjson.JSONDecodeError:
+                    index.drop_source(source)
+        return index
+
+    def _invalidate(self, index: _TenantElementIndex, refs) -> None:
+        for source in index.sources_with(refs):
+            index.drop_source(source)
+            self.stats['dropped'] += 1
+
+    def _insert(self, index: _TenantElementIndex, node: dict, target_webpage_uuid, target_relation_uuid, relative_position) -> bool:
+        """依寫入 tool 的目標參數放到索引中的位置；找不到參考節點時回傳 False"""
+        reference = index.resolve(target_relation_uuid)
+        if reference is not None and relative_position in ('before', 'after'):
+            parent = index.nodes.get(reference['parent_uuid'])
+            if parent is None:
+                return False
+            siblings = parent['children']
+            position = siblings.index(reference['uuid']) if reference['uuid'] in siblings else len(siblings) - 1
+            siblings.insert(position + (relative_position == 'after'), node['uuid'])
+        elif reference is not None and relative_position == 'in':
+            parent = reference
+            parent['children'].append(node['uuid'])
+        else:
+            # 放到網頁 head / body 時不知道在樹中的確切位置
+            return False
+        node['parent_uuid'] = parent['uuid']
+        node['source'] = parent['source']
+        return True
+
+    def element_created(self, config: dict, ok: bool, response: Optional[str], fields: dict, target_webpage_uuid, target_relation_uuid, relative_position) -> None:
+        index = self.materialize(config)
+        if index is None:
+            return
+        created = None
+        if ok and response:
+            with contextlib.suppress(orjson.JSONDecodeError):
+                created = orjson.loads(response)
+        if isinstance(created, dict) and isinstance(created.get('uuid'), str):
+            node = {
+                'uuid': created['uuid'],
+                **{k: fields.get(k) for k in _INDEXED_FIELDS},
+                'relation_uuid': created.get('relation_uuid'),
+                'children': [],
+            }
+            if self._insert(index, node, target_webpage_uuid, target_relation_uuid, relative_position):
+                index.add(node)
+                self.stats['incremental'] += 1
+                return
+        self._invalidate(index, [target_webpage_uuid, target_relation_uuid])
+
+    def element_updated(self, config: dict, ok: bool, element_uuid: str, fields: dict) -> None:
+        index = self.materialize(config)
+        node = index.resolve(element_uuid) if index is not None else None
+        if node is None:
+            return
+        if not ok:
+            self._invalidate(index, [element_uuid])
+            return
+        index.add({**index.discard(node['uuid'], detach=False), **{k: v for k, v in fields.items() if k in _INDEXED_FIELDS}})
+        self.stats['incremental'] += 1
+
+    def element_removed(self, config: dict, ok: bool, relation_uuid: str) -> None:
+        index = self.materialize(config)
+        node = index.resolve(relation_uuid) if index is not None else None
+        if node is None:
+            return
+        if not ok:
+            self._invalidate(index, [relation_uuid])
+            return
+        index.discard_subtree(node['uuid'])
+        self.stats['incremental'] += 1
+
+    def element_moved(self, config: dict, ok: bool, relation_uuid: str, target_webpage_uuid, target_relation_uuid, relative_position) -> None:
+        index = self.materialize(config)
+        if index is None:
+            return
+        node = index.resolve(relation_uuid)
+        if ok and node is not None:
+            previous_parent = index.nodes.get(node['parent_uuid'])
+            if previous_parent is not None and node['uuid'] in previous_parent['children']:
+                previous_parent['children'].remove(node['uuid'])
+            source = node['source']
+            if self._insert(index, node, target_webpage_uuid, target_relation_uuid, relative_position):
+                # 整個子樹改屬新父節點的來源
+                node['source'], stack = source, [node['uuid']]
+                target_source = index.nodes[node['parent_uuid']]['source']
+                while stack:
+                    moved = index.nodes.get(stack.pop())
+                    if moved is None:
+                        continue
+                    index.sources[moved['source']]['nodes'].discard(moved['uuid'])
+                    moved['source'] = target_source
+                    index.sources[target_source]['nodes'].add(moved['uuid'])
+                    stack.extend(moved['children'])
+                self.stats['incremental'] += 1
+                return
+        self._invalidate(index, [relation_uuid, target_webpage_uuid, target_relation_uuid])
+
+    def invalidate(self, config: dict, refs) -> None:
+        """網頁層級的寫入（複製 / 鏡像、刪除網頁等）無法就地更新，丟掉含有相關 uuid 的來源"""
+        index = self.materialize(config)
+        if index is not None:
+            self._invalidate(index, refs)
+
+
+_element_index = _ElementIndex(ELEMENT_INDEX_TTL, ELEMENT_INDEX_MAX_TENANTS)
+
+
+def _match_step(node: dict, step: str) -> bool:
+    step = step.lower()
+    return step == '*' or any((node.get(k) or '').lower() == step for k in ('name', 'type', 'tag_name'))
+
+
+def _match_path(index: _TenantElementIndex, node: dict, steps: list[str]) -> bool:
+    """
+    由右往左比對類似 CSS 的路徑，例如 "header > cart_button"、"body ck_editor"：
+    空白代表任意層的祖先，> 代表直接父節點；每一段比對 name / type / tag_name（不分大小寫），* 代表任意節點
+    """
+    if not steps:
+        return True
+    if steps[-1] == '>':
+        parent = index.nodes.get(node['parent_uuid'])
+        return parent is not None and _match_step(parent, steps[-2]) and _match_path(index, parent, steps[:-2])
+    ancestor = index.nodes.get(node['parent_uuid'])
+    while ancestor is not None:
+        if _match_step(ancestor, steps[-1]) and _match_path(index, ancestor, steps[:-1]):
+            return True
+        ancestor = index.nodes.get(ancestor['parent_uuid'])
+    return False
+
+
+def _node_path(index: _TenantElementIndex, node: dict) -> str:
+    names = []
+    while node is not None:
+        names.append(node.get('name') or node.get('tag_name') or node['uuid'])
+        node = index.nodes.get(node['parent_uuid'])
+    return ' > '.join(reversed(names))
+
+
+# 素材列表：上游 store_file/list 解析後的快照存在記憶體，翻頁時用 cursor 取同一份快照
+MEDIA_PAGE_SIZE = int(os.environ.get('MEDIA_PAGE_SIZE', '50'))
+MEDIA_SNAPSHOT_TTL = float(os.environ.get('MEDIA_SNAPSHOT_TTL', '300'))
+MEDIA_SNAPSHOT_MAX_ENTRIES = int(os.environ.get('MEDIA_SNAPSHOT_MAX_ENTRIES', '64'))
+
+# 上游列表可能回傳頂層陣列或分頁包裝 {"results": [...], "next": ...}
+# 不超過 LIST_IN_MEMORY_MAX_BYTES 的回應以 orjson 一次解析，其餘逐筆串流解析，不保留整份原始回應
+LIST_IN_MEMORY_MAX_BYTES = int(os.environ.get('LIST_IN_MEMORY_MAX_BYTES', str(4 * 1024 * 1024)))
+_LIST_ITEM_KEYS = ('results', 'data')
+_LIST_ITEM_PREFIXES = ('item', 'results.item', 'data.item')
+_MEDIA_COMPACT_FIELDS = ('id', 'uuid', 'url', 'width', 'height')
+
+MediaLimit = Annotated[
+    int,
+    Field(ge=1, le=500, description="每頁筆數"),
+]
+MediaCursor = Annotated[
+    Optional[str],
+    Field(description="上一頁回傳的 next_cursor；篩選條件需與上一頁相同"),
+]
+MediaFieldsMode = Annotated[
+    Literal['full', 'compact'],
+    Field(description="compact 只回傳 id / url / 寬高"),
+]
+
+
+def _parse_json_page(source) -> tuple[list[dict], Optional[str]]:
+    """以 ijson 逐筆組出列表中的物件，同時取出分頁包裝的 next"""
+    items, builder, next_url = [], None, None
+    for prefix, event, value in ijson.parse(source, use_float=True):
+        if builder is None:
+            if event == 'start_map' and prefix in _LIST_ITEM_PREFIXES:
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            elif prefix == 'next' and event == 'string':
+                next_url = value
+            continue
+        builder.event(event, value)
+        if event == 'end_map' and prefix in _LIST_ITEM_PREFIXES:
+            items.append(builder.value)
+            builder = None
+    return items, next_url
+
+
+async def _read_json_page(resp) -> tuple[list[dict], Optional[str]]:
+    """讀出上游列表中的物件與下一頁的 next（沒有分頁時為 None）"""
+    if not _fits_in_memory(resp, LIST_IN_MEMORY_MAX_BYTES):
+        return await _parse_in_thread(resp, _parse_json_page)
+    data = orjson.loads(await resp.read())
+    next_url = data.get('next') if isinstance(data, dict) else None
+    return _json_items(data), next_url if isinstance(next_url, str) else None
+
+
+async def _read_json_items(resp) -> list[dict]:
+    items, _ = await _read_json_page(resp)
+    return items
+
+
+def _json_items(data) -> list[dict]:
+    """上游列表可能是陣列，或放在 results / data 欄位中"""
+    if isinstance(data, dict):
+        data = next((data[key] for key in _LIST_ITEM_KEYS if isinstance(data.get(key), list)), [])
+    return [item for item in data if isinstance(item, dict)]
+
+
+class _MediaFilter(BaseModel):
+    name_contains: Optional[str] = None
+    min_size: Optional[int] = None
+    max_size: Optional[int] = None
+    created_after: Optional[str] = None
+    created_before: Optional[str] = None
+    tags: Optional[list[str]] = None
+
+    def signature(self) -> str:
+        return hashlib.sha256(self.model_dump_json().encode()).hexdigest()[:12]
+
+    def match(self, item: dict) -> bool:
+        if self.name_contains:
+            name = item.get('name') or item.get('filename') or ''
+            if self.name_contains.lower() not in str(name).lower():
+                return False
+        if self.min_size is not None or self.max_size is not None:
+            # 上游的 size 可能是字串或小數，無法轉成數字的視為不符合
+            try:
+                size = float(item.get('size'))
+            except (TypeError, ValueError):
+                return False
+            if math.isnan(size):
+                return False
+            if self.min_size is not None and size < self.min_size:
+                return False
+            if self.max_size is not None and size > self.max_size:
+                return False
+        # ISO 8601 字串可直接依字典序比較，只給日期時等同當天 00:00
+        created = str(item.get('created_at') or '')
+        if self.created_after and created < self.created_after:
+            return False
+        if self.created_before and (not created or created >= self.created_before):
+            return False
+        if self.tags:
+            item_tags = {t.get('name') if isinstance(t, dict) else t for t in item.get('tags') or ()}
+            if not set(self.tags) <= item_tags:
+                return False
+        return True
+
+
+class _MediaSnapshots:
+    """
+    每個租戶 / media_type 一份素材快照（TTL + LRU）
+    cursor 記錄快照 id 與位移，翻頁不必重抓整份列表；快照過期時重抓並從原位移繼續
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple, dict] = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, config: dict, media_type: str, snapshot_id: Optional[str]) -> Optional[dict]:
+        key = (_SiteCache.tenant(config), media_type)
+        entry = self._entries.get(key)
+        if entry is None or entry['expires_at'] <= time.monotonic() or (snapshot_id and entry['id'] != snapshot_id):
+            self.stats['misses'] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats['hits'] += 1
+        return entry
+
+    def put(self, config: dict, media_type: str, items: list[dict]) -> dict:
+        key = (_SiteCache.tenant(config), media_type)
+        entry = {'id': os.urandom(6).hex(), 'items': items, 'expires_at': time.monotonic() + self.ttl}
+        if self.ttl > 0:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+        return entry
+
+    def invalidate(self, config: dict) -> None:
+        tenant = _SiteCache.tenant(config)
+        for key in [k for k in self._entries if k[0] == tenant]:
+            del self._entries[key]
+
+
+_media_snapshots = _MediaSnapshots(MEDIA_SNAPSHOT_TTL, MEDIA_SNAPSHOT_MAX_ENTRIES)
+
+
+def _encode_media_cursor(snapshot_id: str, offset: int, media_filter: _MediaFilter) -> str:
+    raw = json.dumps({'s': snapshot_id, 'o': offset, 'f': media_filter.signature()}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def _decode_media_cursor(cursor: str, media_filter: _MediaFilter) -> tuple[str, int]:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        snapshot_id, offset, signature = data['s'], int(data['o']), data['f']
+    except (ValueError, KeyError, TypeError):
+        raise ToolError("cursor 格式錯誤，請從第一頁重新查詢") from None
+    if signature != media_filter.signature():
+        raise ToolError("cursor 與目前的篩選條件不符，請從第一頁重新查詢")
+    return snapshot_id, offset
+
+
 # 创建一个不验证 SSL 证书的上下文
 ssl_context = ssl.create_default_context()
 ssl_context.check_hostname = False
@@ -157,18 +2903,59 @@ async def my_application_create_webpage( webpage_name: str, ) -> str:
     """
     config = get_user_config()
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
+    try:
+        async with _upstream_request(
+            'POST',
             _build_api_url(config, "/api/v1/website/webpage/create/"),
             ssl=ssl_context,
             json={'name': webpage_name},
             headers=_base_headers(config),
         ) as resp:
-            text = await resp.text()
+            text = await _read_text(resp)
             return text
+    finally:
+        _site_cache.invalidate(config, webpages=True)
 
 
 
+async def _create_element(
+    config: dict,
+    element_name: str,
+    element_tag_name: str,
+    element_inner_html: str,
+    element_props: dict,
+    target_webpage_uuid: Optional[str] = None,
+    target_webpage_position: Optional[str] = None,
+    target_parent_relation_uuid: Optional[str] = None,
+    target_relative_position: Optional[str] = None,
+    element_type: Optional[str] = None,
+) -> tuple[int, str]:
+    status, text = None, None
+    try:
+        async with _upstream_request(
+            'POST',
+            _build_api_url(config, f"/api/v1/website/element/r_create/?target_webpage_uuid={target_webpage_uuid}&target_webpage_position={target_webpage_position}&target_element_relation_uuid={target_parent_relation_uuid}&target_relative_position={target_relative_position}"),
+            ssl=ssl_context,
+            json={
+                'name': element_name,
+                'tag_name': element_tag_name,
+                'inner_html': element_inner_html,
+                'props': element_props,
+                'type': element_type,
+            },
+            headers=_base_headers(config),
+        ) as resp:
+            status, text = resp.status, await _read_text(resp)
+            return status, text
+    finally:
+        _site_cache.invalidate(config, ids=[target_webpage_uuid, target_parent_relation_uuid])
+        _element_index.element_created(
+            config, status is not None and status < 400, text,
+            {'name': element_name, 'tag_name': element_tag_name, 'type': element_type},
+            target_webpage_uuid, target_parent_relation_uuid, target_relative_position,
+        )
+
+
 @mcp.tool(output_schema=None)
 async def my_application_create_element(
     element_name: str,
@@ -186,23 +2973,12 @@ async def my_application_create_element(
     如果需要將元素加入網頁的head/body 使用 target_webpage_uuid 以及 target_webpage_position 參數
     如果需要將元素創建相對於目標參考元素 使用 target_parent_relation_uuid 以及 target_relative_position 參數
     """
-    config = get_user_config()
+    _, text = await _create_element(
+        get_user_config(), element_name, element_tag_name, element_inner_html, element_props,
+        target_webpage_uuid, target_webpage_position, target_parent_relation_uuid, target_relative_position, element_type,
+    )
+    return text
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            _build_api_url(config, f"/api/v1/website/element/r_create/?target_webpage_uuid={target_webpage_uuid}&target_webpage_position={target_webpage_position}&target_element_relation_uuid={target_parent_relation_uuid}&target_relative_position={target_relative_position}"),
-            ssl=ssl_context,
-            json={
-                'name': element_name,
-                'tag_name': element_tag_name,
-                'inner_html': element_inner_html,
-                'props': element_props,
-                'type': element_type,
-            },
-            headers=_base_headers(config),
-        ) as resp:
-            text = await resp.text()
-            return text
 
 @mcp.tool(output_schema=None)
 async def my_application_delete_webpage( webpage_uuid: str, ) -> str:
@@ -211,14 +2987,34 @@ async def my_application_delete_webpage( webpage_uuid: str, ) -> str:
     """
     config = get_user_config()
 
-    async with aiohttp.ClientSession() as session:
-        async with session.delete(
+    try:
+        async with _upstream_request(
+            'DELETE',
             _build_api_url(config, f"/api/v1/website/webpage/{webpage_uuid}/delete/"),
             ssl=ssl_context,
             headers=_base_headers(config),
         ) as resp:
-            text = await resp.text()
+            text = await _read_text(resp)
             return text
+    finally:
+        _site_cache.invalidate(config, ids=[webpage_uuid], webpages=True)
+        _element_index.invalidate(config, [webpage_uuid])
+
+
+async def _delete_element(config: dict, parent_relation_uuid: str) -> tuple[int, str]:
+    status = None
+    try:
+        async with _upstream_request(
+            'DELETE',
+            _build_api_url(config, f"/api/v1/website/element/{parent_relation_uuid}/delete/"),
+            ssl=ssl_context,
+            headers=_base_headers(config),
+        ) as resp:
+            status = resp.status
+            return status, await _read_text(resp)
+    finally:
+        _site_cache.invalidate(config, ids=[parent_relation_uuid])
+        _element_index.element_removed(config, status is not None and status < 400, parent_relation_uuid)
 
 
 @mcp.tool(output_schema=None)
@@ -226,16 +3022,8 @@ async def my_application_delete_element( parent_relation_uuid: str, ) -> str:
     """
     在我的應用中移除元素關係
     """
-    config = get_user_config()
-
-    async with aiohttp.ClientSession() as session:
-        async with session.delete(
-            _build_api_url(config, f"/api/v1/website/element/{parent_relation_uuid}/delete/"),
-            ssl=ssl_context,
-            headers=_base_headers(config),
-        ) as resp:
-            text = await resp.text()
-            return text
+    _, text = await _delete_element(get_user_config(), parent_relation_uuid)
+    return text
 
 
 #更新網頁
@@ -258,15 +3046,55 @@ async def my_application_update_webpage(
         body['props'] = webpage_props
     if webpage_data:
         body['data'] = webpage_data
-    async with aiohttp.ClientSession() as session:
-        async with session.put(
+    try:
+        async with _upstream_request(
+            'PUT',
             _build_api_url(config, f"/api/v1/website/webpage/{webpage_uuid}/update/"),
             ssl=ssl_context,
             json=body,
             headers=_base_headers(config),
         ) as resp:
-            text = await resp.text()
+            text = await _read_text(resp)
             return text
+    finally:
+        _site_cache.invalidate(config, ids=[webpage_uuid], webpages=True)
+
+
+async def _update_element(
+    config: dict,
+    element_uuid: str,
+    element_name: Optional[str] = None,
+    element_tag_name: Optional[str] = None,
+    element_inner_html: Optional[str] = None,
+    element_props: Optional[dict] = None,
+    element_type: Optional[str] = None,
+) -> tuple[int, str]:
+    body = {}
+    if element_name:
+        body['name'] = element_name
+    if element_tag_name:
+        body['tag_name'] = element_tag_name
+    if element_inner_html:
+        body['inner_html'] = element_inner_html
+    if element_props:
+        body['props'] = element_props
+    if element_type:
+        body['type'] = element_type
+    status = None
+    try:
+        async with _upstream_request(
+            'PUT',
+            _build_api_url(config, f"/api/v1/website/element/{element_uuid}/update/"),
+            ssl=ssl_context,
+            json=body,
+            headers=_base_headers(config),
+        ) as resp:
+            status = resp.status
+            return status, await _read_text(resp)
+    finally:
+        _site_cache.invalidate(config, ids=[element_uuid])
+        _element_index.element_updated(config, status is not None and status < 400, element_uuid, body)
+
 
 #更新元素
 @mcp.tool(output_schema=None)
@@ -279,52 +3107,256 @@ async def my_application_update_element(
     element_type: ElementType = None,
     ) -> str:
     """
-    在我的應用中更新元素
+    在我的應用中更新元素
+    """
+    _, text = await _update_element(
+        get_user_config(), element_uuid, element_name, element_tag_name, element_inner_html, element_props, element_type,
+    )
+    return text
+
+
+#檢視我的素材
+@mcp.tool(output_schema=None)
+async def my_application_list_my_media_assets(
+    media_type: Literal['image', 'video'],
+    limit: MediaLimit = MEDIA_PAGE_SIZE,
+    cursor: MediaCursor = None,
+    name_contains: Annotated[Optional[str], Field(description="檔名包含此字串（不分大小寫）")] = None,
+    min_size: Annotated[Optional[int], Field(ge=0, description="最小檔案大小（bytes）")] = None,
+    max_size: Annotated[Optional[int], Field(ge=0, description="最大檔案大小（bytes）")] = None,
+    created_after: Annotated[Optional[str], Field(description="建立時間不早於此 ISO 8601 日期 / 時間")] = None,
+    created_before: Annotated[Optional[str], Field(description="建立時間早於此 ISO 8601 日期 / 時間")] = None,
+    tags: Annotated[Optional[list[str]], Field(description="需同時包含這些標籤")] = None,
+    fields: MediaFieldsMode = 'full',
+    ) -> str:
+    """
+    檢視網站可用的素材，分頁回傳 {items, total, next_cursor}
+    next_cursor 不為 null 時，帶入 cursor 參數（其餘篩選條件不變）取得下一頁
     """
     config = get_user_config()
+    media_filter = _MediaFilter(
+        name_contains=name_contains,
+        min_size=min_size,
+        max_size=max_size,
+        created_after=created_after,
+        created_before=created_before,
+        tags=tags,
+    )
+    snapshot_id, offset = _decode_media_cursor(cursor, media_filter) if cursor else (None, 0)
 
-    body = {}
-    if element_name:
-        body['name'] = element_name
-    if element_tag_name:
-        body['tag_name'] = element_tag_name
-    if element_inner_html:
-        body['inner_html'] = element_inner_html
-    if element_props:
-        body['props'] = element_props
-    if element_type:
-        body['type'] = element_type
-    async with aiohttp.ClientSession() as session:
-        async with session.put(
-            _build_api_url(config, f"/api/v1/website/element/{element_uuid}/update/"),
+    snapshot = _media_snapshots.get(config, media_type, snapshot_id)
+    if snapshot is None:
+        # 不 coalesce：共用的回應會整份讀進記憶體，素材多的商店要邊讀邊解析
+        async with _upstream_request(
+            'GET',
+            _build_api_url(config, f"/api/v1/store/{config['store_uuid']}/store_file/list/?is_public=true&media_type={media_type}"),
             ssl=ssl_context,
-            json=body,
             headers=_base_headers(config),
         ) as resp:
-            text = await resp.text()
-            return text
+            # 錯誤回應照原樣回傳
+            if resp.status != 200 or resp.content_type != 'application/json':
+                return await _read_text(resp)
+            snapshot = _media_snapshots.put(config, media_type, await _read_json_items(resp))
+
+    matched = [item for item in snapshot['items'] if media_filter.match(item)]
+    page = matched[offset:offset + limit]
+    if fields == 'compact':
+        page = [{k: item[k] for k in _MEDIA_COMPACT_FIELDS if k in item} for item in page]
+    next_offset = offset + limit
+    return _json_dumps({
+        'items': page,
+        'total': len(matched),
+        'next_cursor': _encode_media_cursor(snapshot['id'], next_offset, media_filter) if next_offset < len(matched) else None,
+    })
+
+
+# 上傳素材：base64 逐段解碼、暫存檔以 mmap 逐段讀取，以 chunked multipart 串流給後端，不整份放進記憶體
+MEDIA_UPLOAD_CHUNK_BYTES = int(os.environ.get('MEDIA_UPLOAD_CHUNK_BYTES', str(1024 * 1024)))
+MEDIA_UPLOAD_MAX_CONCURRENCY = int(os.environ.get('MEDIA_UPLOAD_MAX_CONCURRENCY', '4'))
+MEDIA_STAGING_DIR = os.environ.get('MEDIA_STAGING_DIR')  # 有設定才允許 staged_path，每個商店只能讀 <dir>/<store_uuid>/ 底下的檔案
+
+_BASE64_WHITESPACE = str.maketrans('', '', ' \t\r\n')
+
+
+class MediaUpload(BaseModel):
+    name: str = Field(description="檔名（含副檔名）")
+    content_base64: Optional[str] = Field(None, description="檔案內容的 base64，可含 data:<mime>;base64, 前綴")
+    staged_path: Optional[str] = Field(None, description="server 端暫存目錄中的相對路徑，大型影片請用這個方式")
+    media_type: Optional[Literal['image', 'video']] = Field(None, description="未指定時依 content type 判斷")
+    content_type: Optional[str] = Field(None, description="未指定時依 data URL 或副檔名判斷")
+
+
+async def _base64_chunks(data: str, offset: int, chunk_size: int):
+    """逐段解碼 base64，每次只多佔一個 chunk 的記憶體；中間夾雜的換行 / 空白會略過"""
+    carry = ''
+    step = max(1, chunk_size // 3) * 4
+    for start in range(offset, len(data), step):
+        piece = carry + data[start:start + step].translate(_BASE64_WHITESPACE)
+        usable = len(piece) - len(piece) % 4
+        carry = piece[usable:]
+        if usable:
+            yield base64.b64decode(piece[:usable], validate=True)
+    if carry:
+        raise ValueError("base64 content is truncated")
+
+
+async def _mmap_chunks(path: str, chunk_size: int):
+    """以 mmap 逐段讀取暫存檔，讀過的頁面用 MADV_DONTNEED 釋放，大型影片的 RSS 維持在一個 chunk 左右"""
+    chunk_size = max(mmap.PAGESIZE, chunk_size // mmap.PAGESIZE * mmap.PAGESIZE)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for start in range(0, size, chunk_size):
+                yield mm[start:start + chunk_size]
+                if hasattr(mmap, 'MADV_DONTNEED'):
+                    mm.madvise(mmap.MADV_DONTNEED, start, min(chunk_size, size - start))
+
+
+def _staged_file_path(config: dict, staged_path: str) -> str:
+    if not MEDIA_STAGING_DIR:
+        raise ValueError("staged uploads are not enabled on this server (MEDIA_STAGING_DIR)")
+    root = os.path.realpath(os.path.join(MEDIA_STAGING_DIR, config['store_uuid']))
+    path = os.path.realpath(os.path.join(root, staged_path))
+    if not path.startswith(root + os.sep):
+        raise ValueError(f"staged_path {staged_path!r} is outside the staging directory")
+    if not os.path.isfile(path):
+        raise ValueError(f"staged file {staged_path!r} does not exist")
+    return path
+
+
+async def _upload_media_file(config: dict, upload: MediaUpload) -> dict:
+    if (upload.content_base64 is None) == (upload.staged_path is None):
+        raise ValueError("provide exactly one of content_base64 / staged_path")
+    content_type = upload.content_type
+    if upload.content_base64 is not None:
+        offset = 0
+        if upload.content_base64.startswith('data:'):
+            offset = upload.content_base64.find(',', 0, 256) + 1
+            if offset == 0:
+                raise ValueError("invalid data URL")
+            content_type = content_type or upload.content_base64[5:offset - 1].split(';')[0] or None
+        chunks = _base64_chunks(upload.content_base64, offset, MEDIA_UPLOAD_CHUNK_BYTES)
+    else:
+        chunks = _mmap_chunks(_staged_file_path(config, upload.staged_path), MEDIA_UPLOAD_CHUNK_BYTES)
+    content_type = content_type or mimetypes.guess_type(upload.name)[0] or 'application/octet-stream'
+    media_type = upload.media_type or content_type.split('/')[0]
+    if media_type not in ('image', 'video'):
+        raise ValueError(f"cannot tell whether {upload.name!r} ({content_type}) is an image or a video; set media_type")
+
+    sent = 0
+
+    async def counted():
+        nonlocal sent
+        async for chunk in chunks:
+            sent += len(chunk)
+            yield chunk
+
+    form = aiohttp.FormData(default_to_multipart=True)
+    form.add_field('name', upload.name)
+    form.add_field('media_type', media_type)
+    form.add_field('is_public', 'true')
+    form.add_field('file', counted(), filename=upload.name, content_type=content_type)
+    try:
+        async with _upstream_request(
+            'POST',
+            _build_api_url(config, f"/api/v1/store/{config['store_uuid']}/store_file/create/"),
+            ssl=ssl_context,
+            data=form,
+            headers=_base_headers(config, content_type=None),
+            # 大檔上傳不套用單一請求的總時間上限，整體由 tool 期限控制
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=UPSTREAM_CONNECT_TIMEOUT, sock_read=UPSTREAM_READ_TIMEOUT),
+        ) as resp:
+            status, text = resp.status, await _read_text(resp)
+    except aiohttp.ClientConnectionError as e:
+        # base64 解碼錯誤發生在串流途中，會被 aiohttp 包成連線錯誤
+        if isinstance(e.__cause__, ValueError):
+            raise ValueError(f"invalid base64 content: {e.__cause__}") from None
+        raise
+    finally:
+        await chunks.aclose()
+    try:
+        result = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        result = text
+    return {'status': 'ok' if 200 <= status < 300 else 'error', 'http_status': status, 'bytes': sent, 'result': result}
+
 
-#檢視我的素材
 @mcp.tool(output_schema=None)
-async def my_application_list_my_media_assets(
-    media_type: Literal['image', 'video']
+async def my_application_upload_media(
+    files: Annotated[list[MediaUpload], Field(min_length=1, description="要上傳的檔案，會並行上傳")],
+    max_concurrency: Annotated[Optional[int], Field(ge=1, description="同時上傳的檔案數上限")] = None,
     ) -> str:
     """
-    檢視網站可用的素材
+    上傳圖片 / 影片到網站素材庫，每個檔案提供 content_base64 或 staged_path 其中之一
+    回傳每個檔案的狀態、上傳位元組數與後端回應
     """
     config = get_user_config()
+    semaphore = asyncio.Semaphore(min(max_concurrency or MEDIA_UPLOAD_MAX_CONCURRENCY, MEDIA_UPLOAD_MAX_CONCURRENCY))
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            _build_api_url(config, f"/api/v1/store/{config['store_uuid']}/store_file/list/?is_public=true&media_type={media_type}"),
+    async def upload(upload: MediaUpload) -> dict:
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                report = await _upload_media_file(config, upload)
+            except (ValueError, OSError, aiohttp.ClientError, asyncio.TimeoutError, ToolError) as e:
+                report = {'status': 'error', 'error': f"{type(e).__name__}: {e}"}
+            return {'name': upload.name, **report, 'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)}
+
+    started = time.perf_counter()
+    try:
+        reports = await asyncio.gather(*(upload(f) for f in files))
+    finally:
+        _media_snapshots.invalidate(config)
+    return _json_dumps({
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+        'uploaded': sum(report['status'] == 'ok' for report in reports),
+        'failed': sum(report['status'] != 'ok' for report in reports),
+        'files': reports,
+    })
+
+
+#元素動作
+async def _element_action(
+    config: dict,
+    parent_relation_uuid: str,
+    action: str,
+    target_webpage_uuid: Optional[str] = None,
+    target_webpage_position: Optional[str] = None,
+    target_parent_relation_uuid: Optional[str] = None,
+    target_relative_position: Optional[str] = None,
+    timeout: Optional[aiohttp.ClientTimeout] = None,
+) -> tuple[int, str]:
+    status = None
+    try:
+        async with _upstream_request(
+            'PUT',
+            _build_api_url(config, f"/api/v1/website/element/{parent_relation_uuid}/r_action/{action}/"),
             ssl=ssl_context,
+            json={
+                'target_webpage_uuid': target_webpage_uuid,
+                'target_webpage_position': target_webpage_position,
+                'target_element_relation_uuid': target_parent_relation_uuid,
+                'target_relative_position': target_relative_position,
+            },
             headers=_base_headers(config),
+            **({'timeout': timeout} if timeout is not None else {}),
         ) as resp:
-            text = await resp.text()
-            return text
+            status = resp.status
+            return status, await _read_text(resp)
+    finally:
+        _site_cache.invalidate(config, ids=[parent_relation_uuid, target_webpage_uuid, target_parent_relation_uuid])
+        if action == 'move':
+            _element_index.element_moved(
+                config, status is not None and status < 400, parent_relation_uuid,
+                target_webpage_uuid, target_parent_relation_uuid, target_relative_position,
+            )
+        else:
+            # 複製 / 鏡像產生的新節點 uuid 不在回應中，丟掉目標所在的來源
+            _element_index.invalidate(config, [target_webpage_uuid, target_parent_relation_uuid])
 
 
-#元素動作
 @mcp.tool(output_schema=None)
 async def my_application_action_to_target_element(
     parent_relation_uuid: str,
@@ -333,6 +3365,10 @@ async def my_application_action_to_target_element(
     target_webpage_position: Optional[Literal['head', 'body']] = None,
     target_parent_relation_uuid: Optional[str] = None,
     target_relative_position: Optional[Literal['before', 'after', 'in']] = None,
+    background: Annotated[bool, Field(description=(
+        "改為背景執行並立即回傳 job_id，之後用 my_application_get_job 取得結果；適合大範圍的 clone / mirror。"
+        "工作只存在接受它的 server process，需單一副本部署，查詢落到其他副本時會回錯誤"
+    ))] = False,
     ) -> str:
     """
     在我的應用中 移動/鏡像/克隆 目標元素
@@ -340,85 +3376,498 @@ async def my_application_action_to_target_element(
     如果需要將元素移至相對於目標參考元素 使用 target_parent_relation_uuid 以及 target_relative_position 參數
     """
     config = get_user_config()
+    args = (parent_relation_uuid, action, target_webpage_uuid, target_webpage_position, target_parent_relation_uuid, target_relative_position)
+    if not background:
+        _, text = await _element_action(config, *args)
+        return text
 
-    async with aiohttp.ClientSession() as session:
-        async with session.put(
-            _build_api_url(config, f"/api/v1/website/element/{parent_relation_uuid}/r_action/{action}/"),
-            ssl=ssl_context,
-            json={
-                'target_webpage_uuid': target_webpage_uuid,
-                'target_webpage_position': target_webpage_position,
-                'target_element_relation_uuid': target_parent_relation_uuid,
-                'target_relative_position': target_relative_position,
-            },
-            headers=_base_headers(config),
-        ) as resp:
-            text = await resp.text()
-            return text
+    async def work(job: _Job):
+        job.report(0, 1, f"waiting for backend to {action} the element")
+        # 後端處理大範圍元素時可能很久才回應，整體由 JOB_TIMEOUT 控制
+        status, text = await _element_action(
+            config, *args,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=UPSTREAM_CONNECT_TIMEOUT),
+        )
+        try:
+            result = orjson.loads(text)
+        except orjson.JSONDecodeError:
+            result = text
+        if status >= 400:
+            raise ToolError(f"Backend returned HTTP {status}: {text[:1000]}")
+        job.report(1, 1, 'done')
+        return result
+
+    job = _jobs.submit(_job_owner(), 'element_action', {
+        'parent_relation_uuid': parent_relation_uuid,
+        'action': action,
+        'target_webpage_uuid': target_webpage_uuid,
+        'target_parent_relation_uuid': target_parent_relation_uuid,
+    }, work)
+    return _json_dumps({'job_id': job.id, 'status': job.status, 'poll_with': 'my_application_get_job'})
+
+
+@mcp.tool(output_schema=None)
+async def my_application_get_job(
+    ctx: Context,
+    job_id: str,
+    wait: Annotated[float, Field(ge=0, description=f"工作未結束時最多等待的秒數（上限 {JOB_WAIT_MAX:g}），等待期間以 MCP 進度通知回報進度")] = 0,
+    cancel: Annotated[bool, Field(description="取消工作；已送到後端的操作可能仍會完成")] = False,
+    ) -> str:
+    """
+    查詢背景工作（例如 background=true 的元素動作）的狀態、進度與結果
+    status 為 queued / running / succeeded / failed / cancelled，結束後 result 或 error 保留一段時間（expires_in 秒）
+    工作只存在接受它的 server process（需單一副本部署），由其他副本或重啟後的 process 查詢時會回錯誤
+    """
+    job = _jobs.get(_job_owner(), job_id)
+    if job is None:
+        raise ToolError(f"Unknown or expired job {job_id!r}.")
+    if cancel and _jobs.cancel(job):
+        # 等工作收尾，回傳最終狀態
+        await asyncio.wait([job.task])
+    deadline = time.monotonic() + min(wait, JOB_WAIT_MAX)
+    while not job.done:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        changed = job.changed
+        with contextlib.suppress(TimeoutError):
+            async with asyncio.timeout(remaining):
+                await changed.wait()
+        await ctx.report_progress(job.progress, job.total, job.message or job.status)
+    return _json_dumps(job.snapshot())
+
+
+# 批次元素操作：op -> 對應單一 tool 的實作，回傳 (HTTP 狀態, 回應內容)
+BATCH_MAX_CONCURRENCY = int(os.environ.get('BATCH_MAX_CONCURRENCY', '8'))
+
+_BATCH_ELEMENT_OPERATIONS = {
+    'create': _create_element,
+    'update': _update_element,
+    'delete': _delete_element,
+    'action': _element_action,
+}
+
+
+class BatchElementOperation(BaseModel):
+    id: Optional[str] = Field(default=None, description="此操作的識別名稱，供後續操作以 \"$<id>.<欄位>\" 引用其回傳結果（例如 \"$header.uuid\"）")
+    op: Literal['create', 'update', 'delete', 'action'] = Field(description="create / update / delete / action 分別對應 my_application_create_element / my_application_update_element / my_application_delete_element / my_application_action_to_target_element")
+    args: dict = Field(default_factory=dict, description="對應 tool 的參數")
+    depends_on: list[str] = Field(default_factory=list, description="必須先完成的操作 id；args 中引用到的操作會自動加入")
+
+
+def _batch_references(value) -> set[str]:
+    """找出 args 中所有 "$<id>.<欄位>" 引用的 id"""
+    if isinstance(value, str) and value.startswith('$') and '.' in value:
+        return {value[1:].split('.', 1)[0]}
+    if isinstance(value, dict):
+        return set().union(*(_batch_references(v) for v in value.values()))
+    if isinstance(value, list):
+        return set().union(*(_batch_references(v) for v in value))
+    return set()
+
+
+def _batch_resolve(value, results: dict):
+    """把 "$<id>.<欄位>" 換成前面操作回傳 JSON 中對應的值"""
+    if isinstance(value, str) and value.startswith('$') and '.' in value:
+        ref_id, path = value[1:].split('.', 1)
+        current = results[ref_id]
+        for part in path.split('.'):
+            if isinstance(current, list) and part.isdigit():
+                current = current[int(part)]
+            elif isinstance(current, dict) and part in current:
+                current = current[part]
+            else:
+                raise ValueError(f"無法解析引用 {value}")
+        return current
+    if isinstance(value, dict):
+        return {k: _batch_resolve(v, results) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_batch_resolve(v, results) for v in value]
+    return value
+
+
+@mcp.tool(output_schema=None)
+async def my_application_batch_element_operations(
+    operations: Annotated[
+        list[BatchElementOperation],
+        Field(description="依序排列的元素操作；彼此沒有依賴的操作會並行執行，需要保持先後順序時請用 depends_on 或引用前面操作的結果"),
+    ],
+    max_concurrency: Annotated[Optional[int], Field(ge=1, description="同時執行的操作數上限")] = None,
+    ) -> str:
+    """
+    在我的應用中批次 創建/更新/刪除/移動/鏡像/克隆 元素，一次呼叫完成多個元素操作
+    後面的操作可以用 "$<id>.<欄位>" 引用前面操作的回傳結果，例如在 target_parent_relation_uuid 填入 "$header.relation_uuid"
+    回傳每個操作的狀態、結果與耗時
+    """
+    # 只允許引用排在前面的操作，因此不會有循環依賴
+    seen_ids: dict[str, int] = {}
+    dependencies: list[set[str]] = []
+    for index, operation in enumerate(operations):
+        deps = set(operation.depends_on) | _batch_references(operation.args)
+        unknown = deps - seen_ids.keys()
+        if unknown:
+            raise ValueError(f"operations[{index}] 引用了未定義或排在後面的操作: {sorted(unknown)}")
+        if operation.id is not None:
+            if operation.id in seen_ids:
+                raise ValueError(f"operations[{index}] 的 id 重複: {operation.id}")
+            seen_ids[operation.id] = index
+        dependencies.append(deps)
+
+    config = get_user_config()
+    semaphore = asyncio.Semaphore(min(max_concurrency or BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY))
+    results: dict[str, object] = {}
+    reports: list[dict] = [{} for _ in operations]
+    tasks: list[asyncio.Task] = []
+
+    async def run(index: int, operation: BatchElementOperation) -> bool:
+        report = reports[index]
+        report.update(index=index, id=operation.id, op=operation.op)
+        deps = dependencies[index]
+        if deps:
+            succeeded = await asyncio.gather(*(tasks[seen_ids[d]] for d in deps))
+            if not all(succeeded):
+                report.update(status='skipped', error='依賴的操作失敗')
+                return False
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                args = _batch_resolve(operation.args, results)
+                status, text = await _BATCH_ELEMENT_OPERATIONS[operation.op](config, **args)
+            except Exception as e:
+                report.update(status='error', error=f"{type(e).__name__}: {e}",
+                              elapsed_ms=round((time.perf_counter() - started) * 1000, 1))
+                return False
+            report['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        try:
+            result = orjson.loads(text)
+        except ValueError:
+            result = text
+        if status >= 400:
+            # 後端拒絕的操作算失敗，依賴它的操作會被略過
+            report.update(status='error', http_status=status, error=result)
+            return False
+        if operation.id is not None:
+            results[operation.id] = result
+        report.update(status='ok', result=result)
+        return True
+
+    started = time.perf_counter()
+    for index, operation in enumerate(operations):
+        tasks.append(asyncio.create_task(run(index, operation)))
+    await asyncio.gather(*tasks)
+    return _json_dumps({
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+        'operations': reports,
+    })
 
 
 @mcp.tool(output_schema=None)
-async def my_application_get_detail_element_structure(element_uuid: str, ) -> str:
+async def my_application_get_detail_element_structure(
+    element_uuid: str,
+    fields: StructureFields = None,
+    max_depth: StructureMaxDepth = None,
+    subtree_root: StructureSubtreeRoot = None,
+    max_bytes: StructureMaxBytes = None,
+    ) -> str:
     """
     在我的應用中取得目標元素詳細的JSON格式資料
+    大型元素可用 fields / max_depth / subtree_root / max_bytes 縮小回傳內容
     """
     config = get_user_config()
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            _build_api_url(config, f"/api/v1/website/element/{element_uuid}/agent/retrieve/?detail=true"),
-            ssl=ssl_context,
-            headers=_base_headers(config),
-        ) as resp:
-            text = await resp.text()
-            return text
+    async with _upstream_request(
+        'GET',
+        _build_api_url(config, f"/api/v1/website/element/{element_uuid}/agent/retrieve/?detail=true"),
+        ssl=ssl_context,
+        headers=_base_headers(config),
+    ) as resp:
+        projection = _StructureProjection(fields, max_depth, subtree_root, max_bytes)
+        # 串流解析的大型回應不整份保留，也就不進元素索引（查詢時會重新讀取）
+        if resp.status == 200 and resp.content_type == 'application/json' and (
+            not projection.requested or _fits_in_memory(resp, PROJECTION_IN_MEMORY_MAX_BYTES)
+        ):
+            _element_index.offer(config, f"element:{element_uuid}", await resp.read())
+        return await _read_structure_response(resp, projection)
+
+# 整站快照：取代原本停用的 website/retrieve，在 server 端並行讀取每個網頁的結構
+SNAPSHOT_MAX_CONCURRENCY = int(os.environ.get('SNAPSHOT_MAX_CONCURRENCY', '8'))
+
+
+async def _fetch_page_structure(config: dict, webpage_name: str, level: str, projection: _StructureProjection) -> tuple[int, str]:
+    """brief 與 my_application_get_brief_webpage_structure 共用快取與元素索引；detail 每次向上游讀取"""
+    source = f"page:{webpage_name}"
+    if level == 'brief':
+        cache_key = ('structure', webpage_name, None)
+        text = _site_cache.get(config, cache_key)
+        if text is not None:
+            _element_index.offer(config, source, text)
+            return 200, _project_structure_text(text, projection)
+        generation = _site_cache.generation(config)
+
+    async with _upstream_request(
+        'GET',
+        _build_api_url(config, f"/api/v1/website/webpage/{webpage_name}//agent/retrieve/?detail={'true' if level == 'detail' else 'false'}"),
+        ssl=ssl_context,
+        headers=_base_headers(config),
+    ) as resp:
+        if resp.status != 200 or resp.content_type != 'application/json':
+            return resp.status, await _read_text(resp)
+        body = await resp.read()
+    if level == 'brief':
+        text = _decode_body(resp, body)
+        _site_cache.put(config, cache_key, text, generation)
+        _element_index.offer(config, source, text)
+        return 200, _project_structure_text(text, projection)
+    return 200, _project_structure_body(body, projection) if projection.requested else _decode_body(resp, body)
+
+
+@mcp.tool(output_schema=None)
+async def my_application_get_website_snapshot(
+    ctx: Context,
+    level: Annotated[
+        Literal['brief', 'detail'],
+        Field(description="brief 為精簡結構；detail 含 props、inner_html 等完整內容，回傳量大很多"),
+    ] = 'brief',
+    webpage_names: Annotated[Optional[list[str]], Field(description="只取這些網頁")] = None,
+    name_contains: Annotated[Optional[str], Field(description="只取名稱包含此字串的網頁（不分大小寫）")] = None,
+    max_pages: Annotated[int, Field(ge=1, le=1000)] = 200,
+    fields: StructureFields = None,
+    max_depth: StructureMaxDepth = None,
+    max_bytes_per_page: StructureMaxBytes = None,
+    ) -> str:
+    """
+    一次取得整個網站所有（或篩選後）網頁的結構，取代逐頁呼叫 my_application_get_brief_webpage_structure
+    回傳 {pages: [{uuid, name, structure}], errors, total, truncated, elapsed_ms}；每讀完一頁送出一次進度通知
+    """
+    config = get_user_config()
+    started = time.perf_counter()
+    status, listing = await _list_webpages(config)
+    try:
+        data = orjson.loads(listing) if status == 200 else None
+    except orjson.JSONDecodeError:
+        data = None
+    # 列表失敗（例如 401 回 {"detail": ...}）不能當成網站沒有網頁
+    if not isinstance(data, list) and not (isinstance(data, dict) and any(isinstance(data.get(key), list) for key in _LIST_ITEM_KEYS)):
+        raise ToolError(f"Failed to list webpages (HTTP {status}): {listing[:500]}")
+    pages = _json_items(data)
+
+    if webpage_names:
+        wanted = set(webpage_names)
+        pages = [page for page in pages if page.get('name') in wanted]
+    if name_contains:
+        pages = [page for page in pages if name_contains.lower() in str(page.get('name') or '').lower()]
+    selected = pages[:max_pages]
+
+    semaphore = asyncio.Semaphore(SNAPSHOT_MAX_CONCURRENCY)
+    completed = 0
+
+    async def fetch(page: dict) -> tuple[Optional[int], str]:
+        nonlocal completed
+        async with semaphore:
+            projection = _StructureProjection(fields, max_depth, None, max_bytes_per_page)
+            try:
+                result = await _fetch_page_structure(config, page.get('name') or '', level, projection)
+                if result[0] == 200 and not projection.requested:
+                    # 未套用 projection 的內容會原樣嵌入回應，先確認是合法 JSON，壞掉的單頁不能弄壞整份快照
+                    orjson.loads(result[1])
+            except (aiohttp.ClientError, asyncio.TimeoutError, ToolError) as e:
+                result = None, f"{type(e).__name__}: {e}"
+            except (orjson.JSONDecodeError, ijson.JSONError) as e:
+                result = None, f"Invalid JSON from backend: {e}"
+        completed += 1
+        await ctx.report_progress(completed, len(selected), f"{page.get('name')}")
+        return result
+
+    results = await asyncio.gather(*(fetch(page) for page in selected))
+    snapshot, errors = [], []
+    for page, (status, text) in zip(selected, results):
+        if status == 200:
+            snapshot.append({'uuid': page.get('uuid'), 'name': page.get('name'), 'structure': orjson.Fragment(text)})
+        else:
+            errors.append({'uuid': page.get('uuid'), 'name': page.get('name'), 'status': status, 'error': text[:500]})
+    return _json_dumps({
+        'pages': snapshot,
+        'errors': errors,
+        'total': len(pages),
+        'truncated': len(pages) - len(selected),
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+    })
+
 
-# @mcp.tool()
-# async def my_application_get_detail_website_structure() -> str:
-#     """
-#     在我的應用中取得整個網站的所有頁面細節的JSON格式文本架構
-#     """
-#     config = get_user_config()
-
-#     async with aiohttp.ClientSession() as session:
-#         async with session.get(
-#             _build_api_url(config, f"/api/v1/website/website/retrieve/"),
-#             ssl=ssl_context,
-#             headers=_base_headers(config),
-#         ) as resp:
-#             text = await resp.text()
-#             return text
 @mcp.tool(output_schema=None)
 async def my_application_list_all_webpages() -> str:
     """
     在我的應用中取得所有網頁
     """
-    config = get_user_config()
+    _, text = await _list_webpages(get_user_config())
+    return text
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            _build_api_url(config, f"/api/v1/website/webpage/list/"),
-            ssl=ssl_context,
-            headers=_base_headers(config),
-        ) as resp:
-            text = await resp.text()
-            return text
-        
+
+async def _list_webpages(config: dict) -> tuple[int, str]:
+    text = _site_cache.get(config, ('webpages',))
+    if text is not None:
+        return 200, text
+    generation = _site_cache.generation(config)
+
+    async with _upstream_request(
+        'GET',
+        _build_api_url(config, f"/api/v1/website/webpage/list/"),
+        coalesce=True,
+        ssl=ssl_context,
+        headers=_base_headers(config),
+    ) as resp:
+        text = await _read_text(resp)
+        if resp.status == 200:
+            _site_cache.put(config, ('webpages',), text, generation)
+        return resp.status, text
+    
 @mcp.tool(output_schema=None)
-async def my_application_get_brief_webpage_structure(webpage_name: str, object_uuid: Optional[str] = None) -> str:
+async def my_application_get_brief_webpage_structure(
+    webpage_name: str,
+    object_uuid: Optional[str] = None,
+    fields: StructureFields = None,
+    max_depth: StructureMaxDepth = None,
+    subtree_root: StructureSubtreeRoot = None,
+    max_bytes: StructureMaxBytes = None,
+    delta: Annotated[bool, Field(description="回傳 {version, full, structure}，之後可用 since 只取變更")] = False,
+    since: Annotated[
+        Optional[str],
+        Field(description="上次回傳的 version；只回傳之後新增（added）、變更（changed）的節點與刪除（removed）的 uuid"),
+    ] = None,
+    ) -> str:
     """
     在我的應用中取得目標網頁精簡的JSON格式文本架構
+    大型網頁可用 fields / max_depth / subtree_root / max_bytes 縮小回傳內容
+    反覆編輯同一頁時用 delta / since 只取變更；since 過期時會回傳完整結構（full=true）
     """
     config = get_user_config()
+    projection = _StructureProjection(fields, max_depth, subtree_root, max_bytes)
+    cache_key = ('structure', webpage_name, object_uuid)
+    source = f"page:{webpage_name}/{object_uuid}" if object_uuid else f"page:{webpage_name}"
+    text = _site_cache.get(config, cache_key)
+    if text is not None:
+        _element_index.offer(config, source, text)
+        if delta or since:
+            return _structure_delta(config, (webpage_name, object_uuid), text, projection, since)
+        return _project_structure_text(text, projection)
+    generation = _site_cache.generation(config)
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            _build_api_url(config, f"/api/v1/website/webpage/{webpage_name or ''}/{object_uuid or ''}/agent/retrieve/?detail=false"),
-            ssl=ssl_context,
-            headers=_base_headers(config),
-        ) as resp:
-            text = await resp.text()
-            return text
+    async with _upstream_request(
+        'GET',
+        _build_api_url(config, f"/api/v1/website/webpage/{webpage_name or ''}/{object_uuid or ''}/agent/retrieve/?detail=false"),
+        ssl=ssl_context,
+        headers=_base_headers(config),
+    ) as resp:
+        # 大小未知或超過快取上限的回應不進快取，直接套用 projection
+        cacheable = (
+            resp.status == 200 and resp.content_type == 'application/json'
+            and (not projection.requested or (resp.content_length is not None and resp.content_length <= SITE_CACHE_MAX_ENTRY_BYTES))
+        )
+        if delta or since:
+            # delta 需要整棵樹才能比對
+            text = await _read_text(resp)
+            if resp.status != 200 or resp.content_type != 'application/json':
+                return text
+        elif not cacheable:
+            if resp.status == 200 and resp.content_type == 'application/json' and _fits_in_memory(resp, PROJECTION_IN_MEMORY_MAX_BYTES):
+                _element_index.offer(config, source, await resp.read())
+            return await _read_structure_response(resp, projection)
+        else:
+            text = await _read_text(resp)
+    _site_cache.put(config, cache_key, text, generation)
+    _element_index.offer(config, source, text)
+    if delta or since:
+        return _structure_delta(config, (webpage_name, object_uuid), text, projection, since)
+    return _project_structure_text(text, projection)
+
+
+@mcp.tool(output_schema=None)
+async def my_application_query_elements(
+    webpage_name: Annotated[Optional[str], Field(description="只查這個網頁；尚未讀取過時會先讀取該網頁結構")] = None,
+    element_type: ElementType = None,
+    tag_name: Optional[str] = None,
+    name: Annotated[Optional[str], Field(description="元素名稱完全相同（不分大小寫）")] = None,
+    name_contains: Annotated[Optional[str], Field(description="元素名稱包含此字串（不分大小寫）")] = None,
+    path: Annotated[
+        Optional[str],
+        Field(description="類似 CSS 的路徑，例如 \"header > cart_button\"、\"body ck_editor\"：空白為任意層子孫，> 為直接子節點，每段比對 name / type / tag_name，* 代表任意節點"),
+    ] = None,
+    within: Annotated[Optional[str], Field(description="只查此元素（uuid 或 relation uuid）底下的子孫")] = None,
+    limit: Annotated[int, Field(ge=1, le=500)] = 50,
+    ) -> str:
+    """
+    從已讀取過的網頁 / 元素結構建立的索引中查詢元素，不必重新拉整棵結構
+    回傳 {matches, total, sources}，每筆含 uuid / relation_uuid / name / tag_name / type / parent_uuid / path
+    索引只涵蓋讀取過的結構（sources）；元素的建立 / 修改 / 刪除 / 移動會同步更新索引
+    """
+    config = get_user_config()
+    steps = path.replace('>', ' > ').split() if path else []
+    if steps and (steps[0] == '>' or steps[-1] == '>' or any(a == b == '>' for a, b in zip(steps, steps[1:]))):
+        raise ToolError(f"Invalid path {path!r}: '>' must be between two steps")
+    page_source = f"page:{webpage_name}" if webpage_name else None
+
+    index = _element_index.materialize(config)
+    if page_source is not None and (index is None or page_source not in index.sources):
+        await my_application_get_brief_webpage_structure(webpage_name)
+        index = _element_index.materialize(config)
+    _element_index.stats['queries'] += 1
+    if index is None:
+        return _json_dumps({'matches': [], 'total': 0, 'sources': [], 'hint': 'Read a webpage structure first or pass webpage_name.'})
+
+    # 從最小的次要索引開始篩選
+    candidates = None
+    for members in (
+        index.by_type.get(element_type, set()) if element_type is not None else None,
+        index.by_tag.get(tag_name.lower(), set()) if tag_name else None,
+        index.by_name.get(name.lower(), set()) if name else None,
+    ):
+        if members is not None and (candidates is None or len(members) < len(candidates)):
+            candidates = members
+    ancestor = index.resolve(within) if within else None
+    if within and ancestor is None:
+        raise ToolError(f"Element {within!r} is not in the index; read the structure that contains it first")
+
+    matches = []
+    for uuid in candidates if candidates is not None else index.nodes:
+        node = index.nodes[uuid]
+        if element_type is not None and node.get('type') != element_type:
+            continue
+        if tag_name and (node.get('tag_name') or '').lower() != tag_name.lower():
+            continue
+        if name and (node.get('name') or '').lower() != name.lower():
+            continue
+        if name_contains and name_contains.lower() not in (node.get('name') or '').lower():
+            continue
+        if page_source is not None and node['source'] != page_source and not node['source'].startswith(page_source + '/'):
+            continue
+        if steps and not (_match_step(node, steps[-1]) and _match_path(index, node, steps[:-1])):
+            continue
+        if ancestor is not None:
+            parent = index.nodes.get(node['parent_uuid'])
+            while parent is not None and parent is not ancestor:
+                parent = index.nodes.get(parent['parent_uuid'])
+            if parent is None:
+                continue
+        matches.append(node)
+
+    now = time.monotonic()
+    return _json_dumps({
+        'matches': [
+            {
+                'uuid': node['uuid'],
+                **{k: node.get(k) for k in _INDEXED_FIELDS},
+                'parent_uuid': node['parent_uuid'],
+                'children': len(node['children']),
+                'path': _node_path(index, node),
+            }
+            for node in matches[:limit]
+        ],
+        'total': len(matches),
+        'sources': [
+            {'source': source, 'age_seconds': round(now - entry['read_at'], 1)}
+            for source, entry in index.sources.items()
+        ],
+    })
 
 @mcp.tool()
 async def my_application_get_element_component_source(component: ElementType) -> str:
@@ -426,16 +3875,128 @@ async def my_application_get_element_component_source(component: ElementType) ->
     取得我的應用中特定element type組件的原始碼以及預設樣式表
     """
     config = get_user_config()
+    return await _source_cache.get(config, component)
 
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            _build_source_viewer_url(config, f"/website_backend/source-viewer/{component}.html"),
-            ssl=ssl_context,
-            headers=_base_headers(config),
-        ) as resp:
-            text = await resp.text()
-            return text
+# 商品 / 部落格文章更新前的比對：記住最近一次 retrieve 的內容，更新時只送出有變更的欄位
+RECORD_CACHE_TTL = float(os.environ.get('RECORD_CACHE_TTL', '60'))  # 超過就不拿來比對，避免後台有人改過而漏送
+RECORD_CACHE_MAX_ENTRIES = int(os.environ.get('RECORD_CACHE_MAX_ENTRIES', '2048'))
+
+UpdateCompareMode = Annotated[
+    Literal['cache', 'fresh', 'off'],
+    Field(description=(
+        "cache：與最近一次 retrieve 的內容比對，只送出有變更的欄位，全部相同時不送出（沒有近期內容時全部送出）；"
+        "fresh：先重新讀取目前內容再比對；off：全部送出並直接回傳後端回應"
+    )),
+]
+
+
+class _RecordCache:
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple, dict] = OrderedDict()
+        self.stats = {'compared': 0, 'skipped_updates': 0, 'omitted_fields': 0, 'omitted_bytes': 0}
+
+    def get(self, config: dict, kind: str, uuid: str) -> Optional[dict]:
+        key = (_SiteCache.tenant(config), kind, uuid)
+        entry = self._entries.get(key)
+        if entry is None or entry['expires_at'] <= time.monotonic():
+            self._entries.pop(key, None)
+            return None
+        return entry['record']
+
+    def put(self, config: dict, kind: str, uuid: str, record: dict) -> None:
+        key = (_SiteCache.tenant(config), kind, uuid)
+        self._entries[key] = {'record': record, 'expires_at': time.monotonic() + self.ttl}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, config: dict, kind: str, uuid: str) -> None:
+        self._entries.pop((_SiteCache.tenant(config), kind, uuid), None)
+
+    def remember(self, config: dict, kind: str, uuid: str, status: int, text: str) -> None:
+        """retrieve / 更新成功且回傳完整記錄時存起來，否則丟掉舊的"""
+        record = None
+        if 200 <= status < 300:
+            with contextlib.suppress(orjson.JSONDecodeError):
+                record = orjson.loads(text)
+        if isinstance(record, dict) and record.get('uuid') == uuid:
+            self.put(config, kind, uuid, record)
+        else:
+            self.invalidate(config, kind, uuid)
+
+
+_record_cache = _RecordCache(RECORD_CACHE_TTL, RECORD_CACHE_MAX_ENTRIES)
+
+
+async def _retrieve_record(config: dict, kind: str, uuid: str) -> tuple[int, str]:
+    async with _upstream_request(
+        'GET',
+        _build_api_url(config, f"/api/v1/store/{config['store_uuid']}/{kind}/{uuid}/retrieve/"),
+        coalesce=True,
+        ssl=ssl_context,
+        headers=_base_headers(config),
+    ) as resp:
+        status, text = resp.status, await _read_text(resp)
+    _record_cache.remember(config, kind, uuid, status, text)
+    return status, text
+
+
+def _same_field_value(new, current) -> bool:
+    """保守比對：送出的值與後端回傳的格式不同（數字字串、關聯物件、時間格式），無法確定相同時一律視為有變更"""
+    if isinstance(current, dict):
+        current = next((current[k] for k in ('uuid', 'id', 'name') if k in current), current)
+    if isinstance(new, bool) or isinstance(current, bool):
+        return str(new).lower() == str(current).lower()
+    if isinstance(new, (int, float)):
+        try:
+            return float(current) == float(new)
+        except (TypeError, ValueError):
+            return False
+    if isinstance(new, list):
+        return isinstance(current, list) and len(new) == len(current) and all(map(_same_field_value, new, current))
+    if isinstance(new, str) and isinstance(current, str) and new != current:
+        try:
+            return datetime.fromisoformat(new) == datetime.fromisoformat(current)
+        except (TypeError, ValueError):
+            return False
+    return new == current
+
+
+async def _changed_fields(config: dict, kind: str, uuid: str, body: dict, compare: str) -> tuple[dict, list[str], Optional[str]]:
+    """回傳 (要送出的欄位, 與目前內容相同而省略的欄位, 比對來源 cache / fresh / None)"""
+    current = _record_cache.get(config, kind, uuid) if compare == 'cache' else None
+    source = 'cache' if current is not None else None
+    if compare == 'fresh':
+        status, text = await _retrieve_record(config, kind, uuid)
+        current = _record_cache.get(config, kind, uuid)
+        if current is None:
+            raise ToolError(f"Failed to retrieve current {kind} for comparison (status {status}): {text[:500]}")
+        source = 'fresh'
+    if current is None:
+        return body, [], None
+    _record_cache.stats['compared'] += 1
+    changes = {k: v for k, v in body.items() if k not in current or not _same_field_value(v, current[k])}
+    unchanged = [k for k in body if k not in changes]
+    _record_cache.stats['omitted_fields'] += len(unchanged)
+    _record_cache.stats['omitted_bytes'] += sum(len(str(body[k]).encode()) for k in unchanged)
+    return changes, unchanged, source
+
+
+def _update_report(changed: list[str], unchanged: list[str], compared_with: Optional[str], text: Optional[str]) -> str:
+    result = text
+    if text is not None:
+        with contextlib.suppress(orjson.JSONDecodeError):
+            result = orjson.loads(text)
+    return _json_dumps({
+        'skipped': text is None,
+        'changed': changed,
+        'unchanged': unchanged,
+        'compared_with': compared_with,
+        'result': result,
+    })
 
 
 #檢視部落格文章
@@ -445,15 +4006,25 @@ async def my_application_retrieve_blog_post(blog_post_uuid: str) -> str:
     在我的應用中取得目標部落格文章的詳細資料
     """
     config = get_user_config()
+    status, text = await _retrieve_record(config, 'blog_post', blog_post_uuid)
+    return text
+
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            _build_api_url(config, f"/api/v1/store/{config['store_uuid']}/blog_post/{blog_post_uuid}/retrieve/"),
+async def _put_blog_post(config: dict, blog_post_uuid: str, body: dict) -> tuple[int, str]:
+    try:
+        async with _upstream_request(
+            'PUT',
+            _build_api_url(config, f"/api/v1/store/{config['store_uuid']}/blog_post/{blog_post_uuid}/update/"),
             ssl=ssl_context,
-            headers=_base_headers(config),
+            data=_to_form_data(body),
+            headers=_base_headers(config, content_type=None),
         ) as resp:
-            text = await resp.text()
-            return text
+            status, text = resp.status, await _read_text(resp)
+    except BaseException:
+        _record_cache.invalidate(config, 'blog_post', blog_post_uuid)
+        raise
+    _record_cache.remember(config, 'blog_post', blog_post_uuid, status, text)
+    return status, text
 
 
 #更新部落格文章
@@ -477,9 +4048,11 @@ async def my_application_update_blog_post(
     ] = None,
     # blog_post_category_relations: Optional[list] = None,
     # blog_post_author_relations: Optional[list] = None,
+    compare: UpdateCompareMode = 'off',
     ) -> str:
     """
     在我的應用中更新目標部落格文章
+    compare 不是 off 時只送出有變更的欄位，回傳 {skipped, changed, unchanged, compared_with, result}
     """
     config = get_user_config()
 
@@ -507,15 +4080,16 @@ async def my_application_update_blog_post(
     if content is not None:
         body['content'] = content
 
-    async with aiohttp.ClientSession() as session:
-        async with session.put(
-            _build_api_url(config, f"/api/v1/store/{config['store_uuid']}/blog_post/{blog_post_uuid}/update/"),
-            ssl=ssl_context,
-            data=_to_form_data(body),
-            headers=_base_headers(config, content_type=None),
-        ) as resp:
-            text = await resp.text()
-            return text
+    if compare == 'off':
+        status, text = await _put_blog_post(config, blog_post_uuid, body)
+        return text
+    changes, unchanged, compared_with = await _changed_fields(config, 'blog_post', blog_post_uuid, body, compare)
+    if compared_with is not None and not changes:
+        _record_cache.stats['skipped_updates'] += 1
+        return _update_report([], unchanged, compared_with, None)
+    status, text = await _put_blog_post(config, blog_post_uuid, changes)
+    return _update_report(list(changes), unchanged, compared_with, text)
+
 
 
 #檢視商品
@@ -525,15 +4099,26 @@ async def my_application_retrieve_product(product_uuid: str) -> str:
     在我的應用中取得目標商品的詳細資料
     """
     config = get_user_config()
+    status, text = await _retrieve_record(config, 'product', product_uuid)
+    return text
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            _build_api_url(config, f"/api/v1/store/{config['store_uuid']}/product/{product_uuid}/retrieve/"),
+
+async def _put_product(config: dict, product_uuid: str, body: dict) -> tuple[int, str]:
+    try:
+        async with _upstream_request(
+            'PUT',
+            _build_api_url(config, f"/api/v1/store/{config['store_uuid']}/product/{product_uuid}/update/"),
             ssl=ssl_context,
-            headers=_base_headers(config),
+            data=_to_form_data(body),
+            headers=_base_headers(config, content_type=None),
         ) as resp:
-            text = await resp.text()
-            return text
+            status, text = resp.status, await _read_text(resp)
+    except BaseException:
+        # 寫入可能已生效，比對用的舊內容不能再用
+        _record_cache.invalidate(config, 'product', product_uuid)
+        raise
+    _record_cache.remember(config, 'product', product_uuid, status, text)
+    return status, text
 
 
 #更新商品
@@ -579,9 +4164,11 @@ async def my_application_update_product(
         Optional[str],
         Field(description="商品規格，使用 CKEditor 編輯與檢視，需為 CKEditor 相容的 HTML 格式字串（例如 <p>, <h2>, <ul> 等標籤）"),
     ] = None,
+    compare: UpdateCompareMode = 'off',
     ) -> str:
     """
     在我的應用中更新目標商品
+    compare 不是 off 時只送出有變更的欄位，回傳 {skipped, changed, unchanged, compared_with, result}
     """
     config = get_user_config()
 
@@ -653,19 +4240,328 @@ async def my_application_update_product(
     if spec is not None:
         body['spec'] = spec
 
-    async with aiohttp.ClientSession() as session:
-        async with session.put(
-            _build_api_url(config, f"/api/v1/store/{config['store_uuid']}/product/{product_uuid}/update/"),
-            ssl=ssl_context,
-            data=_to_form_data(body),
-            headers=_base_headers(config, content_type=None),
-        ) as resp:
-            text = await resp.text()
-            return text
+    if compare == 'off':
+        status, text = await _put_product(config, product_uuid, body)
+        return text
+    changes, unchanged, compared_with = await _changed_fields(config, 'product', product_uuid, body, compare)
+    if compared_with is not None and not changes:
+        _record_cache.stats['skipped_updates'] += 1
+        return _update_report([], unchanged, compared_with, None)
+    status, text = await _put_product(config, product_uuid, changes)
+    return _update_report(list(changes), unchanged, compared_with, text)
+
+
+# 批次更新商品：每個租戶共用一個 token bucket，避免大量改價 / 補貨打爆後端
+BULK_PRODUCT_RATE = float(os.environ.get('BULK_PRODUCT_RATE', '10'))  # 每秒請求數
+BULK_PRODUCT_BURST = int(os.environ.get('BULK_PRODUCT_BURST', '10'))
+BULK_PRODUCT_MAX_CONCURRENCY = int(os.environ.get('BULK_PRODUCT_MAX_CONCURRENCY', '8'))
+BULK_PRODUCT_MAX_ITEMS = int(os.environ.get('BULK_PRODUCT_MAX_ITEMS', '1000'))
+BULK_PRODUCT_MAX_PAGES = int(os.environ.get('BULK_PRODUCT_MAX_PAGES', '50'))  # rule 模式讀取商品列表的分頁上限
+
+
+class _TenantRateLimiter:
+    """每個租戶一個 token bucket；同一租戶同時進行的多個批次共用額度"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._buckets: dict[tuple, list[float]] = {}
+
+    async def acquire(self, config: dict) -> None:
+        if self.rate <= 0:
+            return
+        bucket = self._buckets.setdefault(_SiteCache.tenant(config), [float(self.burst), time.monotonic()])
+        while True:
+            now = time.monotonic()
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return
+            await asyncio.sleep((1 - bucket[0]) / self.rate)
+
+
+_bulk_product_limiter = _TenantRateLimiter(BULK_PRODUCT_RATE, BULK_PRODUCT_BURST)
+
+# 可批次修改的欄位與 my_application_update_product 的參數一致，沿用同一份型別驗證
+_ProductPatch = create_model(
+    'ProductPatch',
+    __config__=ConfigDict(extra='forbid'),
+    **{
+        name: (param.annotation, param.default)
+        for name, param in inspect.signature(my_application_update_product).parameters.items()
+        if name not in ('product_uuid', 'compare')
+    },
+)
+
+
+class BulkProductUpdate(BaseModel):
+    product_uuid: str
+    fields: dict = Field(description="要修改的欄位，名稱與型別同 my_application_update_product 的參數，例如 {\"price\": 199, \"stock\": 20}")
+
+
+class BulkProductRule(BaseModel):
+    tag: Optional[str] = Field(default=None, description="只套用到有此標籤的商品")
+    category: Optional[str] = Field(default=None, description="只套用到此分類的商品")
+    price_change_percent: Optional[float] = Field(default=None, gt=-100, description="原價調整百分比，例如 -10 代表降價 10%")
+    discount_percent: Optional[float] = Field(default=None, gt=0, lt=100, description="以原價打折設定特價（discount_price），例如 20 代表 8 折")
+    stock_set: Optional[int] = Field(default=None, ge=0, description="庫存設為此值")
+    stock_change: Optional[int] = Field(default=None, description="庫存增減量")
+
+
+def _product_matches(product: dict, rule: BulkProductRule) -> bool:
+    if rule.tag is not None:
+        tags = {t.get('name') if isinstance(t, dict) else t for t in product.get('tags') or ()}
+        if rule.tag not in tags:
+            return False
+    if rule.category is not None:
+        category = product.get('category')
+        values = {category.get('uuid'), category.get('name')} if isinstance(category, dict) else {category}
+        if rule.category not in values:
+            return False
+    return True
+
+
+async def _list_all_products(config: dict) -> list[dict]:
+    """讀取完整商品列表；分頁回應（{"results": [...], "next": ...}）會依 next 逐頁讀取，不會只拿到第一頁"""
+    url = _build_api_url(config, f"/api/v1/store/{config['store_uuid']}/product/list/")
+    products = []
+    for _ in range(BULK_PRODUCT_MAX_PAGES):
+        # 不 coalesce：共用的回應會整份讀進記憶體，大型商品列表要邊讀邊解析
+        async with _upstream_request('GET', url, ssl=ssl_context, headers=_base_headers(config)) as resp:
+            if resp.status != 200 or resp.content_type != 'application/json':
+                raise ToolError(f"讀取商品列表失敗（HTTP {resp.status}）: {(await _read_text(resp))[:500]}")
+            items, next_url = await _read_json_page(resp)
+        products.extend(items)
+        if not next_url:
+            return products
+        # next 可能是對外網址，只沿用其 query（page / cursor），仍走內部 URL
+        url = str(yarl.URL(url).with_query(yarl.URL(next_url).query))
+    # 寧可整批失敗，也不要只更新部分符合規則的商品
+    raise ToolError(
+        f"商品列表超過 {BULK_PRODUCT_MAX_PAGES} 頁（已讀取 {len(products)} 個商品），未執行任何更新；"
+        "請縮小規則範圍或改用 updates 逐筆指定"
+    )
+
+
+def _product_rule_patch(product: dict, rule: BulkProductRule) -> dict:
+    fields = {}
+    price = product.get('price')
+    if rule.price_change_percent is not None and price is not None:
+        fields['price'] = round(float(price) * (1 + rule.price_change_percent / 100), 2)
+    if rule.discount_percent is not None and price is not None:
+        fields['discount_price'] = round(fields.get('price', float(price)) * (1 - rule.discount_percent / 100), 2)
+    if rule.stock_set is not None:
+        fields['stock'] = rule.stock_set
+    if rule.stock_change is not None:
+        fields['stock'] = max(0, int(product.get('stock') or 0) + rule.stock_change)
+    return fields
+
+
+@mcp.tool(output_schema=None)
+async def my_application_bulk_update_products(
+    updates: Annotated[
+        Optional[list[BulkProductUpdate]],
+        Field(description="逐筆指定商品與要修改的欄位"),
+    ] = None,
+    rule: Annotated[
+        Optional[BulkProductRule],
+        Field(description="依規則批次修改，例如 {\"tag\": \"sale\", \"discount_percent\": 20}；會先讀取商品列表再計算每個商品的新值"),
+    ] = None,
+    retries: Annotated[int, Field(ge=0, le=5, description="429 / 5xx / 連線失敗的商品重試輪數，其餘錯誤不重試")] = 2,
+    dry_run: Annotated[bool, Field(description="只回傳將套用的變更，不實際更新")] = False,
+    ) -> str:
+    """
+    在我的應用中批次更新商品（改價、折扣、補貨等），一次呼叫完成大量商品更新
+    updates 與 rule 擇一使用；依租戶限速並行送出，回傳每個商品的成功 / 失敗
+    """
+    if (updates is None) == (rule is None):
+        raise ToolError("updates 與 rule 必須擇一提供")
+    config = get_user_config()
+
+    if rule is not None:
+        products = await _list_all_products(config)
+        updates = [
+            BulkProductUpdate(product_uuid=product['uuid'], fields=fields)
+            for product in products
+            if product.get('uuid') and _product_matches(product, rule) and (fields := _product_rule_patch(product, rule))
+        ]
+    if len(updates) > BULK_PRODUCT_MAX_ITEMS:
+        raise ToolError(f"一次最多更新 {BULK_PRODUCT_MAX_ITEMS} 個商品，目前 {len(updates)} 個")
+
+    reports = [{'product_uuid': update.product_uuid} for update in updates]
+    bodies: dict[int, dict] = {}
+    for index, update in enumerate(updates):
+        try:
+            bodies[index] = _ProductPatch(**update.fields).model_dump(mode='json', exclude_none=True)
+        except ValidationError as e:
+            reports[index].update(status='invalid', error='; '.join(
+                f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()
+            ))
+            continue
+        if not bodies[index]:
+            del bodies[index]
+            reports[index].update(status='invalid', error='沒有要修改的欄位')
+    if dry_run:
+        for index, body in bodies.items():
+            reports[index].update(status='planned', fields=body)
+        return _json_dumps({'dry_run': True, 'total': len(updates), 'items': reports})
+
+    semaphore = asyncio.Semaphore(BULK_PRODUCT_MAX_CONCURRENCY)
+
+    async def run(index: int) -> bool:
+        """回傳是否值得重試"""
+        report = reports[index]
+        report['attempts'] = report.get('attempts', 0) + 1
+        async with semaphore:
+            await _bulk_product_limiter.acquire(config)
+            try:
+                status, text = await _put_product(config, updates[index].product_uuid, bodies[index])
+            except (aiohttp.ClientError, asyncio.TimeoutError, ToolError) as e:
+                # 上一輪的 http_status 已不適用
+                report.pop('http_status', None)
+                report.update(status='error', error=f"{type(e).__name__}: {e}")
+                return True
+        if status < 400:
+            report.update(status='ok', http_status=status)
+            report.pop('error', None)
+            return False
+        report.update(status='error', http_status=status, error=text[:500])
+        return status in _RETRY_STATUSES
+
+    started = time.perf_counter()
+    pending = list(bodies)
+    for attempt in range(retries + 1):
+        if attempt:
+            await asyncio.sleep(_retry_delay(attempt))
+        retryable = await asyncio.gather(*(run(index) for index in pending))
+        pending = [index for index, again in zip(pending, retryable) if again]
+        if not pending:
+            break
+
+    succeeded = sum(1 for report in reports if report.get('status') == 'ok')
+    return _json_dumps({
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+        'total': len(updates),
+        'succeeded': succeeded,
+        'failed': len(updates) - succeeded,
+        # 成功的只列 uuid，讓回傳保持精簡
+        'failures': [report for report in reports if report.get('status') != 'ok'],
+        'succeeded_uuids': [report['product_uuid'] for report in reports if report.get('status') == 'ok'],
+    })
+
+
+# 維運用的 /metrics、/stats/* 與 /healthz/ready 的細節和 MCP 共用同一個對外 port，
+# 需帶 Authorization: Bearer <OPS_TOKEN>；未設定 OPS_TOKEN 時這些路徑一律回 404
+OPS_TOKEN = os.environ.get('OPS_TOKEN')
+
+
+def _ops_authorized(request: Request) -> bool:
+    if not OPS_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get('Authorization', '').encode(), f"Bearer {OPS_TOKEN}".encode())
+
+
+def _ops_route(path: str):
+    """只給維運使用的 custom route"""
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        async def guarded(request: Request) -> Response:
+            if not OPS_TOKEN:
+                return JSONResponse({'error': 'not found'}, status_code=404)
+            if not _ops_authorized(request):
+                return JSONResponse({'error': 'unauthorized'}, status_code=401, headers={'WWW-Authenticate': 'Bearer'})
+            return await endpoint(request)
+        return mcp.custom_route(path, methods=["GET"])(guarded)
+    return decorator
+
+
+@_ops_route("/metrics")
+async def metrics(request: Request) -> Response:
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@_ops_route("/stats/upstreams")
+async def upstream_stats(request: Request) -> Response:
+    """各上游的 circuit breaker 狀態與負載平衡 endpoint 統計"""
+    now = time.monotonic()
+    return JSONResponse({
+        'breakers': {name: breaker.state for name, breaker in _circuit_breakers.items()},
+        'pools': {
+            name: [
+                {
+                    'address': e.address,
+                    'outstanding': e.outstanding,
+                    'requests': e.requests,
+                    'ewma_ms': round(e.ewma * 1000, 2),
+                    'failures': e.failures,
+                    'ejected': e.ejected_until > now,
+                }
+                for e in pool.endpoints.values()
+            ]
+            for name, pool in _upstream_pools.items()
+        },
+    })
+
+
+@mcp.custom_route("/healthz/live", methods=["GET"])
+async def liveness(request: Request) -> Response:
+    return JSONResponse({'status': 'ok'})
+
+
+@mcp.custom_route("/healthz/ready", methods=["GET"])
+async def readiness(request: Request) -> Response:
+    """暖機完成前回 503，讓 Kubernetes 先不導流量進來；啟動耗時與暖機錯誤（含內部網址）只回給帶 OPS_TOKEN 的請求"""
+    body = {'ready': _readiness['ready']}
+    if _ops_authorized(request):
+        body.update(startup=_startup_timings, warmup_errors=_readiness['warmup_errors'])
+    return JSONResponse(body, status_code=200 if _readiness['ready'] else 503)
+
+
+@_ops_route("/stats/cache")
+async def cache_stats(request: Request) -> Response:
+    """快取命中率等統計，用來調整快取大小與 TTL"""
+    return JSONResponse({
+        'site': {**_site_cache.stats, 'entries': len(_site_cache._entries)},
+        'source': {'entries': len(_source_cache._entries)},
+        'media': {**_media_snapshots.stats, 'entries': len(_media_snapshots._entries)},
+        'records': {**_record_cache.stats, 'entries': len(_record_cache._entries)},
+        'structure_versions': {**_structure_versions.stats, 'entries': len(_structure_versions._entries)},
+        'element_index': {**_element_index.stats, 'tenants': len(_element_index._tenants)},
+        'tool_manifest': {**_tool_manifest.stats, 'variants': len(_tool_manifest._payloads)},
+        'coalescing': {**_coalesce_stats, 'in_flight': len(_inflight_gets)},
+    })
+
+
+@_ops_route("/stats/tenants")
+async def tenant_stats(request: Request) -> Response:
+    """各租戶執行中 / 排隊中的 tool 呼叫數與被拒絕次數"""
+    return JSONResponse(_tool_scheduler.stats)
+
+
+@_ops_route("/stats/jobs")
+async def job_stats(request: Request) -> Response:
+    """背景工作數量（依租戶與狀態）"""
+    return JSONResponse(_jobs.summary)
+
+
+_mark_startup('module_loaded')
 
 
 if __name__ == "__main__":
-    if dev:
+    import sys
+
+    if sys.argv[1:2] == ['index-tokens']:
+        # python server.py index-tokens [tokens.json] [tokens.db]
+        args = sys.argv[2:]
+        _build_token_db(args[0] if args else "tokens.json", args[1] if len(args) > 1 else "tokens.db")
+    elif dev:
         mcp.run(transport="stdio")
     else:
-        mcp.run(transport="streamable-http", host="0.0.0.0", port=8080, stateless_http=True)
+        mcp.run(
+            transport="streamable-http",
+            host="0.0.0.0",
+            port=8080,
+            stateless_http=True,
+            middleware=[StarletteMiddleware(_HttpMetricsMiddleware), StarletteMiddleware(_CompressionMiddleware), StarletteMiddleware(_ToolListMiddleware)],
+        )
@@ -0,0 +1,79 @@
+import unittest
+from unittest import mock
+
+import orjson
+from aiohttp import web
+
+from upstream import server, upstream
+
+
+class ListAllProductsTest(unittest.IsolatedAsyncioTestCase):
+    async def test_pages_without_content_length_are_streamed(self):
+        async def handler(request):
+            page = int(request.query.get('page', 1))
+            next_url = f"https://shop.example.com{request.path}?page={page + 1}" if page < 3 else None
+            body = orjson.dumps({
+                'results': [{'uuid': f"p{page}-{i}", 'price': 100} for i in range(500)],
+                'next': next_url,
+            })
+            resp = web.StreamResponse(headers={'Content-Type': 'application/json'})
+            resp.enable_chunked_encoding()
+            await resp.prepare(request)
+            for start in range(0, len(body), 8192):
+                await resp.write(body[start:start + 8192])
+            await resp.write_eof()
+            return resp
+
+        async with upstream(handler) as config:
+            with mock.patch.object(server, '_parse_json_page', wraps=server._parse_json_page) as parse:
+                products = await server._list_all_products(config)
+        self.assertEqual(len(products), 1500)
+        self.assertEqual(products[-1]['uuid'], 'p3-499')
+        self.assertEqual(parse.call_count, 3)
+        for call in parse.call_args_list:
+            self.assertIsInstance(call.args[0], server._SyncStreamReader)
+
+
+class BulkRetryTest(unittest.IsolatedAsyncioTestCase):
+    async def _run(self, responses, retries):
+        calls = []
+
+        async def handler(request):
+            calls.append(request.path)
+            response = responses[min(len(calls), len(responses)) - 1]
+            if response is None:
+                # 模擬連線中斷
+                request.transport.close()
+                return web.Response()
+            return web.json_response({'status': response}, status=response)
+
+        async with upstream(handler):
+            with mock.patch.object(server, '_retry_delay', return_value=0):
+                result = orjson.loads(await server.my_application_bulk_update_products(
+                    updates=[server.BulkProductUpdate(product_uuid='p1', fields={'stock': 5})],
+                    retries=retries,
+                ))
+        return result, calls
+
+    async def test_retry_succeeds(self):
+        result, calls = await self._run([503, 200], retries=2)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(result['succeeded'], 1)
+        self.assertEqual(result['failures'], [])
+
+    async def test_connection_error_after_http_error(self):
+        # 第二次失敗是連線錯誤，不應沿用第一次的 503
+        result, _ = await self._run([503, None], retries=1)
+        failure, = result['failures']
+        self.assertEqual(failure['status'], 'error')
+        self.assertNotIn('http_status', failure)
+        self.assertEqual(failure['attempts'], 2)
+
+    async def test_http_error_is_not_retried(self):
+        result, calls = await self._run([400], retries=2)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(result['failures'][0]['http_status'], 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import aiohttp
+from aiohttp import web
+
+from upstream import server, upstream
+
+
+class CoalescedGetTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.calls = 0
+        self.gate = asyncio.Event()
+        self.arrived = asyncio.Event()
+        self.disconnect = False
+
+    async def handler(self, request):
+        self.calls += 1
+        self.arrived.set()
+        await self.gate.wait()
+        if self.disconnect:
+            request.transport.close()
+            return web.Response()
+        return web.json_response({'path': request.path, 'call': self.calls})
+
+    async def get(self, config, path='/api/v1/shared/', headers=None):
+        async with server._upstream_request(
+            'GET', server._build_api_url(config, path), coalesce=True,
+            headers=headers or server._base_headers(config),
+        ) as resp:
+            return resp.status, await resp.read()
+
+    async def test_identical_gets_share_one_request(self):
+        async with upstream(self.handler) as config:
+            tasks = [asyncio.create_task(self.get(config)) for _ in range(5)]
+            await self.arrived.wait()
+            self.gate.set()
+            results = await asyncio.gather(*tasks)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(results[0][0], 200)
+        self.assertEqual(server._inflight_gets, {})
+
+    async def test_different_headers_are_not_shared(self):
+        async with upstream(self.handler) as config:
+            other = {**server._base_headers(config), 'Authorization': 'Token other'}
+            tasks = [asyncio.create_task(self.get(config)), asyncio.create_task(self.get(config, headers=other))]
+            await asyncio.sleep(0.05)
+            self.gate.set()
+            await asyncio.gather(*tasks)
+        self.assertEqual(self.calls, 2)
+
+    async def test_cancelling_one_waiter_keeps_the_others(self):
+        async with upstream(self.handler) as config:
+            first = asyncio.create_task(self.get(config))
+            second = asyncio.create_task(self.get(config))
+            await self.arrived.wait()
+            first.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await first
+            self.gate.set()
+            status, _ = await second
+        self.assertEqual(status, 200)
+        self.assertEqual(self.calls, 1)
+
+    async def test_all_waiters_gone_cancels_the_request(self):
+        async with upstream(self.handler) as config:
+            tasks = [asyncio.create_task(self.get(config)) for _ in range(2)]
+            await self.arrived.wait()
+            flight, = server._inflight_gets.values()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # 已取消的請求立即移出 in-flight 表，之後的呼叫端發新的請求
+            self.assertEqual(server._inflight_gets, {})
+            with self.assertRaises(asyncio.CancelledError):
+                await flight['task']
+            self.gate.set()
+            status, _ = await self.get(config)
+        self.assertEqual(status, 200)
+        self.assertEqual(self.calls, 2)
+
+    async def test_error_reaches_every_waiter(self):
+        self.disconnect = True
+        async with upstream(self.handler) as config:
+            with mock.patch.object(server, '_retry_delay', return_value=0):
+                tasks = [asyncio.create_task(self.get(config)) for _ in range(3)]
+                await self.arrived.wait()
+                self.gate.set()
+                results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            self.assertIsInstance(result, aiohttp.ClientConnectionError)
+        self.assertIs(results[0], results[1])
+        self.assertEqual(server._inflight_gets, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import unittest
+
+import orjson
+
+os.environ.setdefault('DEV', 'true')
+
+import server  # noqa: E402
+
+CONFIG = {'store_uuid': 'store', 'domain': 'example.test'}
+PAGE = orjson.dumps({
+    'uuid': 'page',
+    'name': 'Home',
+    'body': [
+        {
+            'uuid': 'e1',
+            'relation_uuid': 'r1',
+            'name': 'Header',
+            'tag_name': 'header',
+            'children': [{'uuid': 'e2', 'relation_uuid': 'r2', 'name': 'Cart', 'tag_name': 'button'}],
+        },
+        {'uuid': 'e3', 'relation_uuid': 'r3', 'name': 'Footer', 'tag_name': 'footer'},
+    ],
+})
+
+
+class ElementIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = server._ElementIndex(ttl=60, max_tenants=8)
+
+    def names(self):
+        tenant = self.index.materialize(CONFIG)
+        return {uuid: node['name'] for uuid, node in tenant.nodes.items() if uuid != 'page'}
+
+    def test_materialized_source(self):
+        self.index.offer(CONFIG, 'page:home', PAGE)
+        self.assertEqual(self.names(), {'e1': 'Header', 'e2': 'Cart', 'e3': 'Footer'})
+
+    def test_writes_before_materialize(self):
+        # 讀取後還沒查詢就寫入，查詢時要看到寫入後的結果
+        self.index.offer(CONFIG, 'page:home', PAGE)
+        self.index.element_updated(CONFIG, True, 'e3', {'name': 'Bottom'})
+        self.index.element_removed(CONFIG, True, 'r1')
+        self.assertEqual(self.names(), {'e3': 'Bottom'})
+
+    def test_failed_write_before_materialize(self):
+        self.index.offer(CONFIG, 'page:home', PAGE)
+        self.index.element_updated(CONFIG, False, 'e2', {'name': 'Basket'})
+        self.assertEqual(self.names(), {})
+
+    def test_invalidate_before_materialize(self):
+        self.index.offer(CONFIG, 'page:home', PAGE)
+        self.index.invalidate(CONFIG, ['page'])
+        self.assertEqual(self.names(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import asyncio
+import os
+import unittest
+
+os.environ.setdefault('DEV', 'true')
+
+import server  # noqa: E402
+from fastmcp.exceptions import ToolError  # noqa: E402
+
+
+class JobManagerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.jobs = server._JobManager(max_concurrency=2, max_pending=2, timeout=5, ttl=60)
+
+    async def asyncTearDown(self):
+        await self.jobs.shutdown()
+
+    async def test_job_result(self):
+        async def work(job):
+            job.report(1, 1, 'done')
+            return {'ok': True}
+
+        job = self.jobs.submit('tenant', 'test', {}, work)
+        self.assertTrue(job.id.startswith(f"{server._JOB_PROCESS_ID}-"))
+        await job.task
+        self.assertIs(self.jobs.get('tenant', job.id), job)
+        self.assertEqual(job.snapshot()['result'], {'ok': True})
+        self.assertEqual(job.status, 'succeeded')
+
+    async def test_other_tenant_cannot_see_job(self):
+        job = self.jobs.submit('tenant', 'test', {}, lambda job: asyncio.sleep(0))
+        self.assertIsNone(self.jobs.get('other', job.id))
+
+    async def test_unknown_local_job(self):
+        self.assertIsNone(self.jobs.get('tenant', f"{server._JOB_PROCESS_ID}-0000"))
+
+    async def test_job_from_another_process(self):
+        # 多副本時查詢落到別的 pod：明確說明，而不是當成過期
+        with self.assertRaises(ToolError) as cm:
+            self.jobs.get('tenant', 'deadbeef-0123456789abcdef')
+        self.assertIn('single-replica', str(cm.exception))
+
+    async def test_pending_limit(self):
+        gate = asyncio.Event()
+        for _ in range(2):
+            self.jobs.submit('tenant', 'test', {}, lambda job: gate.wait())
+        with self.assertRaises(ToolError):
+            self.jobs.submit('tenant', 'test', {}, lambda job: gate.wait())
+        gate.set()
+
+    async def test_cancel(self):
+        job = self.jobs.submit('tenant', 'test', {}, lambda job: asyncio.sleep(60))
+        await asyncio.sleep(0)
+        self.assertTrue(self.jobs.cancel(job))
+        await asyncio.wait([job.task])
+        self.assertEqual(job.status, 'cancelled')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+from unittest import mock
+
+import orjson
+from aiohttp import web
+
+from upstream import server, upstream
+
+
+def _media(count):
+    return [{'id': i, 'uuid': f"m{i}", 'name': f"image-{i}.png", 'size': 1000 + i} for i in range(count)]
+
+
+class MediaListTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        server._media_snapshots._entries.clear()
+
+    async def test_large_list_without_content_length_is_streamed(self):
+        items = _media(2000)
+
+        async def handler(request):
+            # chunked、沒有 Content-Length
+            resp = web.StreamResponse(headers={'Content-Type': 'application/json'})
+            resp.enable_chunked_encoding()
+            await resp.prepare(request)
+            body = orjson.dumps({'results': items, 'next': None})
+            for start in range(0, len(body), 8192):
+                await resp.write(body[start:start + 8192])
+            await resp.write_eof()
+            return resp
+
+        async with upstream(handler):
+            with mock.patch.object(server, '_parse_json_page', wraps=server._parse_json_page) as parse:
+                result = orjson.loads(await server.my_application_list_my_media_assets('image', limit=5))
+        self.assertEqual(result['total'], 2000)
+        self.assertEqual([item['uuid'] for item in result['items']], ['m0', 'm1', 'm2', 'm3', 'm4'])
+        parse.assert_called_once()
+        self.assertIsInstance(parse.call_args.args[0], server._SyncStreamReader)
+
+    async def test_small_list_is_parsed_in_memory(self):
+        async def handler(request):
+            return web.json_response(_media(3))
+
+        async with upstream(handler):
+            with mock.patch.object(server, '_parse_json_page', wraps=server._parse_json_page) as parse:
+                result = orjson.loads(await server.my_application_list_my_media_assets('image'))
+        self.assertEqual(result['total'], 3)
+        parse.assert_not_called()
+
+    async def test_error_response_is_returned(self):
+        async def handler(request):
+            return web.json_response({'detail': 'Invalid token'}, status=401)
+
+        async with upstream(handler):
+            self.assertEqual(orjson.loads(await server.my_application_list_my_media_assets('image')), {'detail': 'Invalid token'})
+
+
+class MediaFilterTest(unittest.TestCase):
+    def test_size_range(self):
+        media_filter = server._MediaFilter(min_size=100, max_size=200)
+        self.assertTrue(media_filter.match({'size': 150}))
+        self.assertFalse(media_filter.match({'size': 99}))
+        self.assertFalse(media_filter.match({'size': 201}))
+        self.assertFalse(media_filter.match({}))
+
+    def test_string_size(self):
+        media_filter = server._MediaFilter(min_size=100, max_size=200)
+        self.assertTrue(media_filter.match({'size': '150'}))
+        self.assertTrue(media_filter.match({'size': '150.5'}))
+        self.assertFalse(media_filter.match({'size': '250'}))
+        self.assertFalse(media_filter.match({'size': 'large'}))
+        self.assertFalse(media_filter.match({'size': 'nan'}))
+        self.assertFalse(media_filter.match({'size': {'bytes': 150}}))
+
+    def test_size_ignored_without_range(self):
+        self.assertTrue(server._MediaFilter(name_contains='logo').match({'name': 'logo.png', 'size': 'large'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
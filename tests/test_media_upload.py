@@ -0,0 +1,167 @@
+import base64
+import hashlib
+import mmap
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import orjson
+from aiohttp import web
+
+from upstream import server, upstream
+
+CONFIG = {'store_uuid': 'store', 'domain': 'example.test'}
+
+
+async def _collect(chunks) -> list[bytes]:
+    return [chunk async for chunk in chunks]
+
+
+class Base64ChunksTest(unittest.IsolatedAsyncioTestCase):
+    async def test_chunk_boundaries_and_padding(self):
+        # 長度 0 ~ 9 涵蓋沒有 / 一個 / 兩個 = 的 padding
+        for size in range(10):
+            payload = os.urandom(size)
+            encoded = base64.b64encode(payload).decode()
+            for chunk_size in (1, 2, 3, 4, 5, 6, 7, 1024):
+                chunks = await _collect(server._base64_chunks(encoded, 0, chunk_size))
+                self.assertEqual(b''.join(chunks), payload, (size, chunk_size))
+
+    async def test_line_wrapped_input(self):
+        payload = os.urandom(1000)
+        encoded = base64.encodebytes(payload).decode().replace('\n', '\r\n')
+        for chunk_size in (3, 57, 100, 4096):
+            self.assertEqual(b''.join(await _collect(server._base64_chunks(encoded, 0, chunk_size))), payload)
+
+    async def test_offset_skips_data_url_prefix(self):
+        payload = os.urandom(50)
+        data = 'data:image/png;base64,' + base64.b64encode(payload).decode()
+        offset = data.index(',') + 1
+        self.assertEqual(b''.join(await _collect(server._base64_chunks(data, offset, 7))), payload)
+
+    async def test_truncated(self):
+        encoded = base64.b64encode(b'hello world').decode()[:-1]
+        with self.assertRaises(ValueError):
+            await _collect(server._base64_chunks(encoded, 0, 6))
+
+    async def test_invalid_characters(self):
+        with self.assertRaises(ValueError):
+            await _collect(server._base64_chunks('aGVs*G8=', 0, 6))
+
+
+class MmapChunksTest(unittest.IsolatedAsyncioTestCase):
+    async def test_reassembles_file(self):
+        payload = os.urandom(3 * mmap.PAGESIZE + 17)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(payload)
+            f.flush()
+            chunks = await _collect(server._mmap_chunks(f.name, mmap.PAGESIZE + 100))
+        self.assertEqual(b''.join(chunks), payload)
+        # chunk 大小對齊 page
+        self.assertTrue(all(len(chunk) == mmap.PAGESIZE for chunk in chunks[:-1]))
+
+    async def test_empty_file(self):
+        with tempfile.NamedTemporaryFile() as f:
+            self.assertEqual(await _collect(server._mmap_chunks(f.name, 4096)), [])
+
+
+class StagedFilePathTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.staging = tmp.name
+        self.root = os.path.join(self.staging, 'store')
+        os.makedirs(os.path.join(self.root, 'videos'))
+        for path in ('videos/intro.mp4', '../outside.mp4', '../other/secret.mp4', '../store-evil/x.mp4'):
+            full = os.path.normpath(os.path.join(self.root, path))
+            os.makedirs(os.path.dirname(full), exist_ok=True)
+            with open(full, 'wb') as f:
+                f.write(b'video')
+        patcher = mock.patch.object(server, 'MEDIA_STAGING_DIR', self.staging)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_file_inside_store_directory(self):
+        path = server._staged_file_path(CONFIG, 'videos/intro.mp4')
+        self.assertEqual(path, os.path.realpath(os.path.join(self.root, 'videos', 'intro.mp4')))
+        self.assertEqual(server._staged_file_path(CONFIG, 'videos/../videos/intro.mp4'), path)
+
+    def test_rejects_path_traversal(self):
+        for staged_path in (
+            '../outside.mp4',
+            'videos/../../outside.mp4',
+            '../other/secret.mp4',
+            '../store-evil/x.mp4',
+            os.path.join(self.staging, 'outside.mp4'),
+            '/etc/passwd',
+            '.',
+            '',
+        ):
+            with self.assertRaises(ValueError, msg=staged_path):
+                server._staged_file_path(CONFIG, staged_path)
+
+    def test_rejects_symlink_outside(self):
+        os.symlink(os.path.join(self.staging, 'outside.mp4'), os.path.join(self.root, 'link.mp4'))
+        with self.assertRaisesRegex(ValueError, 'outside the staging directory'):
+            server._staged_file_path(CONFIG, 'link.mp4')
+
+    def test_missing_file(self):
+        with self.assertRaisesRegex(ValueError, 'does not exist'):
+            server._staged_file_path(CONFIG, 'videos/missing.mp4')
+
+    def test_disabled_without_staging_dir(self):
+        with mock.patch.object(server, 'MEDIA_STAGING_DIR', None):
+            with self.assertRaisesRegex(ValueError, 'not enabled'):
+                server._staged_file_path(CONFIG, 'videos/intro.mp4')
+
+
+class UploadMediaTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.received = []
+
+    async def handler(self, request):
+        form = await request.post()
+        upload = form['file']
+        body = upload.file.read()
+        self.received.append({'name': form['name'], 'media_type': form['media_type'], 'content_type': upload.content_type, 'body': body})
+        return web.json_response({'uuid': 'f1', 'sha256': hashlib.sha256(body).hexdigest()}, status=201)
+
+    async def upload(self, **fields):
+        async with upstream(self.handler):
+            with mock.patch.object(server, 'MEDIA_UPLOAD_CHUNK_BYTES', 5):
+                return orjson.loads(await server.my_application_upload_media([server.MediaUpload(**fields)]))
+
+    async def test_data_url_upload(self):
+        payload = os.urandom(101)
+        data = 'data:image/webp;base64,' + base64.encodebytes(payload).decode()
+        result = await self.upload(name='banner', content_base64=data)
+        report, = result['files']
+        self.assertEqual(report['status'], 'ok', report)
+        self.assertEqual(report['bytes'], len(payload))
+        received, = self.received
+        self.assertEqual(received['body'], payload)
+        self.assertEqual(received['content_type'], 'image/webp')
+        self.assertEqual(received['media_type'], 'image')
+
+    async def test_invalid_base64_is_reported(self):
+        result = await self.upload(name='banner.png', content_base64='aGVsbG8*')
+        report, = result['files']
+        self.assertEqual(report['status'], 'error')
+        self.assertIn('base64', report['error'])
+
+    async def test_staged_path_traversal_is_rejected(self):
+        with tempfile.TemporaryDirectory() as staging:
+            with open(os.path.join(staging, 'secret.mp4'), 'wb') as f:
+                f.write(b'secret')
+            os.makedirs(os.path.join(staging, 'store'))
+            with mock.patch.object(server, 'MEDIA_STAGING_DIR', staging):
+                result = await self.upload(name='secret.mp4', staged_path='../secret.mp4')
+        report, = result['files']
+        self.assertEqual(report['status'], 'error')
+        self.assertIn('outside the staging directory', report['error'])
+        self.assertEqual(self.received, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
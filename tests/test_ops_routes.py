@@ -0,0 +1,54 @@
+import os
+import unittest
+from unittest import mock
+
+from starlette.testclient import TestClient
+
+os.environ.setdefault('DEV', 'true')
+
+import server  # noqa: E402
+
+OPS_ROUTES = ['/metrics', '/stats/upstreams', '/stats/cache', '/stats/tenants', '/stats/jobs']
+
+
+class OpsRoutesTest(unittest.TestCase):
+    def setUp(self):
+        self.client = TestClient(server.mcp.http_app())
+
+    def test_disabled_without_ops_token(self):
+        with mock.patch.object(server, 'OPS_TOKEN', None):
+            for path in OPS_ROUTES:
+                self.assertEqual(self.client.get(path).status_code, 404, path)
+
+    def test_requires_ops_token(self):
+        with mock.patch.object(server, 'OPS_TOKEN', 'secret'):
+            for path in OPS_ROUTES:
+                self.assertEqual(self.client.get(path).status_code, 401, path)
+                self.assertEqual(self.client.get(path, headers={'Authorization': 'Bearer wrong'}).status_code, 401, path)
+                self.assertEqual(self.client.get(path, headers={'Authorization': 'Bearer secret'}).status_code, 200, path)
+
+    def test_readiness_hides_details(self):
+        readiness = {'ready': True, 'warmup_errors': ['ClientConnectorError: http://10.0.0.1:8000/']}
+        with mock.patch.object(server, 'OPS_TOKEN', 'secret'), mock.patch.dict(server._readiness, readiness):
+            public = self.client.get('/healthz/ready')
+            self.assertEqual(public.status_code, 200)
+            self.assertEqual(public.json(), {'ready': True})
+            detail = self.client.get('/healthz/ready', headers={'Authorization': 'Bearer secret'}).json()
+            self.assertEqual(detail['warmup_errors'], readiness['warmup_errors'])
+            self.assertIn('startup', detail)
+
+    def test_liveness_is_public(self):
+        with mock.patch.object(server, 'OPS_TOKEN', 'secret'):
+            self.assertEqual(self.client.get('/healthz/live').status_code, 200)
+
+
+class TenantLabelTest(unittest.TestCase):
+    def test_tenant_labels_are_opt_in(self):
+        with mock.patch.object(server, 'METRICS_TENANT_LABELS', False):
+            self.assertEqual(server._tenant_label('store-a'), '-')
+        with mock.patch.object(server, 'METRICS_TENANT_LABELS', True):
+            self.assertEqual(server._tenant_label('store-a'), 'store-a')
+
+
+if __name__ == '__main__':
+    unittest.main()
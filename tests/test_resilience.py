@@ -0,0 +1,197 @@
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+from aiohttp import web
+
+from upstream import server, upstream
+from fastmcp.exceptions import ToolError
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.breaker = server._CircuitBreaker('http://backend:8000')
+
+    def open(self):
+        for _ in range(server.UPSTREAM_BREAKER_THRESHOLD):
+            self.breaker.record_failure()
+
+    def cool_down(self):
+        self.breaker.opened_at = time.monotonic() - server.UPSTREAM_BREAKER_COOLDOWN - 1
+
+    def test_stays_closed_below_threshold(self):
+        for _ in range(server.UPSTREAM_BREAKER_THRESHOLD - 1):
+            self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertFalse(self.breaker.before_request())
+
+    def test_success_resets_failures(self):
+        for _ in range(server.UPSTREAM_BREAKER_THRESHOLD - 1):
+            self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_opens_at_threshold(self):
+        self.open()
+        self.assertEqual(self.breaker.state, 'open')
+        with self.assertRaises(ToolError):
+            self.breaker.before_request()
+
+    def test_half_open_allows_one_probe(self):
+        self.open()
+        self.cool_down()
+        self.assertEqual(self.breaker.state, 'half_open')
+        self.assertTrue(self.breaker.before_request())
+        with self.assertRaises(ToolError):
+            self.breaker.before_request()
+
+    def test_probe_success_closes(self):
+        self.open()
+        self.cool_down()
+        self.breaker.before_request()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertFalse(self.breaker.before_request())
+
+    def test_probe_failure_reopens(self):
+        self.open()
+        self.cool_down()
+        self.breaker.before_request()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertFalse(self.breaker.probing)
+
+
+class RetryDelayTest(unittest.TestCase):
+    def test_exponential_backoff_with_cap(self):
+        with mock.patch.object(server.random, 'uniform', side_effect=lambda low, high: high):
+            delays = [server._retry_delay(attempt) for attempt in range(8)]
+        expected = [min(server.UPSTREAM_RETRY_BACKOFF_MAX, server.UPSTREAM_RETRY_BACKOFF * 2 ** i) for i in range(8)]
+        self.assertEqual(delays, expected)
+        self.assertEqual(delays[-1], server.UPSTREAM_RETRY_BACKOFF_MAX)
+
+    def test_full_jitter(self):
+        for attempt in range(6):
+            cap = min(server.UPSTREAM_RETRY_BACKOFF_MAX, server.UPSTREAM_RETRY_BACKOFF * 2 ** attempt)
+            for _ in range(50):
+                self.assertTrue(0 <= server._retry_delay(attempt) <= cap)
+
+
+class _FakeResponse:
+    def __init__(self, name):
+        self.name = name
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+
+class HedgedSendTest(unittest.IsolatedAsyncioTestCase):
+    async def _hedge(self, *behaviours):
+        """behaviours[i] 是第 i 個送出的請求要執行的 coroutine function"""
+        sent = []
+
+        async def send(method, url, kwargs):
+            index = len(sent)
+            sent.append(asyncio.current_task())
+            return await behaviours[index]()
+
+        with mock.patch.object(server, '_send', send), mock.patch.object(server, 'UPSTREAM_HEDGE_DELAY', 0.01):
+            try:
+                return await server._hedged_send('GET', 'http://backend/', {}), sent
+            finally:
+                await asyncio.sleep(0)
+
+    async def test_fast_response_sends_no_hedge(self):
+        fast = _FakeResponse('first')
+
+        async def first():
+            return fast
+
+        resp, sent = await self._hedge(first)
+        self.assertIs(resp, fast)
+        self.assertEqual(len(sent), 1)
+
+    async def test_hedge_wins_and_slow_request_is_cancelled(self):
+        hedge = _FakeResponse('hedge')
+
+        async def slow():
+            await asyncio.sleep(60)
+
+        async def second():
+            return hedge
+
+        resp, sent = await self._hedge(slow, second)
+        self.assertIs(resp, hedge)
+        self.assertEqual(len(sent), 2)
+        self.assertTrue(sent[0].cancelled())
+
+    async def test_losing_response_is_released(self):
+        responses = [_FakeResponse('first'), _FakeResponse('hedge')]
+        release = asyncio.Event()
+        asyncio.get_running_loop().call_later(0.05, release.set)
+
+        async def respond(index):
+            # 兩個請求在同一輪完成，沒被採用的回應要釋放連線
+            await release.wait()
+            return responses[index]
+
+        resp, sent = await self._hedge(lambda: respond(0), lambda: respond(1))
+        self.assertEqual(len(sent), 2)
+        loser, = [r for r in responses if r is not resp]
+        self.assertFalse(resp.released)
+        self.assertTrue(loser.released)
+
+    async def test_failed_first_request_falls_back_to_hedge(self):
+        hedge = _FakeResponse('hedge')
+
+        async def failing():
+            await asyncio.sleep(0.02)
+            raise server.aiohttp.ClientConnectionError('reset')
+
+        async def second():
+            await asyncio.sleep(0.03)
+            return hedge
+
+        resp, _ = await self._hedge(failing, second)
+        self.assertIs(resp, hedge)
+
+    async def test_both_failing_raises(self):
+        async def failing():
+            await asyncio.sleep(0.02)
+            raise server.aiohttp.ClientConnectionError('reset')
+
+        with self.assertRaises(server.aiohttp.ClientConnectionError):
+            await self._hedge(failing, failing)
+
+
+class UpstreamBreakerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_retries_then_opens_breaker(self):
+        calls = 0
+
+        async def handler(request):
+            nonlocal calls
+            calls += 1
+            return web.Response(status=503)
+
+        async with upstream(handler) as config:
+            url = server._build_api_url(config, '/api/v1/flaky/')
+            with mock.patch.object(server, '_retry_delay', return_value=0):
+                # 503 會重試，連續失敗達門檻時 breaker 在重試途中 open，該次請求直接失敗
+                with self.assertRaises(ToolError):
+                    for _ in range(server.UPSTREAM_BREAKER_THRESHOLD):
+                        async with server._upstream_request('GET', url) as resp:
+                            self.assertEqual(resp.status, 503)
+                self.assertEqual(calls, server.UPSTREAM_BREAKER_THRESHOLD)
+                self.assertEqual(server._circuit_breaker(url).state, 'open')
+                with self.assertRaises(ToolError):
+                    async with server._upstream_request('GET', url):
+                        pass
+        # open 期間不再打到後端
+        self.assertEqual(calls, server.UPSTREAM_BREAKER_THRESHOLD)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import asyncio
+import os
+import unittest
+
+os.environ.setdefault('DEV', 'true')
+
+import server  # noqa: E402
+
+
+class FairSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.scheduler = server._FairScheduler(1)
+        self.claims = {'max_concurrency': 1, 'max_queue': 10, 'rate_limit': 0}
+
+    def assertIdle(self):
+        self.assertEqual(self.scheduler.in_use, 0)
+        for state in self.scheduler.tenants.values():
+            self.assertEqual(state.in_flight, 0)
+            self.assertFalse(state.waiters)
+
+    async def _queue(self, tenant):
+        task = asyncio.create_task(self.scheduler.acquire(tenant, self.claims))
+        await asyncio.sleep(0)
+        self.assertEqual(len(self.scheduler.state(tenant).waiters), 1)
+        return task
+
+    async def test_cancelled_waiter_before_release(self):
+        # B 被取消但還沒輪到它清理佇列時 A 釋出名額
+        await self.scheduler.acquire('A', self.claims)
+        b = await self._queue('B')
+        b.cancel()
+        self.scheduler.release('A')
+        with self.assertRaises(asyncio.CancelledError):
+            await b
+        self.assertIdle()
+
+    async def test_cancelled_waiter_skipped_for_next(self):
+        await self.scheduler.acquire('A', self.claims)
+        b = await self._queue('B')
+        c = await self._queue('C')
+        b.cancel()
+        self.scheduler.release('A')
+        with self.assertRaises(asyncio.CancelledError):
+            await b
+        self.assertGreaterEqual(await c, 0.0)
+        self.assertEqual(self.scheduler.state('C').in_flight, 1)
+        self.scheduler.release('C')
+        self.assertIdle()
+
+    async def test_cancelled_waiter_after_cleanup(self):
+        await self.scheduler.acquire('A', self.claims)
+        b = await self._queue('B')
+        b.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await b
+        self.scheduler.release('A')
+        self.assertIdle()
+
+    async def test_cancel_after_grant_returns_slot(self):
+        # 名額已給 B，但 B 在恢復執行前被取消，名額要還回去
+        await self.scheduler.acquire('A', self.claims)
+        b = await self._queue('B')
+        self.scheduler.release('A')
+        b.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await b
+        self.assertIdle()
+
+    async def test_queue_timeout(self):
+        original = server.TENANT_QUEUE_TIMEOUT
+        server.TENANT_QUEUE_TIMEOUT = 0.01
+        try:
+            await self.scheduler.acquire('A', self.claims)
+            b = await self._queue('B')
+            with self.assertRaises(server._Backpressure) as cm:
+                await b
+            self.assertEqual(cm.exception.reason, 'queue_timeout')
+            self.scheduler.release('A')
+            self.assertIdle()
+        finally:
+            server.TENANT_QUEUE_TIMEOUT = original
+
+    async def test_round_robin_grant(self):
+        await self.scheduler.acquire('A', self.claims)
+        claims = dict(self.claims, max_concurrency=2)
+        order = []
+
+        async def run(tenant, tag):
+            await self.scheduler.acquire(tenant, claims)
+            order.append(tag)
+
+        tasks = [asyncio.create_task(run(t, f'{t}{i}')) for i in range(2) for t in ('B', 'C')]
+        await asyncio.sleep(0)
+        self.scheduler.release('A')
+        for _ in range(4):
+            await asyncio.sleep(0)
+            tenant = order[-1][0]
+            self.scheduler.release(tenant)
+        await asyncio.gather(*tasks)
+        self.assertEqual([tag[0] for tag in order], ['B', 'C', 'B', 'C'])
+        self.assertIdle()
+
+
+if __name__ == '__main__':
+    unittest.main()
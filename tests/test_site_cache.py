@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+import unittest
+
+os.environ.setdefault('DEV', 'true')
+
+import server  # noqa: E402
+
+CONFIG = {'store_uuid': 'store', 'domain': 'example.test'}
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _default_ttl(**env) -> float:
+    """在新的 process 中 import server，取得依環境變數決定的預設值"""
+    environ = {k: v for k, v in os.environ.items() if k not in ('SITE_CACHE_TTL', 'SERVER_REPLICAS')}
+    output = subprocess.run(
+        [sys.executable, '-c', 'import server; print(server.SITE_CACHE_TTL)'],
+        cwd=ROOT, env={**environ, 'DEV': 'true', **env}, capture_output=True, text=True, check=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+class SiteCacheDefaultsTest(unittest.TestCase):
+    def test_enabled_for_single_replica(self):
+        self.assertEqual(_default_ttl(), 30)
+
+    def test_disabled_for_multiple_replicas(self):
+        self.assertEqual(_default_ttl(SERVER_REPLICAS='3'), 0)
+
+    def test_explicit_ttl_wins(self):
+        self.assertEqual(_default_ttl(SERVER_REPLICAS='3', SITE_CACHE_TTL='5'), 5)
+
+
+class SiteCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = server._SiteCache(ttl=30, max_entries=8)
+
+    def test_invalidate_structure_containing_uuid(self):
+        generation = self.cache.generation(CONFIG)
+        self.cache.put(CONFIG, ('structure', 'home'), '{"uuid": "e1"}', generation)
+        self.cache.put(CONFIG, ('structure', 'about'), '{"uuid": "e2"}', generation)
+        self.cache.invalidate(CONFIG, ['e1'])
+        self.assertIsNone(self.cache.get(CONFIG, ('structure', 'home')))
+        self.assertEqual(self.cache.get(CONFIG, ('structure', 'about')), '{"uuid": "e2"}')
+
+    def test_read_overlapping_write_is_not_stored(self):
+        generation = self.cache.generation(CONFIG)
+        self.cache.invalidate(CONFIG, ['e1'])
+        self.cache.put(CONFIG, ('structure', 'home'), '{"uuid": "e1"}', generation)
+        self.assertIsNone(self.cache.get(CONFIG, ('structure', 'home')))
+
+    def test_disabled(self):
+        cache = server._SiteCache(ttl=0, max_entries=8)
+        cache.put(CONFIG, ('webpages',), '[]', cache.generation(CONFIG))
+        self.assertIsNone(cache.get(CONFIG, ('webpages',)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+from unittest import mock
+
+import orjson
+from aiohttp import web
+
+from upstream import server, upstream
+
+PAGES = [{'uuid': 'w1', 'name': 'home'}, {'uuid': 'w2', 'name': 'broken'}, {'uuid': 'w3', 'name': 'about'}]
+
+
+class _Context:
+    async def report_progress(self, *args):
+        pass
+
+
+async def _handler(request):
+    if request.path == '/api/v1/website/webpage/list/':
+        return web.json_response(PAGES)
+    name = request.path.split('/')[5]
+    if name == 'broken':
+        return web.Response(text='{"uuid": "page", "body": [', content_type='application/json')
+    return web.json_response({'uuid': name, 'name': name, 'body': [{'uuid': 'e1', 'name': 'Header'}]})
+
+
+class WebsiteSnapshotTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # 快取與元素索引是全域的，每個測試用自己的一份
+        for name, value in (
+            ('_site_cache', server._SiteCache(ttl=60, max_entries=16)),
+            ('_element_index', server._ElementIndex(ttl=60, max_tenants=4)),
+        ):
+            patcher = mock.patch.object(server, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def snapshot(self, **kwargs):
+        async with upstream(_handler):
+            return orjson.loads(await server.my_application_get_website_snapshot(_Context(), **kwargs))
+
+    def assertBrokenPageIsError(self, result):
+        self.assertEqual([page['name'] for page in result['pages']], ['home', 'about'])
+        error, = result['errors']
+        self.assertEqual((error['uuid'], error['name'], error['status']), ('w2', 'broken', None))
+        self.assertIn('Invalid JSON', error['error'])
+
+    async def test_malformed_page_without_projection(self):
+        for level in ('brief', 'detail'):
+            with self.subTest(level=level):
+                result = await self.snapshot(level=level)
+                self.assertBrokenPageIsError(result)
+                self.assertEqual(result['pages'][0]['structure']['body'], [{'uuid': 'e1', 'name': 'Header'}])
+
+    async def test_malformed_page_with_projection(self):
+        for level in ('brief', 'detail'):
+            with self.subTest(level=level):
+                result = await self.snapshot(level=level, fields=['name'])
+                self.assertBrokenPageIsError(result)
+                self.assertEqual(result['pages'][0]['structure']['body'], [{'uuid': 'e1', 'name': 'Header'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
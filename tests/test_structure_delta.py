@@ -0,0 +1,99 @@
+import os
+import time
+import unittest
+from unittest import mock
+
+import orjson
+
+os.environ.setdefault('DEV', 'true')
+
+import server  # noqa: E402
+
+CONFIG = {'store_uuid': 'store', 'domain': 'example.test'}
+PAGE = ('brief', 'home')
+
+
+def _page(header='Header', footer=True, cart=None):
+    body = [{
+        'uuid': 'e1',
+        'name': header,
+        'tag_name': 'header',
+        'children': [{'uuid': 'e2', 'name': 'Logo', 'tag_name': 'img'}] + ([cart] if cart else []),
+    }]
+    if footer:
+        body.append({'uuid': 'e3', 'name': 'Footer', 'tag_name': 'footer'})
+    return orjson.dumps({'uuid': 'page', 'name': 'Home', 'body': body}).decode()
+
+
+def _projection(fields=None, subtree_root=None):
+    return server._StructureProjection(fields, None, subtree_root, None)
+
+
+class StructureDeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.versions = server._StructureVersions(ttl=60, max_entries=16)
+        patcher = mock.patch.object(server, '_structure_versions', self.versions)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def delta(self, text, since=None, projection=None):
+        return orjson.loads(server._structure_delta(CONFIG, PAGE, text, projection or _projection(), since))
+
+    def test_first_read_is_full(self):
+        result = self.delta(_page())
+        self.assertTrue(result['full'])
+        self.assertEqual(result['structure'], orjson.loads(_page()))
+        self.assertIn('version', result)
+
+    def test_unchanged(self):
+        version = self.delta(_page())['version']
+        self.assertEqual(self.delta(_page(), since=version), {'version': version, 'since': version, 'unchanged': True})
+
+    def test_added_changed_removed(self):
+        version = self.delta(_page())['version']
+        cart = {'uuid': 'e4', 'name': 'Cart', 'tag_name': 'button'}
+        result = self.delta(_page(header='Top', footer=False, cart=cart), since=version)
+        self.assertEqual(result['since'], version)
+        self.assertNotEqual(result['version'], version)
+        self.assertEqual(result['added'], [{'uuid': 'e4', 'parent_uuid': 'e1', 'name': 'Cart', 'tag_name': 'button'}])
+        changed = {node['uuid']: node for node in result['changed']}
+        # e1 改名並多了子節點；page 的 body 少了 e3
+        self.assertEqual(set(changed), {'page', 'e1'})
+        self.assertEqual(changed['e1']['name'], 'Top')
+        self.assertEqual(changed['e1']['children'], ['e2', 'e4'])
+        self.assertEqual(changed['page']['body'], ['e1'])
+        self.assertEqual(result['removed'], ['e3'])
+
+    def test_unknown_since_falls_back_to_full(self):
+        result = self.delta(_page(), since='0123456789abcdef')
+        self.assertTrue(result['full'])
+        self.assertEqual(self.versions.stats['expired'], 1)
+
+    def test_expired_since_falls_back_to_full(self):
+        version = self.delta(_page())['version']
+        for entry in self.versions._entries.values():
+            entry['expires_at'] = time.monotonic() - 1
+        result = self.delta(_page(header='Top'), since=version)
+        self.assertTrue(result['full'])
+        self.assertEqual(result['structure'], orjson.loads(_page(header='Top')))
+
+    def test_evicted_since_falls_back_to_full(self):
+        self.versions.max_entries = 1
+        version = self.delta(_page())['version']
+        self.delta(_page(header='Other'))
+        self.assertTrue(self.delta(_page(), since=version)['full'])
+
+    def test_versions_are_scoped_by_projection(self):
+        # 不同 fields 的版本不能互相當作 since
+        version = self.delta(_page())['version']
+        self.assertTrue(self.delta(_page(), since=version, projection=_projection(fields=['name']))['full'])
+
+    def test_field_projection_ignores_other_changes(self):
+        projection = _projection(fields=['name'])
+        version = self.delta(_page(), projection=projection)['version']
+        text = _page().replace('"tag_name":"img"', '"tag_name":"picture"')
+        self.assertTrue(self.delta(text, since=version, projection=_projection(fields=['name']))['unchanged'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import types
+import unittest
+from unittest import mock
+
+os.environ.setdefault('DEV', 'true')
+
+import server  # noqa: E402
+from fastmcp.exceptions import ToolError  # noqa: E402
+from fastmcp.server.auth import AccessToken  # noqa: E402
+
+ALL_TOOLS = frozenset().union(*server.TOOL_SCOPES.values())
+
+
+def _token(scopes):
+    return AccessToken(token='key', client_id='user1', scopes=scopes, claims={})
+
+
+class AllowedToolsTest(unittest.TestCase):
+    def test_no_scopes(self):
+        self.assertIsNone(server._allowed_tools([]))
+        self.assertIsNone(server._allowed_tools(None))
+
+    def test_legacy_scopes(self):
+        # 分組前的 tokens.json（read / write）仍可使用全部 tool
+        self.assertEqual(server._allowed_tools(['read', 'write']), ALL_TOOLS)
+        self.assertEqual(
+            server._allowed_tools(['read']),
+            server.TOOL_SCOPES['website:read'] | server.TOOL_SCOPES['content:read'],
+        )
+
+    def test_unknown_scopes_do_not_restrict(self):
+        self.assertIsNone(server._allowed_tools(['admin']))
+
+    def test_write_implies_read(self):
+        self.assertEqual(
+            server._allowed_tools(['website:write', 'unknown']),
+            server.TOOL_SCOPES['website:read'] | server.TOOL_SCOPES['website:write'],
+        )
+
+
+class ToolScopeMiddlewareTest(unittest.IsolatedAsyncioTestCase):
+    async def _list(self, scopes):
+        with mock.patch.object(server, 'get_access_token', return_value=_token(scopes)):
+            tools = await server._ToolScopeMiddleware().on_list_tools(None, None)
+        return {tool.name for tool in tools}
+
+    async def _call(self, scopes, name):
+        async def call_next(context):
+            return 'called'
+
+        context = types.SimpleNamespace(message=types.SimpleNamespace(name=name))
+        with mock.patch.object(server, 'get_access_token', return_value=_token(scopes)):
+            return await server._ToolScopeMiddleware().on_call_tool(context, call_next)
+
+    async def test_legacy_token_sees_and_calls_all_tools(self):
+        self.assertEqual(await self._list(['read', 'write']), ALL_TOOLS)
+        self.assertEqual(await self._call(['read', 'write'], 'my_application_delete_webpage'), 'called')
+
+    async def test_group_scope_restricts(self):
+        self.assertEqual(await self._list(['content:read']), server.TOOL_SCOPES['content:read'])
+        self.assertEqual(await self._call(['content:read'], 'my_application_retrieve_product'), 'called')
+        with self.assertRaises(ToolError):
+            await self._call(['content:read'], 'my_application_delete_webpage')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import unittest
+from unittest import mock
+
+from aiohttp import web
+
+from upstream import server, upstream
+from fastmcp.exceptions import ToolError
+
+CONFIG = {'store_uuid': 'store', 'domain': 'example.test'}
+
+
+class SameFieldValueTest(unittest.TestCase):
+    def assertSame(self, new, current):
+        self.assertTrue(server._same_field_value(new, current), (new, current))
+
+    def assertDifferent(self, new, current):
+        self.assertFalse(server._same_field_value(new, current), (new, current))
+
+    def test_numbers_and_numeric_strings(self):
+        self.assertSame(199, '199.00')
+        self.assertSame(19.9, '19.90')
+        self.assertSame(1000, '1e3')
+        self.assertSame(5, 5.0)
+        self.assertDifferent(199, '199.01')
+        self.assertDifferent(199, 'abc')
+        self.assertDifferent(0, None)
+        self.assertDifferent(0, '')
+
+    def test_strings_are_not_coerced_to_numbers(self):
+        # 送出字串、後端回數字時無法確定相同，視為有變更
+        self.assertDifferent('199', 199)
+        self.assertDifferent('01', '1')
+
+    def test_booleans(self):
+        self.assertSame(True, True)
+        self.assertSame(True, 'true')
+        self.assertSame(False, 'False')
+        self.assertDifferent(True, False)
+        self.assertDifferent(False, 0)
+        self.assertDifferent(1, True)
+        self.assertDifferent(False, None)
+
+    def test_none(self):
+        self.assertSame(None, None)
+        self.assertDifferent(None, '')
+        self.assertDifferent(None, 0)
+        self.assertDifferent('', None)
+
+    def test_related_object_by_uuid_id_or_name(self):
+        self.assertSame('c1', {'uuid': 'c1', 'name': 'Shoes'})
+        self.assertSame(7, {'id': 7, 'name': 'Shoes'})
+        self.assertSame('Shoes', {'name': 'Shoes'})
+        self.assertDifferent('c2', {'uuid': 'c1'})
+
+    def test_nested_dicts(self):
+        self.assertSame({'color': 'red', 'size': 2}, {'size': 2, 'color': 'red'})
+        self.assertDifferent({'color': 'red'}, {'color': 'blue'})
+        self.assertDifferent({'color': 'red'}, {'color': 'red', 'size': 2})
+        # 帶 uuid 的物件只比 uuid 時無法確定其他欄位，視為有變更
+        self.assertDifferent({'uuid': 'c1', 'name': 'New'}, {'uuid': 'c1', 'name': 'Old'})
+
+    def test_lists(self):
+        self.assertSame(['c1', 'c2'], [{'uuid': 'c1'}, {'uuid': 'c2'}])
+        self.assertSame([1, 2], ['1', '2.0'])
+        self.assertDifferent(['c1', 'c2'], [{'uuid': 'c2'}, {'uuid': 'c1'}])
+        self.assertDifferent(['c1'], [{'uuid': 'c1'}, {'uuid': 'c2'}])
+        self.assertDifferent([], None)
+        self.assertDifferent(['a'], 'a')
+
+    def test_datetimes(self):
+        self.assertSame('2026-01-01T08:00:00+08:00', '2026-01-01T00:00:00Z')
+        self.assertSame('2026-01-01T00:00:00', '2026-01-01T00:00:00.000')
+        self.assertDifferent('2026-01-01T00:00:00', '2026-01-01T00:00:01')
+        self.assertDifferent('2026-01-01T00:00:00', '2026-01-01T00:00:00Z')
+        self.assertDifferent('Hello', 'hello')
+
+
+class ChangedFieldsTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.cache = server._RecordCache(ttl=60, max_entries=16)
+        patcher = mock.patch.object(server, '_record_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_off_sends_everything(self):
+        self.cache.put(CONFIG, 'product', 'p1', {'uuid': 'p1', 'price': '100.00'})
+        body = {'price': 100, 'stock': 5}
+        self.assertEqual(await server._changed_fields(CONFIG, 'product', 'p1', body, 'off'), (body, [], None))
+
+    async def test_cache_without_record_sends_everything(self):
+        body = {'price': 100}
+        self.assertEqual(await server._changed_fields(CONFIG, 'product', 'p1', body, 'cache'), (body, [], None))
+
+    async def test_cache_omits_unchanged_fields(self):
+        self.cache.put(CONFIG, 'product', 'p1', {'uuid': 'p1', 'price': '100.00', 'stock': 3, 'name': 'Shoe'})
+        changes, unchanged, source = await server._changed_fields(
+            CONFIG, 'product', 'p1', {'price': 100, 'stock': 5, 'name': 'Shoe', 'subtitle': None}, 'cache',
+        )
+        # 目前內容沒有的欄位一律送出
+        self.assertEqual(changes, {'stock': 5, 'subtitle': None})
+        self.assertEqual(sorted(unchanged), ['name', 'price'])
+        self.assertEqual(source, 'cache')
+
+    async def test_fresh_reads_current_record(self):
+        async def handler(request):
+            return web.json_response({'uuid': 'p1', 'price': '120.00', 'stock': 5})
+
+        async with upstream(handler) as config:
+            self.cache.put(config, 'product', 'p1', {'uuid': 'p1', 'price': '100.00', 'stock': 5})
+            changes, unchanged, source = await server._changed_fields(config, 'product', 'p1', {'price': 100, 'stock': 5}, 'fresh')
+        self.assertEqual(changes, {'price': 100})
+        self.assertEqual(unchanged, ['stock'])
+        self.assertEqual(source, 'fresh')
+
+    async def test_fresh_read_failure(self):
+        async def handler(request):
+            return web.json_response({'detail': 'Not found.'}, status=404)
+
+        async with upstream(handler) as config:
+            with self.assertRaises(ToolError):
+                await server._changed_fields(config, 'product', 'p1', {'price': 100}, 'fresh')
+
+
+if __name__ == '__main__':
+    unittest.main()
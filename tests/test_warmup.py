@@ -0,0 +1,83 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ.setdefault('DEV', 'true')
+
+import server  # noqa: E402
+
+TOKENS = {
+    # 共用內部 service 的商店算同一個上游
+    'k1': {'store_uuid': 's1', 'domain': 'a.example.com', 'host': 'backend', 'port': 8000, 'protocol': 'http'},
+    'k2': {'store_uuid': 's2', 'domain': 'b.example.com', 'host': 'backend', 'port': '8000', 'protocol': 'http'},
+    'k3': {'store_uuid': 's3', 'domain': 'c.example.com', 'host': 'backend-2', 'protocol': 'http'},
+    # 沒有 host 時各自走 domain
+    'k4': {'store_uuid': 's4', 'domain': 'd.example.com'},
+    'k5': {'store_uuid': 's5', 'domain': 'e.example.com', 'protocol': 'https'},
+}
+
+
+class UpstreamClaimsTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tokens_file = os.path.join(tmp.name, 'tokens.json')
+        with open(self.tokens_file, 'w') as f:
+            json.dump(TOKENS, f)
+        self.db_file = os.path.join(tmp.name, 'tokens.db')
+        server._build_token_db(self.tokens_file, self.db_file)
+
+    def indexes(self):
+        sqlite_index = server._SqliteTokenIndex(self.db_file)
+        self.addCleanup(sqlite_index.close)
+        return server._JsonTokenIndex(self.tokens_file), sqlite_index
+
+    def test_one_tenant_per_upstream(self):
+        for index in self.indexes():
+            with self.subTest(index=type(index).__name__):
+                claims = index.upstream_claims(100)
+                self.assertEqual(len(claims), 4)
+                self.assertEqual(len({server._upstream_key(c) for c in claims}), 4)
+                self.assertEqual(len([c for c in claims if c.get('host') == 'backend']), 1)
+
+    def test_limit(self):
+        for index in self.indexes():
+            with self.subTest(index=type(index).__name__):
+                self.assertEqual(len(index.upstream_claims(2)), 2)
+
+    def test_origins_cover_distinct_hosts(self):
+        configs = [server._config_from_claims(c) for c in server._JsonTokenIndex(self.tokens_file).upstream_claims(100)]
+        origins = server._upstream_origins(configs)
+        self.assertEqual(len(origins), len(set(origins)))
+        for origin in ('http://backend:8000', 'http://backend-2', 'https://d.example.com', 'https://e.example.com'):
+            self.assertIn(origin, origins)
+
+
+class SourcePrefetchTest(unittest.IsolatedAsyncioTestCase):
+    async def prefetch(self, max_entries, stores):
+        cache = server._SourceCache(max_entries, ttl=60)
+        fetched = []
+
+        async def get(config, component):
+            fetched.append((config['domain'], component))
+
+        configs = [{'domain': f"{i}.example.com"} for i in range(stores)]
+        with mock.patch.object(cache, 'get', get):
+            await cache.prefetch(configs)
+        return fetched
+
+    async def test_prefetches_every_component(self):
+        components = server.get_args(server.get_args(server.ElementType)[0])
+        fetched = await self.prefetch(max_entries=512, stores=2)
+        self.assertEqual(len(fetched), 2 * len(components))
+        self.assertEqual(len(set(fetched)), len(fetched))
+
+    async def test_bounded_by_half_of_cache(self):
+        # 租戶再多也只預熱到 LRU 的一半
+        self.assertEqual(len(await self.prefetch(max_entries=64, stores=100)), 32)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+"""測試用的本機上游後端：以 aiohttp 起一個 server，dev 模式的 config 指向它"""
+import contextlib
+import os
+
+from aiohttp import web
+
+os.environ.setdefault('DEV', 'true')
+
+import server  # noqa: E402
+
+
+@contextlib.asynccontextmanager
+async def upstream(handler, store_uuid='store'):
+    app = web.Application()
+    app.router.add_route('*', '/{path:.*}', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    env = {'DOMAIN': f"127.0.0.1:{port}", 'PROTOCOL': 'http', 'STORE_UUID': store_uuid, 'USER_ACCESS_TOKEN': 'token'}
+    previous = {key: os.environ.get(key) for key in env}
+    os.environ.update(env)
+    try:
+        yield server.get_user_config()
+    finally:
+        for key, value in previous.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        # session 綁定建立時的 event loop，每個測試結束時關掉
+        if server._http_session is not None:
+            await server._http_session.close()
+            server._http_session = None
+        await runner.cleanup()
+        # port 可能被之後的測試重用，circuit breaker 的失敗紀錄不能留下來
+        server._circuit_breakers.clear()